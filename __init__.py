@@ -1,7 +1,15 @@
-from .src import (
-    local_main,
-    Configuration,
-    AggregateSpends,
-    BitcoindRPC,
-    BitcoindRPCError,
-)
+from . import src
+
+__all__ = [
+    "local_main",
+    "Configuration",
+    "AggregateSpends",
+    "BitcoindRPC",
+    "BitcoindRPCError",
+]
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(src, name)
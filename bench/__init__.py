@@ -0,0 +1,6 @@
+# Benchmarks and load tests, run from the repository's root folder: `python -m bench.<name>`
+import os
+import tempfile
+
+# src opens its database when imported: benchmarks never touch the working directory's resigner.db
+os.environ.setdefault("RESIGNER_DB_URI", os.path.join(tempfile.mkdtemp(prefix="resigner-bench-"), "resigner.db"))
@@ -0,0 +1,237 @@
+"""
+Worst case cost of adversarial inputs: time and memory of the parsing and script code as
+the size of their input grows, checked to scale (nearly) linearly.
+
+    python -m bench.complexity                  # run every case, exit with an error if one scales badly
+    python -m bench.complexity --filter psbt    # only the cases whose name contains "psbt"
+    python -m bench.complexity --scale 4        # sizes 4 times larger
+
+A case is timed at a series of doubling sizes, and the exponent of its growth is the slope
+of log(cost) against log(size). Linear code is at 1, quadratic code at 2: anything above
+`--max-exponent` is reported as a denial of service risk.
+"""
+import gc
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from src.psbt import PSBT, PartiallySignedInput, PartiallySignedOutput
+from src.tx import CTransaction, CTxIn, CTxOut, COutPoint
+from src.script.script import Script
+from src.crypto.ecc import PrivateKey
+from src.crypto.key import KeyOriginInfo
+from src.bip380.miniscript.parsing import miniscript_from_str
+from src.bip380.miniscript.satisfaction import SatisfactionMaterial
+
+DEFAULT_MAX_EXPONENT = 1.25
+DOUBLINGS = 4
+# Seconds a timing lasts at least, the calls of the small sizes are repeated within it
+MIN_TIMING = 0.05
+
+# name -> (smallest size, function preparing the input of a size and returning the timed callable)
+CASES: Dict[str, tuple] = {}
+
+
+def case(name: str, base: int):
+    def register(setup):
+        CASES[name] = (base, setup)
+        return setup
+    return register
+
+
+_keys: List[bytes] = []
+
+
+def pubkeys(count: int) -> List[bytes]:
+    """Distinct compressed public keys, computed once"""
+    while len(_keys) < count:
+        _keys.append(PrivateKey(len(_keys) + 1).point.sec())
+    return _keys[:count]
+
+
+def psbt_with_inputs(count: int, proprietary: int = 0) -> PSBT:
+    """A PSBT spending `count` segwit outputs, its first input carrying `proprietary` keys"""
+    psbt = PSBT()
+    psbt.tx = CTransaction()
+    psbt.tx.vin = [CTxIn(COutPoint(i + 1, 0), nSequence=0xfffffffd) for i in range(count)]
+    psbt.tx.vout = [CTxOut(1000, b"\x00\x14" + bytes(20))]
+    key = pubkeys(1)[0]
+    for i in range(count):
+        psbt_in = PartiallySignedInput(0)
+        psbt_in.witness_utxo = CTxOut(2000, b"\x00\x20" + bytes(32))
+        psbt_in.hd_keypaths[key] = KeyOriginInfo(b"\x01\x02\x03\x04", [0x80000054, 0x80000001, 0x80000000, 0, i])
+        psbt.inputs.append(psbt_in)
+    psbt.inputs[0].unknown = {b"\xfc\x07resigner" + n.to_bytes(4, "big"): bytes(32) for n in range(proprietary)}
+    psbt.outputs = [PartiallySignedOutput(0)]
+    return psbt
+
+
+@case("psbt.deserialize.inputs", 250)
+def psbt_deserialize_inputs(size: int):
+    psbt = psbt_with_inputs(size).serialize()
+    return lambda: PSBT().deserialize(psbt)
+
+
+@case("psbt.deserialize.proprietary_keys", 1000)
+def psbt_deserialize_proprietary_keys(size: int):
+    psbt = psbt_with_inputs(1, proprietary=size).serialize()
+    return lambda: PSBT().deserialize(psbt)
+
+
+@case("psbt.serialize.inputs", 250)
+def psbt_serialize_inputs(size: int):
+    return psbt_with_inputs(size).serialize
+
+
+def nested_miniscript(depth: int) -> str:
+    keys = [key.hex() for key in pubkeys(2 * depth + 1)]
+    levels = "".join(f"or_d(pk({keys[2 * i]}),and_v(v:pk({keys[2 * i + 1]})," for i in range(depth))
+    return levels + f"pk({keys[-1]})" + "))" * depth
+
+
+def thresh_miniscript(size: int) -> str:
+    keys = [key.hex() for key in pubkeys(size)]
+    return f"thresh({size // 2},pk({keys[0]})," + ",".join(f"s:pk({key})" for key in keys[1:]) + ")"
+
+
+# Each level of nesting is a few frames of the recursive descent parser: deeper than this
+# hits the interpreter's recursion limit, whatever the algorithm.
+@case("miniscript.from_str.nested", 10)
+def miniscript_from_str_nested(size: int):
+    miniscript = nested_miniscript(size)
+    return lambda: miniscript_from_str(miniscript)
+
+
+@case("miniscript.from_str.thresh", 100)
+def miniscript_from_str_thresh(size: int):
+    miniscript = thresh_miniscript(size)
+    return lambda: miniscript_from_str(miniscript)
+
+
+@case("miniscript.satisfy.thresh", 100)
+def miniscript_satisfy_thresh(size: int):
+    node = miniscript_from_str(thresh_miniscript(size))
+    # A (dummy) signature for every key: all of them are candidates
+    material = SatisfactionMaterial(signatures={key: bytes(72) for key in pubkeys(size)})
+    return lambda: node.satisfy(material)
+
+
+def evaluate(script: Script):
+    tx = SimpleNamespace(tx_ins=[SimpleNamespace(witness=None)])
+    return lambda: script.evaluate(tx, 0)
+
+
+@case("script.evaluate.ops", 1000)
+def script_evaluate_ops(size: int):
+    return evaluate(Script([0x51] + [0x76, 0x75] * size))
+
+
+@case("script.evaluate.if_branch", 1000)
+def script_evaluate_if_branch(size: int):
+    # OP_1 OP_IF <size times OP_DUP OP_DROP> OP_ENDIF
+    return evaluate(Script([0x51, 0x51, 0x63] + [0x76, 0x75] * size + [0x68]))
+
+
+def timed_loops(func: Callable, loops: int) -> float:
+    start = time.perf_counter()
+    for _ in range(loops):
+        func()
+    return time.perf_counter() - start
+
+
+def time_call(func: Callable, repeat: int) -> float:
+    """Fastest time of a call, out of `repeat` timings of at least `MIN_TIMING` seconds each"""
+    # A collection landing in one of the timings would skew it
+    gc.disable()
+    try:
+        # A millisecond timing is mostly scheduler noise, which the exponent of the small
+        # sizes would be skewed by
+        loops = 1
+        while timed_loops(func, loops) < MIN_TIMING:
+            loops *= 2
+        return min(timed_loops(func, loops) for _ in range(repeat)) / loops
+    finally:
+        gc.enable()
+
+
+def peak_memory(func: Callable) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def exponent(sizes: List[int], costs: List[float]) -> float:
+    """Least squares slope of log(cost) against log(size)"""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(cost, 1e-9)) for cost in costs]
+    x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+
+
+def run_case(setup: Callable, sizes: List[int], repeat: int) -> Dict:
+    timings, memory = [], []
+    for size in sizes:
+        func = setup(size)
+        func()  # warm up
+        timings.append(time_call(func, repeat))
+        memory.append(peak_memory(func))
+    return {
+        "sizes": sizes,
+        "time_ms": [round(t * 1000, 3) for t in timings],
+        "peak_memory_kb": [round(m / 1024, 1) for m in memory],
+        "time_exponent": round(exponent(sizes, timings), 3),
+        "memory_exponent": round(exponent(sizes, memory), 3),
+    }
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Check the scaling of resigner's parsing code on large inputs.")
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this string")
+    parser.add_argument("--scale", type=float, default=1, help="factor applied to every case's sizes")
+    parser.add_argument("--doublings", type=int, default=DOUBLINGS, help="sizes per case, each twice the previous")
+    parser.add_argument("--repeat", type=int, default=7, help="timings per size, the fastest is kept")
+    parser.add_argument("--max-exponent", type=float, default=DEFAULT_MAX_EXPONENT, help="growth counted as failure")
+    parser.add_argument("--output", help="file the JSON report is written to")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    results = {}
+    print(f"{'case':<36} {'sizes':>14} {'time (ms)':>22} {'time exp':>9} {'mem exp':>8}  status")
+    for name, (base, setup) in CASES.items():
+        if args.filter not in name:
+            continue
+        sizes = [max(1, int(base * args.scale)) * 2 ** i for i in range(args.doublings)]
+        result = run_case(setup, sizes, args.repeat)
+        worst = max(result["time_exponent"], result["memory_exponent"])
+        result["status"] = "ok" if worst <= args.max_exponent else "superlinear"
+        results[name] = result
+        size_range = f"{sizes[0]}..{sizes[-1]}"
+        time_range = f"{result['time_ms'][0]}..{result['time_ms'][-1]}"
+        print(
+            f"{name:<36} {size_range:>14} {time_range:>22} "
+            f"{result['time_exponent']:>9.2f} {result['memory_exponent']:>8.2f}  {result['status']}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "cases": results}, f, indent=2)
+            f.write("\n")
+
+    if any(result["status"] != "ok" for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Database scale benchmark: the daemon's sync jobs and the per-request queries, timed on
+tables holding years worth of rows.
+
+    python -m bench.dbscale --utxos 1000000 --signed-spends 500000 --output dbscale.json
+
+The tables are filled directly, and bitcoind is replaced by `StubRPC` answering from
+memory, so that the timings are the database's (and the Python code around it) only.
+"""
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+from statistics import median
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from src.db import Session
+from src.main import init_db, setup_logging
+from src.models import Utxos, SpentUtxos, SignedSpends, AggregateSpends
+from src.daemon import sync_utxos, sync_aggregate_spends
+from src.analysis import analyse_psbt_from_base64_str
+from src.policy import SpendLimit
+
+from .workload import make_config, SATS
+
+TIP = 800000
+INSERT_BATCH = 50000
+# Satoshis of every synthetic utxo
+UTXO_VALUE = 100000
+
+
+def txid(kind: str, n: int) -> str:
+    return hashlib.sha256(f"{kind}{n}".encode()).hexdigest()
+
+
+class StubRPC:
+    """
+    Answers the rpcs made by the code under test: the first `spent` of the `utxos` known to
+    the database have been spent since the last sync and `new` utxos were received. Every
+    transaction is confirmed.
+    """
+    def __init__(self, utxos: int, spent: int, new: int):
+        self.utxos = utxos
+        self.spent = spent
+        self.new = new
+        self.spent_txids = {txid("utxo", n) for n in range(spent)}
+        self.decoded_psbts: Dict[str, Dict] = {}
+
+    def getblockcount(self) -> int:
+        return TIP
+
+    def listunspent_chunks(self, chunk_size: int = 1000, **kwargs) -> Iterator[List[Dict]]:
+        chunk = []
+        for n in range(self.spent, self.utxos + self.new):
+            chunk.append({
+                "txid": txid("utxo", n), "vout": 0, "amount": UTXO_VALUE / SATS, "confirmations": 1 + n % 1000
+            })
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def gettxout(self, tx: str, vout: int):
+        if tx in self.spent_txids:
+            return None
+        return {"value": UTXO_VALUE / SATS, "confirmations": 1000, "coinbase": False}
+
+    def getrawtransaction(self, tx: str, verbose: bool = True):
+        return {"txid": tx, "confirmations": 1000}
+
+    def decodepsbt(self, psbt: str) -> Dict:
+        return self.decoded_psbts[psbt]
+
+    def getaddressinfo(self, address: str) -> Dict:
+        return {"address": address, "ismine": address.startswith("change")}
+
+
+def populate(args):
+    """Fill the tables, in batches of one transaction each"""
+    init_db()
+    for model in (SpentUtxos, SignedSpends, Utxos, AggregateSpends):
+        model.delete()
+    AggregateSpends.insert()
+
+    for start in range(0, args.utxos, INSERT_BATCH):
+        Utxos.insert_many([
+            (TIP - 1 - n % 1000, txid("utxo", n), 0, UTXO_VALUE)
+            for n in range(start, min(start + INSERT_BATCH, args.utxos))
+        ])
+
+    # Each spend has spent one utxo. The unconfirmed ones are the last, they spend the last
+    # utxos of UTXOS, the confirmed ones utxos long gone.
+    psbt = "cHNidP8B" + "A" * (args.psbt_size - 8)
+    confirmed = args.signed_spends - args.unconfirmed
+    for start in range(0, args.signed_spends, INSERT_BATCH):
+        spends = range(start, min(start + INSERT_BATCH, args.signed_spends))
+        Session.executemany(
+            "INSERT INTO SIGNED_SPENDS VALUES (?,?,?,?,?,?,?);",
+            [(txid("spend", n), time.time(), psbt, psbt, UTXO_VALUE, 0, n < confirmed) for n in spends]
+        )
+        Session.executemany(
+            "INSERT INTO SPENT_UTXOS VALUES (NULL,?,?,?);",
+            [
+                (txid("utxo", args.utxos - args.signed_spends + n) if n >= confirmed else txid("gone", n), 0,
+                 txid("spend", n))
+                for n in spends
+            ]
+        )
+        Session.commit()
+
+
+def time_calls(func: Callable, repeat: int, reset: Callable = None) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        if reset is not None:
+            reset()
+    return {
+        "runs": repeat,
+        "median_ms": round(median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "max_ms": round(max(timings) * 1000, 3),
+    }
+
+
+def rbf_benchmark(config, stub: StubRPC, args) -> Tuple[Callable, Callable]:
+    """A psbt spending the utxo of the last unconfirmed signed spend, replacing it"""
+    n = args.signed_spends - 1
+    replaced = txid("spend", n)
+    spent_utxo = txid("utxo", args.utxos - 1)
+    psbt = "cHNidP8Brbf"
+    stub.decoded_psbts[psbt] = {
+        "tx": {
+            "txid": txid("replacement", n),
+            "vin": [{"txid": spent_utxo, "vout": 0}],
+            "vout": [
+                {"value": 0.0005, "scriptPubKey": {"address": "bcrt1recipient"}},
+                {"value": 0.00049, "scriptPubKey": {"address": "change"}},
+            ],
+        },
+        "fee": 0.00001,
+    }
+    signed_spend = SignedSpends.get([], {"id": replaced})[0]
+
+    def restore():
+        # Put back what the replacement deleted
+        SignedSpends.insert(replaced, signed_spend["unsigned_psbt"], signed_spend["signed_psbt"], UTXO_VALUE)
+        SpentUtxos.insert(spent_utxo, 0, replaced)
+        AggregateSpends.delete()
+        AggregateSpends.insert()
+
+    return lambda: analyse_psbt_from_base64_str(psbt, config), restore
+
+
+def plain_psbt_benchmark(config, stub: StubRPC, inputs: int) -> Callable:
+    """A psbt spending utxos nobody spent before"""
+    psbt = f"cHNidP8B{inputs}"
+    stub.decoded_psbts[psbt] = {
+        "tx": {
+            "txid": txid("plain", inputs),
+            "vin": [{"txid": txid("utxo", stub.utxos // 2 + i), "vout": 0} for i in range(inputs)],
+            "vout": [
+                {"value": 0.0005, "scriptPubKey": {"address": "bcrt1recipient"}},
+                {"value": 0.00049, "scriptPubKey": {"address": "change"}},
+            ],
+        },
+        "fee": 0.00001,
+    }
+    return lambda: analyse_psbt_from_base64_str(psbt, config)
+
+
+def run(args) -> Dict:
+    config = make_config()
+    logger = setup_logging()
+    logger.setLevel(args.log_level)
+    config.set({"logger": logger})
+    stub = StubRPC(args.utxos, args.spent_utxos, args.new_utxos)
+    config.set({"client": stub}, "bitcoind")
+
+    start = time.perf_counter()
+    populate(args)
+    populate_s = time.perf_counter() - start
+
+    results = {}
+    results["sync_utxos"] = time_calls(lambda: sync_utxos(stub), args.sync_repeat)
+    results["sync_aggregate_spends"] = time_calls(lambda: sync_aggregate_spends(config), args.sync_repeat)
+
+    results["analyse_psbt.1_input"] = time_calls(plain_psbt_benchmark(config, stub, 1), args.repeat)
+    results["analyse_psbt.20_inputs"] = time_calls(plain_psbt_benchmark(config, stub, 20), args.repeat)
+    analyse, restore = rbf_benchmark(config, stub, args)
+    results["analyse_psbt.rbf"] = time_calls(analyse, args.repeat, restore)
+
+    policy = SpendLimit(config)
+    psbt = analyse_psbt_from_base64_str("cHNidP8B1", config)
+    results["spend_limit.execute_policy"] = time_calls(lambda: policy.execute_policy({"psbt": psbt}), args.repeat)
+
+    return {
+        "rows": {
+            "utxos": args.utxos,
+            "signed_spends": args.signed_spends,
+            "unconfirmed_signed_spends": args.unconfirmed,
+            "spent_utxos": args.signed_spends,
+        },
+        "populate_s": round(populate_s, 3),
+        "timings": results,
+    }
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Time resigner's database work on large tables.")
+    parser.add_argument("--utxos", type=int, default=1000000, help="rows of UTXOS")
+    parser.add_argument("--signed-spends", type=int, default=500000, help="rows of SIGNED_SPENDS and SPENT_UTXOS")
+    parser.add_argument("--unconfirmed", type=int, default=1000, help="signed spends not confirmed yet")
+    parser.add_argument("--spent-utxos", type=int, default=1000, help="utxos spent since the last sync")
+    parser.add_argument("--new-utxos", type=int, default=1000, help="utxos received since the last sync")
+    parser.add_argument("--psbt-size", type=int, default=600, help="characters of the stored psbts")
+    parser.add_argument("--repeat", type=int, default=20, help="runs of the per-request benchmarks")
+    parser.add_argument("--sync-repeat", type=int, default=1, help="runs of the sync jobs")
+    parser.add_argument("--log-level", default="ERROR", help="resigner's log level during the benchmark")
+    parser.add_argument("--output", help="file the JSON report is written to")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = {"python": platform.python_version(), **run(args)}
+
+    print(f"{'benchmark':<30} {'median (ms)':>12} {'min (ms)':>12} {'max (ms)':>12}")
+    for name, timing in report["timings"].items():
+        print(f"{name:<30} {timing['median_ms']:>12.3f} {timing['min_ms']:>12.3f} {timing['max_ms']:>12.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
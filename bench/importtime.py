@@ -0,0 +1,96 @@
+"""
+Import time of resigner's modules, checked against a budget.
+
+    python -m bench.importtime              # time every module, exit with an error if one is over budget
+    python -m bench.importtime --repeat 10  # keep the fastest of 10 imports
+
+Each module is imported in a fresh interpreter with `-X importtime`, and its cumulative
+import time (its own and its dependencies', interpreter startup excluded) is compared to
+its budget. CLI tools and respawned workers pay it on every start.
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> budget in milliseconds
+BUDGETS: Dict[str, float] = {
+    "src": 5,
+    "src.config": 25,
+    "src.bitcoind_rpc_client": 100,
+    "src.models": 100,
+    "src.analysis": 200,
+    "src.main": 500,
+}
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """(module, own µs, cumulative µs) of every module loaded by importing `module`"""
+    with tempfile.TemporaryDirectory() as cwd:
+        env = dict(os.environ, PYTHONPATH=ROOT, RESIGNER_DB_URI=os.path.join(cwd, "resigner.db"))
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=cwd, env=env, capture_output=True, text=True, check=True
+        )
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times.append((name.strip(), int(own), int(cumulative)))
+    return times
+
+
+def measure(module: str, repeat: int) -> Dict:
+    runs = [import_times(module) for _ in range(repeat)]
+    fastest = min(runs, key=lambda times: next(c for name, _, c in times if name == module))
+    total = next(cumulative for name, _, cumulative in fastest if name == module)
+    heaviest = sorted(fastest, key=lambda entry: -entry[1])[:5]
+    return {
+        "ms": round(total / 1000, 2),
+        "heaviest": {name: round(own / 1000, 2) for name, own, _ in heaviest},
+    }
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Check the import time of resigner's modules against a budget.")
+    parser.add_argument("--filter", default="", help="only time the modules whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module, the fastest is kept")
+    parser.add_argument("--output", help="file the JSON report is written to")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    results = {}
+    print(f"{'module':<28} {'import (ms)':>12} {'budget (ms)':>12}  status")
+    for module, budget in BUDGETS.items():
+        if args.filter not in module:
+            continue
+        result = measure(module, args.repeat)
+        result["budget_ms"] = budget
+        result["status"] = "ok" if result["ms"] <= budget else "over budget"
+        results[module] = result
+        print(f"{module:<28} {result['ms']:>12.1f} {budget:>12.0f}  {result['status']}")
+        if result["status"] != "ok":
+            heaviest = ", ".join(f"{name} {ms}ms" for name, ms in result["heaviest"].items())
+            print(f"    heaviest: {heaviest}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "modules": results}, f, indent=2)
+            f.write("\n")
+
+    if any(result["status"] != "ok" for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Load test of /process-psbt against an in-process fake bitcoind.
+
+    python -m bench.loadtest --requests 500 --rate 100 --inputs 1,5,20 --output load.json
+
+Each run funds the resigner's wallet, builds user-signed PSBTs of the requested shape and
+sends them to the Flask app on a fixed schedule (open loop: a slow server doesn't slow
+the schedule down, so latencies include the time requests spent queued). Part of the
+PSBTs can be:
+- RBF replacements: a second PSBT spending the inputs of an already signed one, sent
+  `--rbf-lag` requests later,
+- conflicts: a second PSBT spending the same inputs, sent at the same time.
+
+The report is JSON: throughput, latency percentiles and histogram, and outcomes by status
+code and error message, per run and per kind of request.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from src.main import init_db
+from src.models import Utxos, SpentUtxos, SignedSpends, AggregateSpends
+from tests.test_framework.fake_bitcoind import FakeBitcoind
+
+from .workload import Wallets, make_app, make_config
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf")]
+UTXO_AMOUNT = 0.001  # btc
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def at(p: float) -> float:
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {
+        "mean": round(sum(samples) / len(samples) * 1000, 3),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(samples[-1] * 1000, 3),
+    }
+
+
+def histogram(samples: List[float]) -> List[Dict]:
+    counts = Counter()
+    for sample in samples:
+        counts[next(le for le in HISTOGRAM_BUCKETS if sample * 1000 <= le)] += 1
+    return [{"le": "+Inf" if le == float("inf") else le, "count": counts[le]} for le in HISTOGRAM_BUCKETS]
+
+
+def build_requests(wallets: Wallets, args, inputs: int, rng: random.Random) -> List[Tuple[str, str]]:
+    """(kind, psbt) in sending order"""
+    utxos = wallets.spendable_utxos()
+    rng.shuffle(utxos)
+
+    requests = []
+    replacements = {}  # position -> replacement psbt
+    for i in range(args.requests):
+        spent = utxos[i * inputs:(i + 1) * inputs]
+        requests.append(("spend", wallets.create_psbt(spent, args.outputs, rng=rng)))
+        if rng.random() < args.conflicts:
+            requests.append(("conflict", wallets.create_psbt(spent, args.outputs, rng=rng)))
+        elif rng.random() < args.rbf:
+            psbt = wallets.create_psbt(spent, args.outputs, fee=0.0001, rng=rng)
+            replacements.setdefault(len(requests) + args.rbf_lag, []).append(("rbf", psbt))
+
+    for position in sorted(replacements, reverse=True):
+        requests[position:position] = replacements[position]
+    return requests
+
+
+class Worker:
+    """Sends the requests scheduled for it and records their outcome"""
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        self.results = []
+
+    def send(self, kind: str, psbt: str, scheduled: float, timeout: float):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+
+        time.sleep(max(0.0, scheduled - time.perf_counter()))
+        start = time.perf_counter()
+        body = {"psbt": psbt}
+        if timeout:
+            body["timeout"] = timeout
+        try:
+            response = client.post("/process-psbt", json=body)
+            if response.status_code == 200:
+                outcome = "200"
+            else:
+                outcome = f"{response.status_code} {(response.json or {}).get('message', '')}"[:200]
+        except Exception as e:
+            outcome = f"exception {type(e).__name__}: {e}"[:200]
+        end = time.perf_counter()
+
+        with self.lock:
+            self.results.append((kind, outcome, end - scheduled, end - start, end))
+
+
+def reset_db():
+    init_db()
+    SpentUtxos.delete()
+    SignedSpends.delete()
+    Utxos.delete()
+    AggregateSpends.delete()
+    AggregateSpends.insert()
+
+
+def run(args, inputs: int) -> Dict:
+    rng = random.Random(args.seed)
+    node = FakeBitcoind(latency=args.rpc_latency)
+    # Addresses handed out by the wallets: funding, and change of every psbt
+    requests_upper_bound = args.requests * 2
+    wallets = Wallets(node, address_range=args.requests * inputs + requests_upper_bound + 100)
+    wallets.fund(args.requests * inputs, UTXO_AMOUNT)
+
+    reset_db()
+    app = make_app(make_config(), wallets, args.log_level)
+    requests = build_requests(wallets, args, inputs, rng)
+    node.calls.clear()
+
+    worker = Worker(app)
+    interval = 1 / args.rate if args.rate else 0
+    start = time.perf_counter() + 0.1
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i, (kind, psbt) in enumerate(requests):
+            executor.submit(worker.send, kind, psbt, start + i * interval, args.timeout)
+    duration = max(result[4] for result in worker.results) - start
+
+    return {
+        "shape": {"inputs": inputs, "outputs": args.outputs},
+        "requests": len(worker.results),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(worker.results) / duration, 2),
+        "ok_rps": round(sum(1 for r in worker.results if r[1] == "200") / duration, 2),
+        **summarize(worker.results),
+        "by_kind": {
+            kind: summarize([r for r in worker.results if r[0] == kind])
+            for kind in sorted({r[0] for r in worker.results})
+        },
+        "rpc_calls": dict(node.calls.most_common()),
+    }
+
+
+def summarize(results: List) -> Dict:
+    outcomes = defaultdict(int)
+    for result in results:
+        outcomes[result[1]] += 1
+    return {
+        "latency_ms": percentiles([r[2] for r in results]),
+        "service_time_ms": percentiles([r[3] for r in results]),
+        "histogram_ms": histogram([r[2] for r in results]),
+        "outcomes": dict(sorted(outcomes.items(), key=lambda outcome: -outcome[1])),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Load test /process-psbt against a fake bitcoind.")
+    parser.add_argument("--requests", type=int, default=200, help="psbts per run, RBF and conflicts excluded")
+    parser.add_argument("--rate", type=float, default=50, help="requests per second, 0 sends them all at once")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at most")
+    parser.add_argument(
+        "--inputs", type=lambda s: [int(i) for i in s.split(",")], default=[1],
+        help="inputs per psbt, a comma separated list runs once per value"
+    )
+    parser.add_argument("--outputs", type=int, default=2, help="outputs per psbt, change included")
+    parser.add_argument("--rbf", type=float, default=0.0, help="share of psbts replaced later on")
+    parser.add_argument("--rbf-lag", type=int, default=20, help="requests sent between a psbt and its replacement")
+    parser.add_argument("--conflicts", type=float, default=0.0, help="share of psbts sent twice concurrently")
+    parser.add_argument("--rpc-latency", type=float, default=0.001, help="seconds added to every rpc")
+    parser.add_argument("--timeout", type=float, default=0, help="time budget sent with each request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="ERROR", help="resigner's log level during the test")
+    parser.add_argument("--output", help="file the JSON report is written to, instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "runs": [run(args, inputs) for inputs in args.inputs],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Microbenchmarks of the pure Python parsing and crypto code, compared to committed baselines.
+
+    python -m bench.micro                   # run, and compare to bench/baselines/micro.json
+    python -m bench.micro --filter psbt     # only the benchmarks whose name contains "psbt"
+    python -m bench.micro --check           # exit with an error if a benchmark regressed
+    python -m bench.micro --save            # record the results as the new baseline
+
+Timings depend on the machine: the baseline should be recorded on the machine the
+comparisons are made on, and updated in the commit that changes the performance.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from io import BytesIO
+from statistics import median
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from src.psbt import PSBT
+from src.tx import CTransaction
+from src.helper import encode_varstr, encode_base58_checksum, decode_base58
+from src.script.script import Script
+from src.crypto import bech32, _base58
+from src.crypto.ecc import G, PrivateKey
+from src.crypto.hd import HDPrivateKey
+from src.bip380.descriptors.checksum import descsum_create
+from src.bip380.miniscript.parsing import miniscript_from_str, miniscript_from_script
+from tests.test_framework.fake_bitcoind import FakeBitcoind
+
+from .workload import Wallets
+
+BASELINE_PATH = "bench/baselines/micro.json"
+# A benchmark regressed if it got slower than its baseline by more than this factor
+DEFAULT_THRESHOLD = 1.25
+
+# name -> function preparing the benchmark's data and returning the timed callable
+BENCHMARKS: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+_psbt = None
+
+
+def sample_psbt() -> str:
+    """A 10 inputs, 3 outputs psbt signed by the user, as sent to resigner"""
+    global _psbt
+    if _psbt is None:
+        wallets = Wallets(FakeBitcoind(), address_range=50)
+        wallets.fund(10, 0.01)
+        _psbt = wallets.create_psbt(wallets.spendable_utxos(), 3, rng=random.Random(0))
+    return _psbt
+
+
+def sample_miniscript() -> str:
+    keys = [PrivateKey(i + 1).point.sec().hex() for i in range(3)]
+    return f"and_v(v:pk({keys[0]}),or_d(multi(2,{keys[1]},{keys[2]},{keys[0]}),and_v(v:pk({keys[1]}),older(12960))))"
+
+
+@benchmark("psbt.deserialize")
+def psbt_deserialize():
+    psbt = sample_psbt()
+    return lambda: PSBT().deserialize(psbt)
+
+
+@benchmark("psbt.serialize")
+def psbt_serialize():
+    psbt = PSBT()
+    psbt.deserialize(sample_psbt())
+    return psbt.serialize
+
+
+@benchmark("tx.deserialize")
+def tx_deserialize():
+    psbt = PSBT()
+    psbt.deserialize(sample_psbt())
+    raw = psbt.tx.serialize_with_witness()
+    return lambda: CTransaction().deserialize(BytesIO(raw))
+
+
+@benchmark("tx.calc_sha256")
+def tx_calc_sha256():
+    psbt = PSBT()
+    psbt.deserialize(sample_psbt())
+    # rehash drops the cached txid before computing it again
+    return psbt.tx.rehash
+
+
+@benchmark("script.parse")
+def script_parse():
+    stream = encode_varstr(miniscript_from_str(sample_miniscript()).script)
+    return lambda: Script.parse(BytesIO(stream))
+
+
+@benchmark("script.evaluate")
+def script_evaluate():
+    # Arithmetic and stack operations only: signature checks are covered by the ecc benchmarks
+    script = Script([0x51] + [0x76, 0x93] * 100 + [0x75])
+    tx = SimpleNamespace(tx_ins=[SimpleNamespace(witness=None)])
+    return lambda: script.evaluate(tx, 0)
+
+
+@benchmark("ecc.s256point_mul")
+def s256point_mul():
+    secret = random.Random(0).randrange(1, 2**256)
+    return lambda: secret * G
+
+
+@benchmark("ecc.private_key_sign")
+def private_key_sign():
+    key = PrivateKey(random.Random(0).randrange(1, 2**256))
+    z = random.Random(1).randrange(1, 2**256)
+    return lambda: key.sign(z)
+
+
+@benchmark("hd.private_child")
+def hd_private_child():
+    key = HDPrivateKey.from_seed(b"\x01" * 32, network="testnet")
+    return lambda: key.child(0)
+
+
+@benchmark("hd.public_traverse")
+def hd_public_traverse():
+    key = HDPrivateKey.from_seed(b"\x01" * 32, network="testnet").pub
+    return lambda: key.traverse("m/0/1")
+
+
+@benchmark("miniscript.from_str")
+def miniscript_parse_str():
+    miniscript = sample_miniscript()
+    return lambda: miniscript_from_str(miniscript)
+
+
+@benchmark("miniscript.from_script")
+def miniscript_parse_script():
+    script = miniscript_from_str(sample_miniscript()).script
+    return lambda: miniscript_from_script(script)
+
+
+@benchmark("descriptors.descsum_create")
+def descriptors_descsum_create():
+    descriptor = f"wsh({sample_miniscript()})"
+    return lambda: descsum_create(descriptor)
+
+
+@benchmark("base58.encode")
+def base58_encode():
+    payload = bytes(range(78))
+    return lambda: _base58.encode(payload)
+
+
+@benchmark("base58.decode")
+def base58_decode():
+    encoded = _base58.encode(bytes(range(78)))
+    return lambda: _base58.decode(encoded)
+
+
+@benchmark("base58.checksum_roundtrip")
+def base58_checksum_roundtrip():
+    payload = b"\x6f" + bytes(range(20))
+    return lambda: decode_base58(encode_base58_checksum(payload))
+
+
+@benchmark("bech32.encode")
+def bech32_encode():
+    script = b"\x00\x20" + bytes(range(32))
+    return lambda: bech32.encode_bech32_checksum(script, "testnet")
+
+
+@benchmark("bech32.decode")
+def bech32_decode():
+    address = bech32.encode_bech32_checksum(b"\x00\x20" + bytes(range(32)), "testnet")
+    return lambda: bech32.decode_bech32(address)
+
+
+def measure(func: Callable, min_time: float, repeat: int) -> Dict[str, float]:
+    """Time per call in microseconds, over `repeat` rounds of at least `min_time` seconds"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    timings = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - start) / loops)
+    return {
+        "median_us": round(median(timings) * 1e6, 3),
+        "min_us": round(min(timings) * 1e6, 3),
+        "loops": loops,
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[Dict]:
+    report = []
+    for name, result in results.items():
+        # The fastest round is the least disturbed by the rest of the machine
+        row = {"name": name, "min_us": result["min_us"], "baseline_us": None, "ratio": None, "status": "new"}
+        if name in baseline:
+            row["baseline_us"] = baseline[name]["min_us"]
+            row["ratio"] = round(result["min_us"] / baseline[name]["min_us"], 3)
+            if row["ratio"] > threshold:
+                row["status"] = "regressed"
+            elif row["ratio"] < 1 / threshold:
+                row["status"] = "improved"
+            else:
+                row["status"] = "unchanged"
+        report.append(row)
+    return report
+
+
+def print_report(report: List[Dict]):
+    print(f"{'benchmark':<30} {'time (us)':>14} {'baseline (us)':>14} {'ratio':>8}  status")
+    for row in report:
+        baseline = f"{row['baseline_us']:.3f}" if row["baseline_us"] is not None else "-"
+        ratio = f"{row['ratio']:.3f}" if row["ratio"] is not None else "-"
+        print(f"{row['name']:<30} {row['min_us']:>14.3f} {baseline:>14} {ratio:>8}  {row['status']}")
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of resigner's parsing and crypto code.")
+    parser.add_argument("--filter", default="", help="only run the benchmarks whose name contains this string")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing round at least")
+    parser.add_argument("--repeat", type=int, default=5, help="timing rounds per benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="slowdown counted as regression")
+    parser.add_argument("--save", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if a benchmark regressed")
+    parser.add_argument("--output", help="file the JSON comparison report is written to")
+    return parser.parse_args(argv)
+
+
+def load_baseline(path: str) -> Dict[str, Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)["benchmarks"]
+    except FileNotFoundError:
+        return {}
+
+
+def main(argv: List[str] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.filter in name:
+            results[name] = measure(setup(), args.min_time, args.repeat)
+
+    baseline = load_baseline(args.baseline)
+    report = compare(results, baseline, args.threshold)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "report": report}, f, indent=2)
+            f.write("\n")
+
+    if args.save:
+        # Benchmarks that weren't run keep their previous baseline
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "benchmarks": {**baseline, **results},
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.check and any(row["status"] == "regressed" for row in report):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
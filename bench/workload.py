@@ -0,0 +1,135 @@
+"""
+Synthetic resigner deployment on top of a `FakeBitcoind`: funded wallets, a configured
+app, and user-signed PSBTs to feed it.
+"""
+import os
+import random
+import tempfile
+from typing import Dict, List, Optional
+
+import toml
+
+from src import Configuration, BitcoindRPC
+from src.main import create_app, init_db, setup_logging
+from src.daemon import sync_utxos
+from src.policy import PolicyHandler, SpendLimit
+from tests.test_framework.fake_bitcoind import FakeBitcoind
+
+RPC_URL = "http://fake"
+SATS = 100000000
+FEE = 0.00001  # btc, paid by every synthetic psbt
+
+# The 2-of-2 descriptors of the functional tests: the user's key, then the resigner's
+USER_XPRV = (
+    "tprv8ZgxMBicQKsPd2JjaqU5FBPphchnxPV2fuE53v3TwR1EEYRWcJp4u9oj7E7VeGouzveBssGRrw8QRMevu2oBgPgWVy5CUAz8HU1AFCWnmiQ"
+)
+USER_XPUB = (
+    "tpubD6NzVbkrYhZ4WVLXUV8feb3wGeDj7ifwFCprLS5mMgod52gHEhdf5eRbHLfKpK7Quev91HYkP1TzooEM9jzY331ViXWzDbeWc4hFy9QdS3R"
+)
+RESIGNER_XPRV = (
+    "tprv8ZgxMBicQKsPcu7atsTZmCB59KA6mhFr4TyKBghM7Tqu3cNHxVD2S2KFoth2b7c9tZsD3PetrANdQ8oc5KUw3KcZr273Vgxrd1dTzyGepSG"
+)
+RESIGNER_XPUB = (
+    "tpubD6NzVbkrYhZ4WN9NnX8AAbqBiLg2w2Skdma6UCjeXjeHt6d4at2ccWw7z4TRkdP6JzbTHiUn4Cyv8QcztoGXooUsP2Dud1AHLyUsCf1ekPU"
+)
+DESCRIPTOR = "wsh(and_v(v:pk({user}/{branch}/*),or_d(pk({resigner}/{branch}/*),older(12960))))"
+
+
+def rpc_client(node: FakeBitcoind, wallet: Optional[str] = None) -> BitcoindRPC:
+    url = f"{RPC_URL}/wallet/{wallet}" if wallet else RPC_URL
+    return BitcoindRPC(url, "user", "passwd", transport=node)
+
+
+class Wallets:
+    """
+    The wallets of a deployment: a miner paying for everything, the resigner's wallet
+    and the wallet of its user, holding the other key of the same descriptors.
+    """
+    def __init__(self, node: FakeBitcoind, address_range: int = 1000):
+        self.node = node
+        self.funder = self._create("funder", [])
+        self.resigner = self._create("resigner_wallet", [
+            (DESCRIPTOR.format(user=USER_XPUB, resigner=RESIGNER_XPRV, branch=branch), branch == 1)
+            for branch in (0, 1)
+        ], address_range)
+        self.user = self._create("user_wallet", [
+            (DESCRIPTOR.format(user=USER_XPRV, resigner=RESIGNER_XPUB, branch=branch), branch == 1)
+            for branch in (0, 1)
+        ], address_range)
+
+        self._miner_address = self.funder.getnewaddress()
+        # Mature coinbases pay for the funding
+        self.mine(101)
+
+    def _create(self, name: str, descriptors: List, address_range: int = 1000) -> BitcoindRPC:
+        client = rpc_client(self.node)
+        client.createwallet(name, False, bool(descriptors), "", False, True)
+        client._url = f"{RPC_URL}/wallet/{name}"
+        if descriptors:
+            client.importdescriptors([
+                {"desc": desc, "active": True, "internal": internal, "range": [0, address_range], "timestamp": "now"}
+                for desc, internal in descriptors
+            ])
+        return client
+
+    def mine(self, blocks: int):
+        self.funder.generatetoaddress(blocks, self._miner_address)
+
+    def fund(self, count: int, amount: float, batch: int = 500):
+        """Create `count` confirmed utxos of `amount` btc in the resigner's wallet"""
+        while count > 0:
+            outputs = {self.resigner.getnewaddress(): amount for _ in range(min(batch, count))}
+            # Keep enough mature coinbases around to pay for the batch
+            self.mine(int(len(outputs) * amount // 25) + 1)
+            self.funder.call("sendmany", ["", outputs])
+            count -= len(outputs)
+        # Spendable by resigner's standards
+        self.mine(6)
+
+    def spendable_utxos(self) -> List[Dict]:
+        return self.resigner.listunspent(6)
+
+    def create_psbt(self, utxos: List[Dict], outputs: int, fee: float = FEE, rng: random.Random = random) -> str:
+        """A psbt spending `utxos` signed by the user, paying `outputs - 1` third parties and the change"""
+        available = round(sum(utxo["amount"] for utxo in utxos) - fee, 8)
+        payments = [round(available * rng.uniform(0.1, 0.5) / max(outputs - 1, 1), 8) for _ in range(outputs - 1)]
+        recipients = [{self.funder.getnewaddress(): amount} for amount in payments]
+        recipients.append({self.user.call("getrawchangeaddress", []): round(available - sum(payments), 8)})
+
+        psbt = self.resigner.createpsbt(
+            [{"txid": utxo["txid"], "vout": utxo["vout"], "sequence": 0xfffffffd} for utxo in utxos],
+            recipients
+        )
+        return self.user.walletprocesspsbt(psbt)["psbt"]
+
+
+def make_config(spend_limit: int = 21000000 * SATS, request_timeout: float = 30) -> Configuration:
+    config_path = os.path.join(tempfile.mkdtemp(prefix="resigner-bench-"), "config.toml")
+    with open(config_path, "w") as f:
+        toml.dump({
+            "resigner_config": {"use_servertime": True, "node": "bitcoind", "request_timeout": request_timeout},
+            "bitcoind": {
+                "network": "regtest",
+                "rpc_url": RPC_URL,
+                "bitcoind_wallet_rpc_url": f"{RPC_URL}/wallet/resigner_wallet",
+                "bitcoind_rpc_user": "user",
+                "bitcoind_rpc_password": "passwd",
+            },
+            "spending_limt": {"daily_limit": spend_limit, "weekly_limit": spend_limit, "monthly_limit": spend_limit},
+        }, f)
+    return Configuration(config_path)
+
+
+def make_app(config: Configuration, wallets: Wallets, log_level: str = "WARNING"):
+    """A synced resigner app using the deployment's resigner wallet"""
+    logger = setup_logging()
+    logger.setLevel(log_level)
+    config.set({"client": wallets.resigner}, "bitcoind")
+    config.set({"logger": logger})
+
+    init_db()
+    sync_utxos(wallets.resigner)
+
+    policy_handler = PolicyHandler()
+    policy_handler.register_policy([SpendLimit(config)])
+    return create_app(config, policy_handler, debug=False)
@@ -1,4 +1,24 @@
-from .main import local_main
-from .config import Configuration
-from .bitcoind_rpc_client import BitcoindRPC, BitcoindRPCError
-from .models import AggregateSpends
\ No newline at end of file
+# The public names are imported on first use: importing the package for `Configuration`
+# doesn't load Flask, the database and the psbt/crypto code along with it.
+_EXPORTS = {
+    "local_main": ".main",
+    "Configuration": ".config",
+    "BitcoindRPC": ".bitcoind_rpc_client",
+    "BitcoindRPCError": ".bitcoind_rpc_client",
+    "AggregateSpends": ".models",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,4 +1,4 @@
-from typing import Any, List, TypedDict, Optional
+from typing import Any, Dict, List, Tuple, TypedDict, Optional, Union
 import sys
 import logging
 
@@ -9,8 +9,12 @@ from .errors import (
 )
 
 from .bitcoind_rpc_client import BitcoindRPC, BitcoindRPCError
-from .crypto.hd import HDPrivateKey, HDPublicKey
+from .deadline import Deadline
+from .logs import PSBT_LOG, psbt_summary
 from .config import Configuration
+from .db import Session
+from .replication import SPEND_REPLICA
+from .shared_cache import WALLET_UTXOS
 from .models import (
     Utxos,
     SpentUtxos,
@@ -71,79 +75,81 @@ class ResignerPsbt:
 
 
 
-def analyse_psbt_from_base64_str(psbt: str, config: Configuration) -> ResignerPsbt:
-    btd_client = config.get("bitcoind")["client"]
-
-    decoded_psbt =  btd_client.decodepsbt(psbt)
-    psbt_vin = decoded_psbt["tx"]["vin"]
-
-    # for key, value in decoded_psbt["tx"].items():
-    
-    utxos: List[Utxos] = []  # Utxos we control
-    third_party_utxos: List[Utxos] = []
-    recipient: List[Recipient] = []
-
-    # build utxo list
-    for utxo in psbt_vin:
-        txout =  btd_client.gettxout(utxo["txid"], utxo["vout"])
-        if not txout:
-            logger.error(f"UTXO txid:{utxo['txid']}, vout: {utxo['vout']}, appears to have been spent")
-            raise UtxoError(utxo["txid"], utxo["vout"])
-        # Get relative lock
-        tx_utxo = {
-                    "txid": utxo["txid"],
-                    "vout": utxo["vout"],
-                    "value": txout["value"],
-                    "safe_to_spend": (txout["confirmations"] >= 6) if not txout["coinbase"] else (txout["confirmations"] >= 100)
-        }
-
-        # Check that the utxo is in the db.
-        # TODO: We should check that the utxo isn't really ours, just incase we aren't completely synced with the blockchain
-        coin = Utxos.get([], {"txid": utxo["txid"], "vout": utxo["vout"]})
-        if coin:
-            utxos.append(tx_utxo)
-            # Check if tx is replaces an already signed but uncomfirmed tx (some version of Replace-by-fee(RBF))
-            spentutxo = SpentUtxos.get([], {"txid": utxo["txid"], "vout": utxo["vout"]})
-            if spentutxo:
-                SpentUtxos.delete({"psbt_id": spentutxo[0]["psbt_id"]})
-                prv_signed_psbt = SignedSpends.get([], {"id": spentutxo[0]["psbt_id"]})
-                logger.info("PSBT: %s...%s replaces a previously signed psbt: %s...%s",\
-                    psbt[0:9], psbt[-10:], prv_signed_psbt["signed_psbt"][0:9], prv_signed_psbt["signed_psbt"][-10:])
-                if prv_signed_psbt:
-                    SignedSpends.delete({"id": spentutxo[0]["psbt_id"]})
-                    agg_spend = AggregateSpends.get([])[0]
-                    AggregateSpends.update(
-                        {
-                            "unconfirmed_daily_spends": agg_spend["unconfirmed_daily_spends"] - prv_signed_psbt[0]["amount_sats"],
-                            "unconfirmed_weekly_spends": agg_spend["unconfirmed_weekly_spends"] - prv_signed_psbt[0]["amount_sats"],
-                            "unconfirmed_monthly_spends": agg_spend["unconfirmed_monthly_spends"] - prv_signed_psbt[0]["amount_sats"]
-                        }
-                    )
-
-        else:
-            third_party_utxos.append(tx_utxo)
-
-    # Get receipients
-    spend_amount = 0
-    psbt_vout = decoded_psbt["tx"]["vout"]
-    for vout in psbt_vout:
-        address = vout["scriptPubKey"]["address"]
-        addr_info = btd_client.getaddressinfo(address)
-        ismine = addr_info["ismine"]
-
-        if not addr_info["ismine"]:
-                spend_amount += vout["value"]
-
-        recv = {
-            "address": address,  # Some vout contain multiple addresses; we expect only one.
-            "value": vout["value"],
-            "ismine": ismine
-        }
-        recipient.append(recv)
+def utxo_from_txout(utxo: Dict, txout: Optional[Dict]) -> UtxosType:
+    """The input `utxo` of a psbt, given the `gettxout` of the output it spends"""
+    if not txout:
+        logger.error(f"UTXO txid:{utxo['txid']}, vout: {utxo['vout']}, appears to have been spent")
+        raise UtxoError(utxo["txid"], utxo["vout"])
+    # Get relative lock
+    return {
+                "txid": utxo["txid"],
+                "vout": utxo["vout"],
+                "value": txout["value"],
+                "safe_to_spend": (txout["confirmations"] >= 6) if not txout["coinbase"] else (txout["confirmations"] >= 100)
+    }
+
+
+def wallet_coin(tx_utxo: UtxosType) -> bool:
+    """Whether `tx_utxo` is a utxo of the wallet whose database is in use"""
+    # The shared table holds the utxos of the default wallet
+    if Session.is_default and WALLET_UTXOS.published:
+        return bool(WALLET_UTXOS.lookup(tx_utxo["txid"], tx_utxo["vout"]))
+    return bool(Utxos.get([], {"txid": tx_utxo["txid"], "vout": tx_utxo["vout"]}))
+
+
+def sort_utxo(
+    psbt: str, tx_utxo: UtxosType, coin: bool, utxos: List[UtxosType], third_party_utxos: List[UtxosType]
+):
+    """
+    Add `tx_utxo` to the utxos we control if it is a `coin` of the wallet, or to the third
+    party ones, undoing the spend it replaces
+    """
+    # TODO: We should check that the utxo isn't really ours, just incase we aren't completely synced with the blockchain
+    if coin:
+        utxos.append(tx_utxo)
+        undo_replaced_spend(psbt, tx_utxo["txid"], tx_utxo["vout"])
+    else:
+        third_party_utxos.append(tx_utxo)
+
+
+def undo_replaced_spend(psbt: str, txid: str, vout: int):
+    """Undo the signed spend of the utxo `txid:vout`, which `psbt` spends again"""
+    # Check if tx is replaces an already signed but uncomfirmed tx (some version of Replace-by-fee(RBF))
+    spentutxo = SpentUtxos.get([], {"txid": txid, "vout": vout})
+    if spentutxo:
+        SpentUtxos.delete({"psbt_id": spentutxo[0]["psbt_id"]})
+        prv_signed_psbt = SignedSpends.get([], {"id": spentutxo[0]["psbt_id"]})
+        if prv_signed_psbt:
+            logger.info("PSBT: %s replaces a previously signed psbt: %s",\
+                psbt_summary(psbt), psbt_summary(prv_signed_psbt[0]["signed_psbt"]), extra=PSBT_LOG)
+            SignedSpends.delete({"id": spentutxo[0]["psbt_id"]})
+            if SPEND_REPLICA.enabled:
+                SPEND_REPLICA.record(-prv_signed_psbt[0]["amount_sats"])
+            AggregateSpends.add(unconfirmed_sats=-prv_signed_psbt[0]["amount_sats"])
+
+
+def recipient_from_vout(vout: Dict, addr_info: Dict) -> RecipientType:
+    """An output of a psbt, given the `getaddressinfo` of its address"""
+    return {
+        "address": vout["scriptPubKey"]["address"],  # Some vout contain multiple addresses; we expect only one.
+        "value": vout["value"],
+        "ismine": addr_info["ismine"]
+    }
+
+
+def resigner_psbt(
+    psbt: str,
+    decoded_psbt: Dict,
+    utxos: List[UtxosType],
+    third_party_utxos: List[UtxosType],
+    recipient: List[RecipientType]
+) -> ResignerPsbt:
+    # Only what leaves the wallet is spent
+    spend_amount = sum(recv["value"] for recv in recipient if not recv["ismine"])
 
     safe_to_sign = all(utxo["safe_to_spend"] for utxo in utxos)
     if not safe_to_sign:
-        logger("PSBT: %s...%s contains unconfirmed UTXOS in it's input", psbt[0:9], psbt[-10:])
+        logger.info("PSBT: %s contains unconfirmed UTXOS in it's input", psbt_summary(psbt), extra=PSBT_LOG)
         raise UnsafePSBTError(psbt, "PSBT contains unconfirmed or unsafe UTXOS in it's input")
 
     fee = None
@@ -160,3 +166,89 @@ def analyse_psbt_from_base64_str(psbt: str, config: Configuration) -> ResignerPs
             fee,
             safe_to_sign
         )
+
+
+def analyse_psbt_from_base64_str(
+    psbt: str,
+    config: Configuration,
+    deadline: Optional[Deadline] = None
+) -> ResignerPsbt:
+    return analyse_psbt_lookups(psbt, psbt_lookups(psbt, config.get("bitcoind")["client"], deadline))
+
+
+# A psbt decoded by bitcoind, with the `gettxout` of its inputs and the `getaddressinfo` of its outputs
+PsbtLookups = Tuple[Dict, List[Optional[Dict]], List[Dict]]
+
+
+def psbt_lookups(psbt: str, btd_client: BitcoindRPC, deadline: Optional[Deadline] = None) -> PsbtLookups:
+    """The rpcs `analyse_psbt_from_base64_str` makes, which don't touch the database"""
+    if deadline is not None:
+        deadline.check("psbt analysis")
+
+    decoded_psbt = btd_client.decodepsbt(psbt)
+    txouts = [btd_client.gettxout(utxo["txid"], utxo["vout"]) for utxo in decoded_psbt["tx"]["vin"]]
+    addr_infos = [btd_client.getaddressinfo(vout["scriptPubKey"]["address"]) for vout in decoded_psbt["tx"]["vout"]]
+    return decoded_psbt, txouts, addr_infos
+
+
+def batch_psbt_lookups(
+    psbts: List[str],
+    btd_client: BitcoindRPC,
+    deadline: Optional[Deadline] = None
+) -> List[Union[PsbtLookups, BitcoindRPCError]]:
+    """
+    The rpcs `analyse_psbt_from_base64_str` makes for each of `psbts`, as one batch request
+    per method. A psbt bitcoind can't decode gets its error instead.
+    """
+    if deadline is not None:
+        deadline.check("psbt analysis")
+
+    decoded_psbts = btd_client.batch_call("decodepsbt", [[psbt] for psbt in psbts])
+    decoded = [d for d in decoded_psbts if not isinstance(d, BitcoindRPCError)]
+
+    # Looked up once even when several psbts share them
+    outpoints = list(dict.fromkeys((vin["txid"], vin["vout"]) for d in decoded for vin in d["tx"]["vin"]))
+    addresses = list(dict.fromkeys(vout["scriptPubKey"]["address"] for d in decoded for vout in d["tx"]["vout"]))
+    txouts = dict(zip(outpoints, btd_client.batch_call("gettxout", [[txid, n, True] for txid, n in outpoints])))
+    addr_infos = dict(zip(addresses, btd_client.batch_call("getaddressinfo", [[address] for address in addresses])))
+
+    return [
+        d if isinstance(d, BitcoindRPCError) else (
+            d,
+            [txouts[(vin["txid"], vin["vout"])] for vin in d["tx"]["vin"]],
+            [addr_infos[vout["scriptPubKey"]["address"]] for vout in d["tx"]["vout"]]
+        )
+        for d in decoded_psbts
+    ]
+
+
+def analyse_psbt_lookups(psbt: str, lookups: PsbtLookups, owned_only: bool = False) -> ResignerPsbt:
+    """
+    `analyse_psbt_from_base64_str`, given the results of its rpcs. It undoes the spends the
+    psbt replaces: it's run under the spend lock, like the recording of the spend.
+
+    With `owned_only`, a psbt spending a utxo that isn't the wallet's is rejected.
+    """
+    decoded_psbt, txouts, addr_infos = lookups
+    for result in (*txouts, *addr_infos):
+        if isinstance(result, BitcoindRPCError):
+            raise result
+
+    # Every input is checked before the database is touched
+    tx_utxos = [utxo_from_txout(utxo, txout) for utxo, txout in zip(decoded_psbt["tx"]["vin"], txouts)]
+
+    utxos: List[UtxosType] = []  # Utxos we control
+    third_party_utxos: List[UtxosType] = []
+    with Session.transaction():
+        coins = [wallet_coin(tx_utxo) for tx_utxo in tx_utxos]
+        if owned_only and not all(coins):
+            # Its keys routed it to this wallet, its spends would be recorded in no other
+            logger.info("PSBT: %s spends utxos of another wallet", psbt_summary(psbt), extra=PSBT_LOG)
+            raise UnsafePSBTError(psbt, "PSBT spends utxos that aren't the wallet's")
+        for tx_utxo, coin in zip(tx_utxos, coins):
+            sort_utxo(psbt, tx_utxo, coin, utxos, third_party_utxos)
+
+    recipient = [
+        recipient_from_vout(vout, addr_info) for vout, addr_info in zip(decoded_psbt["tx"]["vout"], addr_infos)
+    ]
+    return resigner_psbt(psbt, decoded_psbt, utxos, third_party_utxos, recipient)
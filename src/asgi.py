@@ -0,0 +1,338 @@
+"""
+ASGI serving mode.
+
+`/process-psbt` is handled by coroutines: the rpcs to bitcoind go through an
+`AsyncBitcoindRPC` and the database work through an `AsyncDB`, so a request waiting on
+bitcoind costs a coroutine instead of a thread. The other endpoints (metrics, admin,
+swagger) are served by the Flask app, run in a thread pool.
+
+Run it with any ASGI server, e.g.
+
+    RESIGNER_CONFIG_PATH=config.toml uvicorn --factory src.asgi:asgi_app_from_env --port 7767
+"""
+import io
+import os
+import sys
+import math
+import time
+import asyncio
+import logging
+from sqlite3 import DatabaseError
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+from .analysis import ResignerPsbt, PsbtLookups, analyse_psbt_lookups
+from .async_db import AsyncDB
+from .async_rpc_client import AsyncBitcoindRPC
+from .bitcoind_rpc_client import BitcoindRPCError
+from .config import Configuration
+from .deadline import Deadline
+from .errors import ServerError, UtxoError, UnsafePSBTError, DBError, DeadlineExceededError, PSBTSerializationError
+from .logs import PSBT_LOG, psbt_summary
+from .locks import ProcessLock
+from .main import (
+    INVALID_TIMEOUT,
+    create_app,
+    route_psbt,
+    routed_wallet,
+    routing_enabled,
+    start_resigner,
+    valid_timeout,
+    request_deadline,
+    record_signed_spend,
+    annotate_request_trace,
+)
+from .metrics import HTTP_REQUESTS, HTTP_REQUEST_DURATION
+from .policy import PolicyHandler, PolicyException
+from .tenants import Tenant
+from .tracing import TRACER, span, valid_request_id
+
+PROCESS_PSBT = "/process-psbt"
+
+
+class Response:
+    def __init__(self, status_code: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers if headers is not None else {}
+
+    @classmethod
+    def json(cls, status_code: int, **content) -> "Response":
+        return cls(status_code, orjson.dumps(content), {"Content-Type": "application/json"})
+
+
+def error_response(e: Exception, logger: logging.Logger) -> Response:
+    """The response of the Flask app's error handlers to `e`"""
+    if isinstance(e, UtxoError):
+        return Response.json(403, error_code=403, message=e.message, details={"txid": e.txid, "vout": e.vout})
+    if isinstance(e, PSBTSerializationError):
+        return Response.json(400, error_code=400, message=e.message)
+    if isinstance(e, (UnsafePSBTError, PolicyException)):
+        return Response.json(403, error_code=403, message=e.message)
+    if isinstance(e, DeadlineExceededError):
+        logger.error(e.message)
+        return Response.json(504, error_code=504, message=e.message)
+    if isinstance(e, (DatabaseError, DBError)):
+        logger.error(f"A Database Error: {e} occured")
+    else:
+        logger.error(f"Unhandled Exception: {e} occured")
+    return Response.json(500, error_code=500, message=f"Internal Server Error: {e}")
+
+
+def wsgi_environ(scope: Dict, body: bytes) -> Dict:
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value.decode('latin-1')}" if key in environ else value.decode("latin-1")
+    return environ
+
+
+def call_wsgi(app, scope: Dict, body: bytes) -> Response:
+    """Serve an ASGI request with a WSGI app, buffering the response"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = int(status.split(" ", 1)[0]), headers
+
+    result = app(wsgi_environ(scope, body), start_response)
+    try:
+        content = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return Response(started["status"], content, dict(started["headers"]))
+
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return bytes(body)
+
+
+async def acquire_spend_lock(lock: ProcessLock, deadline: Deadline):
+    """
+    Wait for `lock` within the request's time budget, without holding a thread. The lock
+    is polled: a cancelled wait never leaves it acquired by nobody.
+    """
+    delay = 0.0005
+    while not lock.try_acquire():
+        if deadline.remaining() <= 0:
+            raise DeadlineExceededError("waiting for the spend lock", deadline.budget)
+        await asyncio.sleep(min(delay, deadline.remaining()))
+        delay = min(delay * 2, 0.005)
+
+
+class ResignerASGI:
+    """The ASGI app, see the module's documentation"""
+    def __init__(
+        self,
+        config: Configuration,
+        policy_handler: PolicyHandler,
+        rpc: AsyncBitcoindRPC,
+        db: AsyncDB,
+        wsgi_app=None
+    ):
+        self.config = config
+        self.policy_handler = policy_handler
+        self.rpc = rpc
+        self.db = db
+        self.wsgi_app = wsgi_app
+        self.logger = config.get("logger")
+        # The tenants' clients, made on their first request
+        self.tenant_rpcs: Dict[str, AsyncBitcoindRPC] = {}
+
+    async def __call__(self, scope: Dict, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = await read_body(receive)
+        if scope["path"] == PROCESS_PSBT:
+            response = await self.process_psbt_request(scope, body)
+        elif self.wsgi_app is not None:
+            response = await asyncio.get_running_loop().run_in_executor(None, call_wsgi, self.wsgi_app, scope, body)
+        else:
+            response = Response.json(404, error_code=404, message="No such endpoint")
+
+        headers: List[Tuple[bytes, bytes]] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()
+        ]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": response.body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.rpc.aclose()
+                self.db.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def process_psbt_request(self, scope: Dict, body: bytes) -> Response:
+        """`/process-psbt`, traced and measured like the Flask app's requests"""
+        start = time.perf_counter()
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        request_id = headers.get("x-request-id", "").lower()
+        root = TRACER.start(
+            "ProcessPsbt", request_id if valid_request_id(request_id) else None,
+            **{"http.method": scope["method"], "http.route": PROCESS_PSBT}
+        )
+
+        rejected_by = ""
+        try:
+            if scope["method"] != "POST":
+                response = Response.json(405, error_code=405, message="Only the POST Method is allowed")
+            else:
+                response = await self.process_psbt(body)
+        except Exception as e:
+            if isinstance(e, PolicyException):
+                rejected_by = e.policy
+            response = error_response(e, self.logger)
+
+        status = str(response.status_code)
+        HTTP_REQUESTS.inc(endpoint=PROCESS_PSBT, status=status, policy=rejected_by)
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=PROCESS_PSBT, status=status)
+        if root is not None:
+            annotate_request_trace(root, response)
+            TRACER.finish(root)
+        return response
+
+    async def process_psbt(self, body: bytes) -> Response:
+        request_timestamp = math.floor(time.time() * 1000000)
+        try:
+            args = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return Response.json(400, error_code=400, message="The request body must be JSON")
+        if not isinstance(args, dict) or not args.get("psbt"):
+            return Response.json(400, error_code=400, message="psbt not supplied in request")
+        # Validated here: `request_deadline` aborts the way only the Flask app answers
+        if not valid_timeout(args.get("timeout")):
+            return Response.json(400, error_code=400, message=INVALID_TIMEOUT)
+
+        # Parsing the psbt would hold up the event loop
+        tenant = None
+        if routing_enabled():
+            tenant = await asyncio.get_running_loop().run_in_executor(None, route_psbt, args["psbt"])
+        with routed_wallet(tenant, self.config, self.policy_handler) as (config, policy_handler, lock):
+            return await self.process_wallet_psbt(
+                args, config, policy_handler, self.wallet_rpc(tenant), lock, request_timestamp
+            )
+
+    def wallet_rpc(self, tenant: Optional[Tenant]) -> AsyncBitcoindRPC:
+        """The client of the wallet `route_psbt` returned, sharing the default one's connections"""
+        if tenant is None:
+            return self.rpc
+        if tenant.name not in self.tenant_rpcs:
+            self.tenant_rpcs[tenant.name] = self.rpc.for_wallet(tenant.config.get("bitcoind")["client"])
+        return self.tenant_rpcs[tenant.name]
+
+    async def process_wallet_psbt(
+        self,
+        args: Dict,
+        config: Configuration,
+        policy_handler: PolicyHandler,
+        rpc: AsyncBitcoindRPC,
+        lock: ProcessLock,
+        request_timestamp: int
+    ) -> Response:
+        """`process_psbt` for the default wallet or a tenant's, whose database is in use"""
+        deadline = request_deadline(args, config)
+        with deadline:
+            with span("psbt_lookups"):
+                lookups = await self.psbt_lookups(args["psbt"], deadline, rpc)
+
+        # A spend is analysed and checked against the limits only once the previous one is recorded
+        await acquire_spend_lock(lock, deadline)
+        try:
+            with span("analyse_psbt"):
+                psbt_obj = await self.db.run(
+                    analyse_psbt_lookups, args["psbt"], lookups, owned_only=routing_enabled()
+                )
+            result = await self.sign(args["psbt"], psbt_obj, deadline, rpc, policy_handler)
+            with span("persist"):
+                await self.db.run(record_signed_spend, psbt_obj, result["psbt"], request_timestamp, self.logger)
+        finally:
+            lock.release()
+
+        return Response.json(200, psbt=result["psbt"], signed=True)
+
+    async def sign(
+        self,
+        psbt: str,
+        psbt_obj: ResignerPsbt,
+        deadline: Deadline,
+        rpc: AsyncBitcoindRPC,
+        policy_handler: PolicyHandler
+    ) -> Dict:
+        with deadline:
+            with span("policies"):
+                await self.db.run(policy_handler.run, {"psbt": psbt_obj}, deadline=deadline)
+
+            self.logger.info("Signing PSBT: %s", psbt_summary(psbt), extra=PSBT_LOG)
+            with span("sign_transaction"):
+                deadline.check("signing")
+                try:
+                    result = await rpc.walletprocesspsbt(psbt)
+                except BitcoindRPCError as e:
+                    raise ServerError(e)
+
+        # The psbt is signed at this point, the spend has to be recorded whatever the time left.
+        if result["complete"] is not True:
+            self.logger.info("Signed PSBT: %s not complete", psbt_summary(result["psbt"]), extra=PSBT_LOG)
+        return result
+
+    async def psbt_lookups(self, psbt: str, deadline: Deadline, rpc: AsyncBitcoindRPC) -> PsbtLookups:
+        """`psbt_lookups`, with the rpcs of the inputs and of the outputs sent as two concurrent batches"""
+        deadline.check("psbt analysis")
+        decoded_psbt = await rpc.decodepsbt(psbt)
+        vin, vout = decoded_psbt["tx"]["vin"], decoded_psbt["tx"]["vout"]
+        txouts, addr_infos = await asyncio.gather(
+            rpc.batch_call("gettxout", [[utxo["txid"], utxo["vout"], True] for utxo in vin]),
+            rpc.batch_call("getaddressinfo", [[output["scriptPubKey"]["address"]] for output in vout])
+        )
+        return decoded_psbt, txouts, addr_infos
+
+
+def create_asgi_app(config: Configuration, policy_handler: PolicyHandler, transport=None) -> ResignerASGI:
+    """
+    The ASGI app of a started resigner. `transport` is an `httpx.AsyncBaseTransport` the
+    rpcs are sent through instead of the network.
+    """
+    rpc = AsyncBitcoindRPC(config.get("bitcoind")["client"], transport)
+    return ResignerASGI(
+        config, policy_handler, rpc, AsyncDB(), create_app(config, policy_handler, debug=False)
+    )
+
+
+def asgi_app_from_env() -> ResignerASGI:
+    """Factory for ASGI servers: starts resigner with the configuration at RESIGNER_CONFIG_PATH"""
+    config, policy_handler = start_resigner(os.getenv("RESIGNER_CONFIG_PATH"))
+    return create_asgi_app(config, policy_handler)
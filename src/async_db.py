@@ -0,0 +1,26 @@
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class AsyncDB:
+    """
+    Runs database work off the event loop, on a single thread: SQLite is used through one
+    connection, statements are executed one at a time whichever the thread.
+
+    The work runs in the context of the awaiting coroutine, so its statements are traced
+    as part of the request and see the request's deadline.
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="resigner-db")
+
+    async def run(self, function: Callable, *args, **kwargs) -> Any:
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(context.run, function, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
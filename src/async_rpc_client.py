@@ -0,0 +1,201 @@
+import time
+import asyncio
+import contextlib
+from typing import Dict, List, Optional
+
+import httpx
+import orjson
+
+from .bitcoind_rpc_client import BitcoindRPC, IDEMPOTENT_METHODS, retryable
+from .deadline import current_deadline
+from .errors import DeadlineExceededError
+from .rpc_backend import RPCBackend, HedgedRequest
+from .tracing import span, KIND_CLIENT
+
+
+class AsyncBitcoindRPC:
+    """
+    Asyncio counterpart of `BitcoindRPC`, for the ASGI app: an rpc waiting on bitcoind
+    holds a coroutine rather than a thread.
+
+    It shares the nodes, their health and latency, the rpc cache and the recorder of the
+    `BitcoindRPC` it is made from, and behaves the same: failover on transport errors,
+    hedging of idempotent rpcs across nodes and timeouts bound by the request's deadline.
+
+    At most `max_concurrent_rpcs` (an option of `rpc`) rpcs are in flight at once, across
+    the requests being served, so that bitcoind's work queue isn't overflowed: the others
+    wait for their turn within their request's deadline.
+
+    `transport` is an `httpx.AsyncBaseTransport` to use instead of the network. The clients
+    of other wallets share the connection pool and the rpcs in flight of the first one,
+    given as `client` and `slots`.
+    """
+    def __init__(
+        self,
+        rpc: BitcoindRPC,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        client: Optional[httpx.AsyncClient] = None,
+        slots: Optional[asyncio.Semaphore] = None
+    ):
+        self.rpc = rpc
+        self.slots = slots or asyncio.Semaphore(rpc.max_concurrent_rpcs)
+        # Closed by the client that made it
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(
+            auth=rpc.auth,
+            headers=rpc.client.headers,
+            timeout=rpc.client.timeout,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+            transport=transport
+        )
+
+    def for_wallet(self, rpc: BitcoindRPC) -> "AsyncBitcoindRPC":
+        """The client of the wallet of `rpc`, made with `BitcoindRPC.for_wallet`, sharing this one's pool"""
+        return AsyncBitcoindRPC(rpc, client=self.client, slots=self.slots)
+
+    async def aclose(self):
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def _request(self, backend: RPCBackend, payload: bytes, **kwargs) -> Dict:
+        start = time.monotonic()
+        try:
+            response = await self.client.post(url=backend.url, content=payload, auth=self.rpc.auth, **kwargs)
+            response_content = orjson.loads(response.content)
+        except (httpx.TransportError, orjson.JSONDecodeError):
+            backend.record_failure()
+            raise
+
+        backend.record_success(time.monotonic() - start)
+        return response_content
+
+    async def _post(self, payload: bytes, idempotent: bool, **kwargs) -> Dict:
+        """Send the request to the healthiest node, failing over on transport errors."""
+        error = None
+        for backend in self.rpc.candidates():
+            try:
+                return await self._request(backend, payload, **kwargs)
+            except (httpx.TransportError, orjson.JSONDecodeError) as e:
+                if not retryable(e, idempotent):
+                    raise
+                error = e
+        raise error
+
+    async def _hedged_post(self, payload: bytes, **kwargs) -> Dict:
+        """
+        Send the request to the healthiest node, and to the next one as well if the
+        first hasn't answered after its p95 latency. The first successful answer wins.
+        """
+        hedge = HedgedRequest(self.rpc.candidates(), self.rpc.hedge_min_delay)
+        pending = {asyncio.ensure_future(self._request(hedge.first, payload, **kwargs))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=hedge.timeout, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    hedge.error = future.exception()
+
+                backend = hedge.next_backend(failed=len(done), pending=len(pending))
+                if backend is not None:
+                    pending.add(asyncio.ensure_future(self._request(backend, payload, **kwargs)))
+            raise hedge.error
+        finally:
+            # The slower requests aren't waited for
+            for future in pending:
+                future.cancel()
+
+    async def call(self, method: str, params, **kwargs):
+        """
+        Initiate JSONRPC call, answered from the cache when the method allows it.
+        """
+        with span(f"rpc {method}", KIND_CLIENT, **{"rpc.method": method}) as rpc_span:
+            steps = self.rpc.cached_call_steps(rpc_span, method, params)
+            try:
+                request = next(steps)
+                while True:
+                    try:
+                        result = await self._call(*request, **kwargs)
+                    except Exception as e:
+                        request = steps.throw(e)
+                    else:
+                        request = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+    @contextlib.asynccontextmanager
+    async def slot(self, method: str):
+        """One of the rpcs in flight, waited for within the request's deadline"""
+        if self.slots.locked():
+            deadline = current_deadline()
+            try:
+                await asyncio.wait_for(self.slots.acquire(), None if deadline is None else deadline.remaining())
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError(f"rpc {method}", deadline.budget)
+        else:
+            await self.slots.acquire()
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    async def _call(self, method: str, params, **kwargs):
+        async with self.slot(method):
+            payload = self.rpc.payload(method, params)
+            deadline = self.rpc.apply_deadline(method, kwargs)
+
+            start = time.monotonic()
+            try:
+                if self.rpc.hedged(method):
+                    response_content = await self._hedged_post(payload, **kwargs)
+                else:
+                    response_content = await self._post(payload, method in IDEMPOTENT_METHODS, **kwargs)
+            except httpx.TransportError as e:
+                raise self.rpc.transport_error(method, params, start, e, deadline)
+
+        return self.rpc.result(method, params, start, response_content)
+
+    async def batch_call(self, method: str, params_list: List, **kwargs) -> List:
+        """`BitcoindRPC.batch_call`: the calls are sent as a single batch request"""
+        with span(f"rpc {method}", KIND_CLIENT, **{"rpc.method": method, "rpc.batch_size": len(params_list)}):
+            steps = self.rpc.cached_batch_steps(method, params_list)
+            try:
+                request = next(steps)
+                while True:
+                    try:
+                        results = await self._batch_call(*request, **kwargs)
+                    except Exception as e:
+                        request = steps.throw(e)
+                    else:
+                        request = steps.send(results)
+            except StopIteration as stop:
+                return stop.value
+
+    async def _batch_call(self, method: str, params_list: List, **kwargs) -> List:
+        if not params_list:
+            return []
+        async with self.slot(method):
+            payload = self.rpc.batch_payload(method, params_list)
+            deadline = self.rpc.apply_deadline(method, kwargs)
+
+            start = time.monotonic()
+            try:
+                response_content = await self._post(payload, method in IDEMPOTENT_METHODS, **kwargs)
+            except httpx.TransportError as e:
+                raise self.rpc.batch_transport_error(method, params_list, start, e, deadline)
+
+        return self.rpc.batch_results(method, params_list, start, response_content)
+
+    async def decodepsbt(self, psbt: str):
+        return await self.call("decodepsbt", [psbt])
+
+    async def gettxout(self, txid: str, n: int, include_mempool: Optional[bool] = True):
+        return await self.call("gettxout", [txid, n, include_mempool])
+
+    async def getaddressinfo(self, address: str):
+        return await self.call("getaddressinfo", [address])
+
+    async def walletprocesspsbt(
+        self, psbt: str, sign: bool = True, sighashtype: str = "ALL", bip32derivs: bool = True
+    ):
+        return await self.call("walletprocesspsbt", [psbt, sign, sighashtype, bip32derivs])
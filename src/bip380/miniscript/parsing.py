@@ -540,64 +540,63 @@ def miniscript_from_script(script, pkh_preimages={}):
     return parse_expr_list(expr_list)
 
 
-def split_params(string):
+def split_params(string, pos):
     """Read a list of values before the next ')'. Split the result by comma."""
-    i = string.find(")")
+    i = string.find(")", pos)
     assert i >= 0
 
-    params, remaining = string[:i], string[i:]
-    if len(remaining) > 0:
-        return params.split(","), remaining[1:]
-    else:
-        return params.split(","), ""
+    return string[pos:i].split(","), i + 1
 
 
-def parse_many(string):
+def parse_many(string, pos):
     """Read a list of nodes before the next ')'."""
     subs = []
-    remaining = string
     while True:
-        sub, remaining = parse_one(remaining)
+        sub, pos = parse_one(string, pos)
         subs.append(sub)
-        if remaining[0] == ")":
-            return subs, remaining[1:]
-        assert remaining[0] == ","  # TODO: real errors
-        remaining = remaining[1:]
+        if string[pos] == ")":
+            return subs, pos + 1
+        assert string[pos] == ","  # TODO: real errors
+        pos += 1
 
 
-def parse_one_num(string):
+def parse_one_num(string, pos):
     """Read an integer before the next comma."""
-    i = string.find(",")
+    i = string.find(",", pos)
     assert i >= 0
 
-    return int(string[:i]), string[i + 1 :]
+    return int(string[pos:i]), i + 1
+
 
+def parse_one(string, pos=0):
+    """Read a node and its subs recursively from a string, starting at index pos.
+    Returns the node and the index of the part of the string not consumed.
 
-def parse_one(string):
-    """Read a node and its subs recursively from a string.
-    Returns the node and the part of the string not consumed.
+    The string is never sliced past pos: copying what remains of it at each node makes
+    the parsing of deeply nested or wide fragments quadratic.
     """
 
     # We special case fragments.Just1 and fragments.Just0 since they are the only one which don't
     # have a function syntax.
-    if string[0] == "0":
-        return fragments.Just0(), string[1:]
-    if string[0] == "1":
-        return fragments.Just1(), string[1:]
+    if string[pos] == "0":
+        return fragments.Just0(), pos + 1
+    if string[pos] == "1":
+        return fragments.Just1(), pos + 1
 
     # Now, find the separator for all functions.
-    for i, char in enumerate(string):
+    for i in range(pos, len(string)):
+        char = string[i]
         if char in ["(", ":"]:
             break
     # For wrappers, we may have many of them.
-    if char == ":" and i > 1:
-        tag, remaining = string[0], string[1:]
+    if char == ":" and i > pos + 1:
+        tag, remaining = string[pos], pos + 1
     else:
-        tag, remaining = string[:i], string[i + 1 :]
+        tag, remaining = string[pos:i], i + 1
 
     # fragments.Wrappers
     if char == ":":
-        sub, remaining = parse_one(remaining)
+        sub, remaining = parse_one(string, remaining)
         if tag == "a":
             return fragments.WrapA(sub), remaining
 
@@ -644,7 +643,7 @@ def parse_one(string):
         "after",
         "multi",
     ]:
-        params, remaining = split_params(remaining)
+        params, remaining = split_params(string, remaining)
 
         if tag == "0":
             return fragments.Just0(), remaining
@@ -695,9 +694,9 @@ def parse_one(string):
     # Non-terminal elements (connectives)
     # We special case fragments.Thresh, as its first sub is an integer.
     if tag == "thresh":
-        k, remaining = parse_one_num(remaining)
+        k, remaining = parse_one_num(string, remaining)
     # TODO: real errors in place of unpacking
-    subs, remaining = parse_many(remaining)
+    subs, remaining = parse_many(string, remaining)
 
     if tag == "and_v":
         return fragments.AndV(*subs), remaining
@@ -732,5 +731,5 @@ def parse_one(string):
 def miniscript_from_str(ms_str):
     """Construct miniscript node from string representation"""
     node, remaining = parse_one(ms_str)
-    assert remaining == ""
+    assert remaining == len(ms_str)
     return node
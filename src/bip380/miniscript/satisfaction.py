@@ -174,14 +174,17 @@ class Satisfaction:
         arbitrage = sorted(arbitrage, key=lambda x: x[:2])
         optimal_sat = undissatisfiable + [a[2] for a in arbitrage] + unsatisfiable
         to_satisfy = set(optimal_sat[:k])
-        return sum(
-            [
-                sub.satisfaction(sat_material)
-                if sub in to_satisfy
-                else sub.dissatisfaction()
-                for sub in subs[::-1]
-            ],
-            start=Satisfaction(witness=[]),
+        sats = [
+            sub.satisfaction(sat_material)
+            if sub in to_satisfy
+            else sub.dissatisfaction()
+            for sub in subs[::-1]
+        ]
+        # Concatenate the witnesses at once: summing the satisfactions would copy the
+        # witness built so far for every sub.
+        return Satisfaction(
+            witness=[elem for sat in sats for elem in sat.witness],
+            has_sig=any(sat.has_sig for sat in sats),
         )
 
 
@@ -1,9 +1,76 @@
+import copy
 import time
-from typing import Any, List, Optional, Union, Literal, Dict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Generator, Iterator, List, Optional, Set, Tuple, Union, Literal, Dict
+from urllib.parse import urlsplit
 
-import httpx
 import orjson
 
+from .deadline import Deadline, current_deadline
+from .errors import DeadlineExceededError
+from .json_stream import JSONArrayStream
+from .metrics import RPC_DURATION
+from .tracing import span, KIND_CLIENT
+from .rpc_backend import RPCBackend, HedgedRequest
+from .rpc_cache import RPCCache
+from .lazy import lazy_import
+
+# Loaded on the first client created, importing the module stays cheap
+httpx = lazy_import("httpx")
+
+# Read-only RPCs that may safely be retried on, or raced against, another node.
+IDEMPOTENT_METHODS = frozenset({
+    "getblockchaininfo",
+    "getbestblockhash",
+    "getblockhash",
+    "getblockcount",
+    "getblockheader",
+    "getblockstats",
+    "getblock",
+    "gettxout",
+    "getrawtransaction",
+    "gettransaction",
+    "getaddressinfo",
+    "getbalance",
+    "getwalletinfo",
+    "listunspent",
+    "listsinceblock",
+    "listwallets",
+    "listwalletdir",
+    "listdescriptors",
+    "listreceivedbyaddress",
+    "decodepsbt",
+    "analyzepsbt",
+})
+
+# RPCs whose result holds until the chain tip changes, with the condition a call (its params
+# and result) has to meet to be cached. A mempool transaction can spend an output without
+# the tip changing: `gettxout` is only cached when it ignores the mempool
+# (`include_mempool` false), for a confirmed output.
+CACHEABLE_METHODS = {
+    "getblockcount": lambda params, result: True,
+    "getblockhash": lambda params, result: True,
+    "getblockheader": lambda params, result: True,
+    "getaddressinfo": lambda params, result: True,
+    "gettxout": lambda params, result: (
+        len(params) > 2 and params[2] is False and result is not None and result["confirmations"] > 0
+    ),
+}
+
+# RPCs that change what the wallet considers its own, invalidating cached address info
+WALLET_IMPORT_METHODS = frozenset({
+    "importaddress",
+    "importdescriptors",
+    "importmulti",
+})
+
+
+def retryable(error: Exception, idempotent: bool) -> bool:
+    """Whether a request that failed with a transport `error` may be sent to the next node"""
+    # A request that never reached the node is always safe to send again
+    return idempotent or isinstance(error, httpx.ConnectError)
+
 
 class BitcoindRPCError(Exception):
     def __init__(self, code, message):
@@ -11,51 +78,493 @@ class BitcoindRPCError(Exception):
         self.message = message
 
 
+def node_origins(backends: List[RPCBackend]) -> Set[Tuple[str, str]]:
+    """The nodes `backends` are on: their urls without the wallet path"""
+    return {tuple(urlsplit(backend.url)[:2]) for backend in backends}
+
+
+class HedgePool:
+    """
+    The threads sending hedged requests, shared by a client and the clients of the other
+    wallets made from it (`for_wallet`). A request never waits for one of them: a thread is
+    only used if one is free, see `BitcoindRPC._hedged_post`.
+    """
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.after_fork()
+
+    def after_fork(self):
+        """In a forked process: the threads of the parent's pool didn't survive the fork"""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bitcoind-rpc")
+        # Threads of the pool not running a request
+        self.slots = threading.BoundedSemaphore(self.max_workers)
+
+    def try_acquire(self) -> bool:
+        """Claim a free thread of the pool, False if they are all busy"""
+        return self.slots.acquire(blocking=False)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Run `fn` on the thread claimed with `try_acquire`, released once it returns"""
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def release(self):
+        """Give back a thread claimed but not used"""
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
 class BitcoindRPC:
     """
     Bitcoin RPC client.
 
     We intend to support only the RPC's we need for this project
     <https://developer.bitcoin.org/reference/rpc/index.html>
+
+    `url` may be a list of urls of equivalent nodes. Requests go to the healthiest node
+    and fail over to the next one on transport errors. Idempotent calls are hedged:
+    if the first node hasn't answered after its p95 latency, the request is also sent
+    to the next node and the first answer wins.
+
+    Options:
+        timeout: read timeout in seconds (default 100)
+        hedge_min_delay: lower bound of the hedging delay in seconds (default 0.05)
+        hedge_max_workers: threads sending hedged requests, when all are busy requests are
+            sent without hedging rather than queued (default 16)
+        circuit_failure_threshold: consecutive failures before a node is skipped (default 3)
+        circuit_reset_timeout: seconds before a skipped node is probed again (default 30)
+        cache_size: max number of cached rpc results, 0 disables the cache (default 4096)
+        cache_tip_check_interval: seconds between two checks of the chain tip (default 5)
+        max_concurrent_rpcs: rpcs the ASGI app's clients send at once, the others wait
+            for their turn (default 8)
+        record_path: append every rpc, its answer and latency to this file
+        replay_path: answer rpcs from a file written with `record_path` instead of a node
+        replay_latency_scale: factor applied to the replayed latencies (default 1, 0 for none)
+        transport: `httpx.BaseTransport` to use instead of the network
     """
-    def __init__(self, url: str, rpc_user: str, rpc_password: str, **options: Dict):
-        self._url = url
+    def __init__(self, url: Union[str, List[str]], rpc_user: str, rpc_password: str, **options: Dict):
+        self._backend_options = {
+            "failure_threshold": int(options.get("circuit_failure_threshold", 3)),
+            "reset_timeout": float(options.get("circuit_reset_timeout", 30.0)),
+        }
+        urls = [url] if isinstance(url, str) else list(url)
+        self._backends = [RPCBackend(u, **self._backend_options) for u in urls]
+
+        self.hedge_min_delay = float(options.get("hedge_min_delay", 0.05))
+        self._hedge_pool = HedgePool(int(options.get("hedge_max_workers", 16)))
+
+        self._cache_options = (
+            int(options.get("cache_size", 4096)), float(options.get("cache_tip_check_interval", 5.0))
+        )
+        self.cache = RPCCache(*self._cache_options) if self._cache_options[0] else None
+        # See `AsyncBitcoindRPC`
+        self.max_concurrent_rpcs = int(options.get("max_concurrent_rpcs", 8))
 
-        # Configure `httpx.AsyncClient`.
-        auth = (rpc_user, rpc_password)
+        # Configure `httpx.Client`, sent with the credentials of each client using it
+        self.auth = (rpc_user, rpc_password)
         headers = {"content-type": "application/json"}
-        timeout = httpx.Timeout(10.0, read=100)
+        self._read_timeout = float(options.get("timeout", 100))
+        timeout = httpx.Timeout(10.0, read=self._read_timeout)
         limits = httpx.Limits(max_keepalive_connections=0, max_connections=None, keepalive_expiry=0)
-        self.client = httpx.Client(auth=auth, headers=headers, timeout=timeout, limits=limits)
+        transport = options.get("transport")
+        if "replay_path" in options:
+            from .rpc_recorder import ReplayTransport
+            transport = ReplayTransport(options["replay_path"], float(options.get("replay_latency_scale", 1.0)))
+        self.client = httpx.Client(
+            auth=self.auth, headers=headers, timeout=timeout, limits=limits, transport=transport
+        )
 
+        self.recorder = None
+        if "record_path" in options:
+            from .rpc_recorder import RPCRecorder
+            self.recorder = RPCRecorder(options["record_path"])
+
+    @property
+    def _url(self) -> str:
+        return self._backends[0].url
+
+    @_url.setter
+    def _url(self, url: str):
+        # Point the client at a single endpoint, e.g. a wallet path on the same node.
+        self._backends = [RPCBackend(url, **self._backend_options)]
+
+    @property
+    def backends(self) -> List[RPCBackend]:
+        return list(self._backends)
+
+    def for_wallet(self, url: Union[str, List[str]], rpc_user: str, rpc_password: str) -> "BitcoindRPC":
+        """
+        A client of another wallet, with the options of this one. It shares this client's
+        connection pool, hedging threads and recorder, and its cache when the wallet is on the
+        same nodes (the cache follows their chain tip); the health of the nodes is its own.
+        """
+        client = copy.copy(self)
+        client._backends = [RPCBackend(u, **self._backend_options) for u in ([url] if isinstance(url, str) else url)]
+        client.auth = (rpc_user, rpc_password)
+        if self.cache is not None and node_origins(client._backends) != node_origins(self._backends):
+            client.cache = RPCCache(*self._cache_options)
+        return client
+
+    def after_fork(self):
+        """In a forked process, see `HedgePool.after_fork`"""
+        self._hedge_pool.after_fork()
 
     def _exit_(self):
+        self._hedge_pool.shutdown()
         self.client.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def candidates(self) -> Iterator[RPCBackend]:
+        """
+        Yield the backends whose circuit lets a request through, healthiest first.
+
+        Lazy, so that a half-open backend is only claimed for a probe when it is used.
+        """
+        yielded = False
+        for backend in sorted(self._backends, key=lambda b: b.score):
+            if backend.acquire():
+                yielded = True
+                yield backend
+
+        if not yielded:
+            # Every circuit is open: rather than failing without trying, use the node
+            # that is closest to being probed again.
+            yield min(self._backends, key=lambda b: b.retry_in())
+
+    def _request(self, backend: RPCBackend, payload: bytes, **kwargs) -> Dict:
+        start = time.monotonic()
+        try:
+            response = self.client.post(url=backend.url, content=payload, auth=self.auth, **kwargs)
+            response_content = orjson.loads(response.content)
+        except (httpx.TransportError, orjson.JSONDecodeError):
+            backend.record_failure()
+            raise
+
+        backend.record_success(time.monotonic() - start)
+        return response_content
+
+    def _post(self, payload: bytes, idempotent: bool, **kwargs) -> Dict:
+        """Send the request to the healthiest node, failing over on transport errors."""
+        return self._failover(self.candidates(), payload, idempotent, **kwargs)
+
+    def _failover(
+        self, backends: Iterator[RPCBackend], payload: bytes, idempotent: bool, error=None, **kwargs
+    ) -> Dict:
+        for backend in backends:
+            try:
+                return self._request(backend, payload, **kwargs)
+            except (httpx.TransportError, orjson.JSONDecodeError) as e:
+                if not retryable(e, idempotent):
+                    raise
+                error = e
+        raise error
+
+    def _hedged_post(self, payload: bytes, **kwargs) -> Dict:
+        """
+        Send the request to the healthiest node, and to the next one as well if the
+        first hasn't answered after its p95 latency. The first successful answer wins.
+
+        Requests are never queued behind the pool: when all its threads are busy, the
+        request is sent from the calling thread and fails over without hedging, so the
+        pool bounds the number of hedges in flight but not the number of requests.
+        """
+        pool = self._hedge_pool
+        if not pool.try_acquire():
+            return self._post(payload, True, **kwargs)
+
+        hedge = HedgedRequest(self.candidates(), self.hedge_min_delay)
+        pending = {pool.submit(self._request, hedge.first, payload, **kwargs)}
+        while pending:
+            done, pending = wait(pending, timeout=hedge.timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                hedge.error = future.exception()
+
+            if not pool.try_acquire():
+                if pending:
+                    # No thread for a hedge, keep waiting for the requests in flight
+                    continue
+                return self._failover(hedge.candidates, payload, True, hedge.error, **kwargs)
+
+            backend = hedge.next_backend(failed=len(done), pending=len(pending))
+            if backend is None:
+                pool.release()
+            else:
+                pending.add(pool.submit(self._request, backend, payload, **kwargs))
+        raise hedge.error
+
+    def cache_stats(self) -> Dict[str, int]:
+        return self.cache.stats() if self.cache is not None else {}
 
     def call(self, method: str, params, **kwargs):
         """
-        Initiate JSONRPC call.
+        Initiate JSONRPC call, answered from the cache when the method allows it.
         """
-        response = self.client.post(
-            url=self._url,
-            content=orjson.dumps(
-                {
-                    "jsonrpc": "2.0",
-                    "id": int(time.time()),  # Todo: verify id to match the response with the request
-                    "method": method,
-                    "params": params,
-                }
-            ),
-            **kwargs,
+        with span(f"rpc {method}", KIND_CLIENT, **{"rpc.method": method}) as rpc_span:
+            steps = self.cached_call_steps(rpc_span, method, params)
+            try:
+                request = next(steps)
+                while True:
+                    try:
+                        result = self._call(*request, **kwargs)
+                    except Exception as e:
+                        request = steps.throw(e)
+                    else:
+                        request = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+    def cached_call_steps(self, rpc_span, method: str, params) -> Generator:
+        """
+        What `call` does around the cache, shared with `AsyncBitcoindRPC`: a generator
+        yielding the rpcs to send, as `(method, params)`, to be sent their results or thrown
+        their errors. Its return value is the result of the call.
+        """
+        if self.cache is None or method not in CACHEABLE_METHODS:
+            result = yield method, params
+            if self.cache is not None and method in WALLET_IMPORT_METHODS:
+                self.cache.clear()
+            return result
+
+        if self.cache.claim_tip_check():
+            try:
+                tip = yield "getbestblockhash", []
+            except Exception:
+                self.cache.tip_check_failed()
+                raise
+            self.cache.set_tip(tip)
+
+        key = (self._url, method, orjson.dumps(params))
+        found, result = self.cache.get(key)
+        rpc_span.set_attribute("rpc.cache_hit", found)
+        if found:
+            return result
+
+        result = yield method, params
+        if CACHEABLE_METHODS[method](params, result):
+            self.cache.put(key, result)
+        return result
+
+    def payload(self, method: str, params) -> bytes:
+        return orjson.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": int(time.time()),  # Todo: verify id to match the response with the request
+                "method": method,
+                "params": params,
+            }
         )
-        response_content = orjson.loads(response.content or response._content)
 
-        # close the connection pool
-        #self._exit_()
+    def apply_deadline(self, method: str, kwargs: Dict) -> Optional[Deadline]:
+        """Within a request, the rpc may only use what is left of the request's time budget"""
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check(f"rpc {method}")
+            kwargs["timeout"] = httpx.Timeout(min(deadline.remaining(), self._read_timeout))
+        return deadline
+
+    def _call(self, method: str, params, **kwargs):
+        """
+        Initiate JSONRPC call.
+        """
+        payload = self.payload(method, params)
+        deadline = self.apply_deadline(method, kwargs)
+
+        start = time.monotonic()
+        try:
+            if self.hedged(method):
+                response_content = self._hedged_post(payload, **kwargs)
+            else:
+                response_content = self._post(payload, method in IDEMPOTENT_METHODS, **kwargs)
+        except httpx.TransportError as e:
+            raise self.transport_error(method, params, start, e, deadline)
+
+        return self.result(method, params, start, response_content)
+
+    def hedged(self, method: str) -> bool:
+        """Whether the rpc is raced against several nodes"""
+        return method in IDEMPOTENT_METHODS and len(self._backends) > 1
+
+    def transport_error(
+        self, method: str, params, start: float, error: Exception, deadline: Optional[Deadline]
+    ) -> Exception:
+        """Record an rpc that failed with a transport `error`, returning the error to raise"""
+        self.record(method, params, start, exception=error)
+        if isinstance(error, httpx.TimeoutException) and deadline is not None and deadline.expired:
+            deadline_error = DeadlineExceededError(f"rpc {method}", deadline.budget)
+            deadline_error.__cause__ = error
+            return deadline_error
+        return error
+
+    def result(self, method: str, params, start: float, response_content: Dict):
+        """Record an answered rpc, returning its result or raising its error"""
+        self.record(method, params, start, response_content)
         if response_content["error"] is not None:
             raise BitcoindRPCError(response_content["error"]["code"], response_content["error"]["message"])
+        return response_content["result"]
+
+    def record(self, method: str, params, start: float, response: Optional[Dict] = None, exception=None):
+        latency = time.monotonic() - start
+        if exception is not None:
+            outcome = "transport_error"
         else:
-            return response_content["result"]
+            outcome = "ok" if response["error"] is None else "error"
+        RPC_DURATION.observe(latency, method=method, outcome=outcome)
+
+        if self.recorder is not None:
+            self.recorder.record(self._url, method, params, latency, response, exception)
+
+    def _stream(self, backend: RPCBackend, payload: bytes, chunk_size: int, sink: Optional[List], **kwargs):
+        start = time.monotonic()
+        parser = JSONArrayStream()
+        chunk = []
+        try:
+            with self.client.stream("POST", backend.url, content=payload, auth=self.auth, **kwargs) as response:
+                for data in response.iter_bytes():
+                    items = parser.feed(data)
+                    chunk.extend(items)
+                    if sink is not None:
+                        sink.extend(items)
+                    while len(chunk) >= chunk_size:
+                        yield chunk[:chunk_size]
+                        del chunk[:chunk_size]
+            response_content = parser.close()
+        except (httpx.TransportError, orjson.JSONDecodeError):
+            backend.record_failure()
+            raise
+
+        backend.record_success(time.monotonic() - start)
+        if chunk:
+            yield chunk
+        return response_content
+
+    def _stream_with_failover(self, payload: bytes, chunk_size: int, sink: Optional[List], **kwargs):
+        error = None
+        for backend in self.candidates():
+            try:
+                response_content = yield from self._stream(backend, payload, chunk_size, sink, **kwargs)
+                return response_content
+            except httpx.ConnectError as e:
+                # Nothing was received from this node, try the next one
+                error = e
+        raise error
+
+    def stream_call(self, method: str, params, chunk_size: int = 1000, **kwargs) -> Iterator[List]:
+        """
+        Initiate JSONRPC call returning a list, and yield the list in chunks of at most
+        `chunk_size` elements as the response is received, instead of loading it whole.
+        """
+        payload = self.payload(method, params)
+        deadline = self.apply_deadline(method, kwargs)
+
+        # The whole result is only kept when it has to be recorded
+        recorded = [] if self.recorder is not None else None
+        start = time.monotonic()
+        try:
+            response_content = yield from self._stream_with_failover(payload, chunk_size, recorded, **kwargs)
+        except httpx.TransportError as e:
+            raise self.transport_error(method, params, start, e, deadline)
+
+        self.result(method, params, start, {**response_content, "result": recorded})
+
+    def batch_call(self, method: str, params_list: List, **kwargs) -> List:
+        """
+        Initiate a JSONRPC call of `method` with each params of `params_list`, sent as a single
+        batch request. The error of a call is returned in place of its result, as a `BitcoindRPCError`.
+        """
+        with span(f"rpc {method}", KIND_CLIENT, **{"rpc.method": method, "rpc.batch_size": len(params_list)}):
+            steps = self.cached_batch_steps(method, params_list)
+            try:
+                request = next(steps)
+                while True:
+                    try:
+                        results = self._batch_call(*request, **kwargs)
+                    except Exception as e:
+                        request = steps.throw(e)
+                    else:
+                        request = steps.send(results)
+            except StopIteration as stop:
+                return stop.value
+
+    def cached_batch_steps(self, method: str, params_list: List) -> Generator:
+        """
+        What `batch_call` does around the cache, shared with `AsyncBitcoindRPC`: see
+        `cached_call_steps`, the rpcs yielded are batches, as `(method, params_list)`.
+        """
+        if self.cache is None or method not in CACHEABLE_METHODS:
+            return (yield method, params_list)
+
+        if self.cache.claim_tip_check():
+            yield from self._batch_tip_check()
+
+        keys = [(self._url, method, orjson.dumps(params)) for params in params_list]
+        cached = [self.cache.get(key) for key in keys]
+        missing = [i for i, (found, _) in enumerate(cached) if not found]
+
+        results = [result for _, result in cached]
+        if missing:
+            for i, result in zip(missing, (yield method, [params_list[i] for i in missing])):
+                results[i] = result
+                if not isinstance(result, BitcoindRPCError) and CACHEABLE_METHODS[method](params_list[i], result):
+                    self.cache.put(keys[i], result)
+        return results
+
+    def _batch_tip_check(self) -> Generator:
+        try:
+            [tip] = yield "getbestblockhash", [[]]
+            if isinstance(tip, BitcoindRPCError):
+                raise tip
+        except Exception:
+            self.cache.tip_check_failed()
+            raise
+        self.cache.set_tip(tip)
+
+    def _batch_call(self, method: str, params_list: List, **kwargs) -> List:
+        if not params_list:
+            return []
+        payload = self.batch_payload(method, params_list)
+        deadline = self.apply_deadline(method, kwargs)
+
+        start = time.monotonic()
+        try:
+            response_content = self._post(payload, method in IDEMPOTENT_METHODS, **kwargs)
+        except httpx.TransportError as e:
+            raise self.batch_transport_error(method, params_list, start, e, deadline)
+        return self.batch_results(method, params_list, start, response_content)
+
+    def batch_payload(self, method: str, params_list: List) -> bytes:
+        return orjson.dumps([
+            {"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, params in enumerate(params_list)
+        ])
+
+    def batch_transport_error(
+        self, method: str, params_list: List, start: float, error: Exception, deadline: Optional[Deadline]
+    ) -> Exception:
+        """`transport_error` of a batch: each of its calls is recorded as failed"""
+        for params in params_list[1:]:
+            self.record(method, params, start, exception=error)
+        return self.transport_error(method, params_list[0], start, error, deadline)
+
+    def batch_results(self, method: str, params_list: List, start: float, response_content) -> List:
+        """Record an answered batch, returning the result or error of each of its calls"""
+        if isinstance(response_content, dict):
+            # The batch itself was rejected
+            raise BitcoindRPCError(response_content["error"]["code"], response_content["error"]["message"])
+
+        results = []
+        for params, response in zip(params_list, sorted(response_content, key=lambda response: response["id"])):
+            self.record(method, params, start, response)
+            error = response["error"]
+            if error is not None:
+                results.append(BitcoindRPCError(error["code"], error["message"]))
+            else:
+                results.append(response["result"])
+        return results
 
     def stop(self):
         return self.call("stop", [])
@@ -116,6 +625,24 @@ class BitcoindRPC:
             [minconf, maxconf, addresses, query_options]
         )
 
+    def listunspent_chunks(
+        self,
+        minconf: Optional[int] = 1,
+        maxconf: Optional[int] = 9999999,
+        addresses: Optional[List] = None,
+        query_options: Optional[Dict] = None,
+        chunk_size: int = 1000
+    ) -> Iterator[List]:
+        """
+        Same as `listunspent`, but the utxos are parsed while the response is received
+        and yielded in chunks of at most `chunk_size`.
+        """
+        return self.stream_call(
+            "listunspent",
+            [minconf, maxconf, addresses, query_options],
+            chunk_size
+        )
+
     def scanblocks(
         self,
         action: Literal["start", "stop", "status"],
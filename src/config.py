@@ -1,5 +1,6 @@
 import os
 import sys
+import copy
 import time
 from typing import Union, Dict
 
@@ -48,6 +49,9 @@ class Configuration:
             else:
                 self.set({"min_conf": 3}, "resigner_config")
 
+            if "request_timeout" not in self.config["resigner_config"]:
+                self.set({"request_timeout": 30}, "resigner_config")
+
  
     def get(self, key: str) -> Union[Dict, str]:
         if key in self.config:
@@ -64,3 +68,12 @@ class Configuration:
                     self.config[section] = key
             else:
                 self.config.update(key)
+
+    def derive(self, sections: Dict[str, Dict]) -> "Configuration":
+        """A copy of the configuration, with `sections` replacing its own"""
+        derived = copy.copy(self)
+        derived.config = {
+            key: dict(value) if isinstance(value, dict) else value for key, value in self.config.items()
+        }
+        derived.config.update(sections)
+        return derived
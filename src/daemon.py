@@ -6,16 +6,25 @@
 # Check periodically for spends outside resigner. update the db ?
 #
 
+import itertools
 import time
 import math
 import logging
-import asyncio
 import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import OperationalError
+from typing import List, Optional, Tuple
 
 from .config import Configuration
 from .bitcoind_rpc_client import BitcoindRPC, BitcoindRPCError
 from .db import Session
+from .errors import LeaseLostError
+from .lease import Lease, FENCING_LEASE, fenced
+from .metrics import DAEMON_JOB_DURATION, SYNC_HEIGHT
+from .logs import PSBT_LOG, psbt_summary
+from .shared_cache import WALLET_UTXOS
+from .tenants import TENANTS, TenantRegistry
 from .models import (
     Utxos,
     SpentUtxos,
@@ -27,45 +36,46 @@ from .policy import SpendLimit
 
 SATS=100000000
 BLOCK_TIME = 10*60  # Approx time to create a block
+UTXO_CHUNK_SIZE = 1000  # Utxos inserted per transaction while syncing
 
-# Logging
-sh = logging.StreamHandler()
-formatter = logging.Formatter("%(levelname)s - %(asctime)s.%(msecs)03d - %(name)s - ThreadId %(thread)d: %(message)s", datefmt='%H:%M:%S')
-sh.setFormatter(formatter)
-
+# Written by the handlers of the root logger, through the queue of `setup_logging`
 logger = logging.getLogger("resigner.daemon")
-logger.addHandler(sh)
 
 def sync_utxos(btd_client: BitcoindRPC):
 
-    def update_utxos(tip, unspent, coins):
-        # Insert new uxto in Utxos Table
-        for utxo in unspent:
-            coin = Utxos.get(["id"], {"txid": utxo["txid"], "vout": utxo["vout"]})
-            if not coin:
-                logger.debug("Inserting new UTXO into Utxos Table. txid: %s, vout: %d", utxo["txid"], utxo["vout"])
-                Utxos.insert(
-                    (tip-utxo["confirmations"]),
-                    utxo["txid"],
-                    utxo["vout"],
-                    utxo["amount"]*SATS
-                )
-
-        # Delete spent coin from Utxos Table
-        for coin in coins:
-            txout = btd_client.gettxout(coin["txid"], coin["vout"])
-            if not txout:
-                # Should not fail
-                logger.debug("Deleting spent UTXO from Utxos Table. txid: %s, vout: %d", coin["txid"], coin["vout"])
-                Utxos.delete({"txid": coin["txid"]})
-
-
-    coins = Utxos.get()
+    def insert_utxos(tip, unspent):
+        # Insert new uxtos in Utxos Table, the ones already known are skipped
+        with fenced():
+            Utxos.insert_many(
+                [(tip-utxo["confirmations"], utxo["txid"], utxo["vout"], utxo["amount"]*SATS) for utxo in unspent]
+            )
+
+    def delete_spent_utxos():
+        # Delete spent coin from Utxos Table, read a chunk at a time
+        for coins in Utxos.batches(UTXO_CHUNK_SIZE):
+            for coin in coins:
+                txout = btd_client.gettxout(coin["txid"], coin["vout"])
+                if not txout:
+                    # Should not fail
+                    logger.debug(
+                        "Deleting spent UTXO from Utxos Table. txid: %s, vout: %d", coin["txid"], coin["vout"]
+                    )
+                    with fenced():
+                        Utxos.delete({"txid": coin["txid"]})
+
+
     tip = btd_client.getblockcount()
-    unspent = btd_client.listunspent()
 
     logger.info("Updating utxos")
-    update_utxos(tip, unspent, coins)
+    # Before the new utxos are inserted, they are unspent and needn't be checked
+    delete_spent_utxos()
+    # The wallet's utxos are streamed, a large wallet is never held in memory at once
+    for unspent in btd_client.listunspent_chunks(chunk_size=UTXO_CHUNK_SIZE):
+        insert_utxos(tip, unspent)
+    # The shared cache only holds the utxos of the default wallet
+    if WALLET_UTXOS.path is not None and Session.is_default:
+        WALLET_UTXOS.publish_rows(itertools.chain.from_iterable(Utxos.batches(UTXO_CHUNK_SIZE)))
+    SYNC_HEIGHT.set(tip)
 
 def sync_aggregate_spends(config: Configuration):
     btd_client = config.get("bitcoind")["client"]
@@ -78,29 +88,34 @@ def sync_aggregate_spends(config: Configuration):
                 tx = btd_client.getrawtransaction(row["id"])
                 # After 6 confirmations, the chances of loosing a tx due to reorganisations becomes negligible
                 if tx["confirmations"] > min_conf:
-                    logger.info("Signed psbt: %s has been confirmed on the blockchain", row["signed_psbt"])
-                    SignedSpends.update({"confirmed": True}, {"id": row["id"]})
-                    agg_spends = AggregateSpends.get()[0]
-                    AggregateSpends.update(
-                        {
-                            "confirmed_daily_spends": agg_spends["confirmed_daily_spends"] + row["amount_sats"],
-                            "unconfirmed_daily_spends": agg_spends["unconfirmed_daily_spends"] - row["amount_sats"],
-                            "confirmed_weekly_spends": agg_spends["confirmed_weekly_spends"] + row["amount_sats"],
-                            "unconfirmed_weekly_spends": agg_spends["unconfirmed_weekly_spends"] - row["amount_sats"],
-                            "confirmed_monthly_spends": agg_spends["confirmed_monthly_spends"] + row["amount_sats"],
-                            "unconfirmed_monthly_spends": agg_spends["unconfirmed_monthly_spends"] - row["amount_sats"]
-                        }
+                    logger.info(
+                        "Signed psbt: %s has been confirmed on the blockchain", psbt_summary(row["signed_psbt"]),
+                        extra=PSBT_LOG
                     )
+                    with fenced():
+                        # Counted once, whoever confirms it
+                        if SignedSpends.confirm(row["id"]):
+                            amount = row["amount_sats"]
+                            AggregateSpends.add(unconfirmed_sats=-amount, confirmed_sats=amount)
             except BitcoindRPCError as e:
                 logger.info("Transaction `%s` does not exist on the blockchain", row["id"])
                 spent_utxos = SpentUtxos.get([], {"psbt_id": row["id"]})
                 txouts = [(btd_client.gettxout(spends["txid"], spends["vout"])) for spends in spent_utxos]
                 if not all(txouts):
                     logger.info("UTXOs in transaction `%s` has been respent in another transaction", row["id"])
-                    SignedSpends.delete({"id": row["id"]})
-                    SpentUtxos.delete({"psbt_id": row["id"]})
+                    with fenced():
+                        SignedSpends.delete({"id": row["id"]})
+                        SpentUtxos.delete({"psbt_id": row["id"]})
                 
 
+def record_timer(config: Configuration, timer: SpendLimit):
+    config.set({
+        "hrs_passed_since_last_day": timer._hrs_passed_since_last_day,
+        "days_passed_since_last_week": timer._days_passed_since_last_week,
+        "days_passed_since_last_month": timer._days_passed_since_last_month
+        }, "timer")
+
+
 def reset_aggregate_spends(config: Configuration, timer: SpendLimit):
     """Reset the aggregate spends in the db after each day, week and month
     """
@@ -112,38 +127,96 @@ def reset_aggregate_spends(config: Configuration, timer: SpendLimit):
 
     if prvs_time["days_passed_since_last_week"] > timer._days_passed_since_last_week:
         logger.info("Aggregate weekly spends has been reset to 0")
-        AggregateSpends.update({"confirmed_weekly_spends": 0})
+        with fenced():
+            AggregateSpends.update({"confirmed_weekly_spends": 0})
 
     if prvs_time["days_passed_since_last_month"] > timer._days_passed_since_last_month:
         logger.info("Aggregate monthly spends has been reset to 0")
-        AggregateSpends.update({"confirmed_monthly_spends": 0})
+        with fenced():
+            AggregateSpends.update({"confirmed_monthly_spends": 0})
 
-    config.set({
-        "hrs_passed_since_last_day": timer._hrs_passed_since_last_day,
-        "days_passed_since_last_week": timer._days_passed_since_last_week,
-        "days_passed_since_last_month": timer._days_passed_since_last_month
-        }, "timer")
+    record_timer(config, timer)
+
+def run_job(name: str, job, *args):
+    """Run one of the daemon's jobs, recording how long it took"""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        job(*args)
+        outcome = "ok"
+    except LeaseLostError as e:
+        # Another instance is the leader now, the job's remaining writes are its own
+        logger.warning("Stopped the %s job: %s", name, e.message)
+        outcome = "lease_lost"
+    finally:
+        DAEMON_JOB_DURATION.observe(time.perf_counter() - start, job=name, outcome=outcome)
+
+
+def sync_tenants(tenants: TenantRegistry):
+    """The daemon's jobs for every tenant on its own database, `tenants.sync_workers` at once"""
+    def sync_tenant(tenant):
+        with Session.use(tenant.database):
+            try:
+                if "timer" not in tenant.config.config:
+                    record_timer(tenant.config, tenant.spend_limit)
+                sync_utxos(tenant.config.get("bitcoind")["client"])
+                sync_aggregate_spends(tenant.config)
+                reset_aggregate_spends(tenant.config, tenant.spend_limit)
+            except (BitcoindRPCError, OperationalError, OSError) as e:
+                # The other tenants are still synced
+                logger.error("Failed to sync the database of tenant %s: %s", tenant.name, e)
 
-def daemon(config: Configuration, condition: threading.Condition):
+    with ThreadPoolExecutor(max_workers=tenants.sync_workers, thread_name_prefix="sync-tenants") as pool:
+        # Each sync runs in a copy of the job's context: its writes are fenced with the daemon's lease
+        futures = [pool.submit(contextvars.copy_context().run, sync_tenant, tenant) for tenant in tenants]
+        for future in futures:
+            # A lost lease stops the job
+            future.result()
+
+
+def sync_once(config: Configuration):
+    """Sync the database with the chain once, without the daemon"""
+    run_job("sync_utxos", sync_utxos, config.get("bitcoind")["client"])
+    run_job("sync_aggregate_spends", sync_aggregate_spends, config)
+    if len(TENANTS):
+        run_job("sync_tenants", sync_tenants, TENANTS)
+    config.set({"synced_db_with_onchain_data": True}, "resigner_config")
+
+
+def daemon_jobs(config: Configuration, btd_client: BitcoindRPC, timer: SpendLimit) -> List[Tuple]:
+    jobs = [
+        ("sync_utxos", sync_utxos, btd_client),
+        ("sync_aggregate_spends", sync_aggregate_spends, config),
+        ("reset_aggregate_spends", reset_aggregate_spends, config, timer),
+    ]
+    if len(TENANTS):
+        jobs.append(("sync_tenants", sync_tenants, TENANTS))
+    return jobs
+
+
+def daemon(config: Configuration, condition: threading.Condition, lease: Optional[Lease] = None):
+    """
+    Sync the database with the chain every block, forever or until `lease` is lost.
+    `condition` is notified after the first sync.
+    """
     logger.info("resigner daemon starting...")
 
     timer = SpendLimit(config)
 
-    config.set({
-        "hrs_passed_since_last_day": timer._hrs_passed_since_last_day,
-        "days_passed_since_last_week": timer._days_passed_since_last_week,
-        "days_passed_since_last_month": timer._days_passed_since_last_month
-        }, "timer")
+    record_timer(config, timer)
 
     btd_client = config.get("bitcoind")["client"]
 
     condition.acquire()
     synced_db_with_onchain_data = False
     threads = []
-    while True:
-        threads.append(threading.Thread(target=sync_utxos, args=([btd_client])))
-        threads.append(threading.Thread(target=sync_aggregate_spends, args=([config])))
-        threads.append(threading.Thread(target=reset_aggregate_spends, args=([config, timer])))
+    # The leader stops waiting for the next block when it loses the lease
+    pause = time.sleep if lease is None else lease.sleep
+    FENCING_LEASE.set(lease)
+    while lease is None or lease.held:
+        for job in daemon_jobs(config, btd_client, timer):
+            # The jobs' writes are fenced with the lease, see `fenced`
+            threads.append(threading.Thread(target=contextvars.copy_context().run, args=(run_job, *job)))
 
         start_time = math.floor(time.time())
         
@@ -155,6 +228,8 @@ def daemon(config: Configuration, condition: threading.Condition):
 
         threads.clear()
         synced_db_with_onchain_data = True
+        if lease is not None:
+            lease.mark_synced()
         if condition._is_owned():
             config.set({"synced_db_with_onchain_data": synced_db_with_onchain_data},"resigner_config")
             # Notify main thread
@@ -164,4 +239,30 @@ def daemon(config: Configuration, condition: threading.Condition):
         end_time = math.floor(time.time())
 
         if (end_time - start_time) < BLOCK_TIME:
-            time.sleep(BLOCK_TIME - (end_time - start_time))
+            pause(BLOCK_TIME - (end_time - start_time))
+
+    logger.info("This instance lost the daemon lease, stopping the daemon")
+
+
+def elected_daemon(config: Configuration, condition: threading.Condition, lease: Lease):
+    """
+    Run the daemon while this instance holds `lease`, the leader; other instances rely on
+    the leader's syncs of the database and retry to take the lease every third of its ttl.
+    A database recently synced (by another instance, or shipped to a standby) is
+    served without waiting for the daemon's first sync.
+    """
+    while True:
+        if not config.get("resigner_config")["synced_db_with_onchain_data"]:
+            synced_at = lease.synced_at()
+            # As recent as the syncs of a running leader: not one from long before a restart
+            if synced_at is not None and time.time() - synced_at < BLOCK_TIME + lease.ttl:
+                logger.info("The database was synced by the leader %.0fs ago", time.time() - synced_at)
+                with condition:
+                    config.set({"synced_db_with_onchain_data": True}, "resigner_config")
+                    condition.notify_all()
+
+        if lease.try_acquire():
+            logger.info("This instance is the leader, running the daemon")
+            lease.start_heartbeat()
+            daemon(config, condition, lease)
+        time.sleep(lease.ttl / 3)
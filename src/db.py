@@ -1,9 +1,177 @@
 import os
+import re
+import time
 import sqlite3
+import contextlib
+import threading
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Optional
+
+from .metrics import DB_QUERY_DURATION, DB_COMMIT_DURATION
+from .tracing import span, KIND_CLIENT
+
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def statement_labels(sql: str):
+    """(operation, table) of a statement, for the query latency metric and spans"""
+    words = sql.split(None, 1)
+    table = STATEMENT_TABLE.search(sql)
+    return (words[0].lower() if words else ""), (table.group(1).lower() if table else "")
+
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor recording the time its statements take to execute"""
+    def _timed(self, execute, sql, *args):
+        operation, table = statement_labels(sql)
+        start = time.perf_counter()
+        try:
+            with span(f"db {operation} {table}".rstrip(), KIND_CLIENT):
+                return execute(sql, *args)
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - start, operation=operation, table=table)
+
+    def execute(self, sql, *args):
+        return self._timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(super().executemany, sql, *args)
+
+    def executescript(self, script):
+        return self._timed(super().executescript, script)
+
+
+class TimedConnection(sqlite3.Connection):
+    """A connection whose cursors and commits are timed"""
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The connection's shortcuts don't go through cursor()
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            with span("db commit", KIND_CLIENT):
+                return super().commit()
+        finally:
+            DB_COMMIT_DURATION.observe(time.perf_counter() - start)
+
 
 class Database:
+    """
+    The connection to the database. The connection's methods (`cursor`, `execute`,
+    `commit`, ...) can be called on the database, and go to its current connection.
+    """
     def __init__(self, path, **kwargs):
-        self.connection = sqlite3.connect(path, timeout=100, check_same_thread=False, **kwargs)
+        self.path = path
+        self._kwargs = kwargs
+        self._forked_connections = []
+        self.connection = self.connect()
+        # The connection of the transactions, see `transaction`
+        self._transaction_connection: Optional[sqlite3.Connection] = None
+        self._transaction_lock = threading.Lock()
+        self._transaction: ContextVar[Optional[sqlite3.Connection]] = ContextVar(f"transaction {path}", default=None)
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(
+            self.path, timeout=100, check_same_thread=False, factory=TimedConnection, **self._kwargs
+        )
+
+    def reconnect(self):
+        """
+        Open a new connection in a forked process: a SQLite connection must not be used on
+        both sides of a fork. The inherited one is kept open, closing it would release the
+        locks the parent holds on the database.
+        """
+        self._forked_connections.append(self.connection)
+        self.connection = self.connect()
+        if self._transaction_connection is not None:
+            self._forked_connections.append(self._transaction_connection)
+            self._transaction_connection = None
+        self._transaction_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the statements of the block as a single transaction: committed at the end of the
+        block, rolled back if it raises. The models' commits within are deferred to the end.
+
+        A transaction has a connection of its own, so that the statements other threads run
+        meanwhile on the shared connection aren't part of it. Transactions of the database are
+        run one at a time; a transaction started within another one is part of it.
+        """
+        if self._transaction.get() is not None:
+            yield self
+            return
+
+        with self._transaction_lock:
+            if self._transaction_connection is None:
+                # An in memory database only exists for its connection
+                self._transaction_connection = self.connection if self.path == ":memory:" else self.connect()
+            connection = self._transaction_connection
+            token = self._transaction.set(connection)
+            try:
+                if connection.in_transaction:
+                    connection.commit()
+                # Writers are excluded from the start, what is read can't change until the commit
+                connection.execute("BEGIN IMMEDIATE")
+                yield self
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                self._transaction.reset(token)
+
+    def commit(self):
+        if self._transaction.get() is None:
+            self.connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._transaction.get() or self.connection, name)
+
+
+# The database of the tenant being served, see `DatabaseSession.use`
+CURRENT_DATABASE: ContextVar[Optional[Database]] = ContextVar("database", default=None)
+
+
+class DatabaseSession:
+    """
+    The database the models work on: the default one, or a tenant's within `use`. Like a
+    `Database`, the attributes of the current one can be used on the session.
+    """
+    def __init__(self, default: Database):
+        self.default = default
+
+    @property
+    def current(self) -> Database:
+        return CURRENT_DATABASE.get() or self.default
+
+    @property
+    def is_default(self) -> bool:
+        return self.current is self.default
+
+    @contextlib.contextmanager
+    def use(self, database: Database):
+        """Work on `database` in this context (threads started within don't inherit it)"""
+        token = CURRENT_DATABASE.set(database)
+        try:
+            yield database
+        finally:
+            CURRENT_DATABASE.reset(token)
+
+    def __getattr__(self, name):
+        return getattr(self.current, name)
 
 
-Session = Database(os.getenv("RESIGNER_DB_URI", "resigner.db")).connection
+Session = DatabaseSession(Database(os.getenv("RESIGNER_DB_URI", "resigner.db")))
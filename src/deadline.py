@@ -0,0 +1,44 @@
+import time
+import contextvars
+from typing import List, Optional
+
+from .errors import DeadlineExceededError
+
+_current_deadline = contextvars.ContextVar("resigner_deadline", default=None)
+
+
+class Deadline:
+    """
+    Time budget of a request.
+
+    Used as a context manager it becomes the active deadline: every bitcoind RPC made
+    inside the block gets the remaining budget as its timeout, and fails with
+    `DeadlineExceededError` once the budget is spent.
+    """
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self._tokens: List[contextvars.Token] = []
+
+    def __enter__(self):
+        self._tokens.append(_current_deadline.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        _current_deadline.reset(self._tokens.pop())
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str):
+        """Fail fast if the budget ran out before `stage` could start."""
+        if self.expired:
+            raise DeadlineExceededError(stage, self.budget)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
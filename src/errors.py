@@ -44,4 +44,17 @@ class ServerError(Exception):
 
 class DBError(Exception):
     def __init__(self, message):
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+
+class DeadlineExceededError(Exception):
+    def __init__(self, stage: str, budget: float):
+        self.message = f"Request exceeded its {budget:g}s time budget during {stage}"
+        self.stage = stage
+        self.budget = budget
+
+
+class LeaseLostError(Exception):
+    def __init__(self, name: str):
+        self.message = f"This instance no longer holds the {name} lease"
+        self.name = name
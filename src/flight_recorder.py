@@ -0,0 +1,88 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+import orjson
+
+from .tracing import Trace
+
+logger = logging.getLogger("resigner")
+
+
+class FlightRecorder:
+    """
+    Keeps the timelines of the last `size` requests in memory, and writes them all to
+    `dump_path` when a request fails with a 5xx status or takes longer than
+    `slow_request_threshold` seconds. Dumps are at least `min_dump_interval` seconds
+    apart, a failing node doesn't fill the disk.
+
+    A trace exporter: it gets every trace once the request is handled.
+    """
+    def __init__(
+        self,
+        size: int = 100,
+        slow_request_threshold: Optional[float] = None,
+        dump_path: Optional[str] = None,
+        min_dump_interval: float = 60.0
+    ):
+        self.slow_request_threshold = slow_request_threshold
+        self.dump_path = dump_path
+        self.min_dump_interval = min_dump_interval
+
+        self._timelines = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._last_dump: Optional[float] = None
+        self.dumps = 0
+
+    def __call__(self, trace: Trace):
+        timeline = trace.to_dict()
+        root = trace.root
+        timeline["status"] = root.attributes.get("http.status_code")
+        timeline["duration_ms"] = round(root.duration_ms, 3)
+        with self._lock:
+            self._timelines.append(timeline)
+
+        reason = self.dump_reason(timeline)
+        if reason is not None:
+            self.dump(reason, trace.trace_id)
+
+    def dump_reason(self, timeline: Dict) -> Optional[str]:
+        if timeline["status"] is not None and timeline["status"] >= 500:
+            return f"status {timeline['status']}"
+        if self.slow_request_threshold is not None and timeline["duration_ms"] > self.slow_request_threshold * 1000:
+            return f"took {timeline['duration_ms']}ms"
+        return None
+
+    def timelines(self) -> List[Dict]:
+        """The recorded timelines, oldest first"""
+        with self._lock:
+            return list(self._timelines)
+
+    def snapshot(self, reason: str = "on demand", request_id: Optional[str] = None) -> Dict:
+        return {
+            "reason": reason,
+            "request_id": request_id,
+            "time": time.time(),
+            "timelines": self.timelines(),
+        }
+
+    def dump(self, reason: str, request_id: str) -> Optional[str]:
+        """Write the recorded timelines to a new file of `dump_path`, returns its path"""
+        if self.dump_path is None:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._last_dump is not None and now - self._last_dump < self.min_dump_interval:
+                return None
+            self._last_dump = now
+
+        os.makedirs(self.dump_path, exist_ok=True)
+        path = os.path.join(self.dump_path, f"flight-{time.strftime('%Y%m%dT%H%M%S')}-{request_id}.json")
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(self.snapshot(reason, request_id)))
+        self.dumps += 1
+        logger.warning("Request %s %s, flight recorder dumped to %s", request_id, reason, path)
+        return path
@@ -0,0 +1,140 @@
+import re
+from typing import Any, Dict, List
+
+import orjson
+
+# A complete JSON string, or a single structural character. A lone `"` is a string
+# whose end hasn't been received yet.
+_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}"]')
+# Between the elements of the array, commas separate them as well
+_ITEM_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}",]')
+# What follows an element when the next one is an object or array too, or the array ends
+_NEXT_CONTAINER = re.compile(rb'\s*(?:,\s*[\[{]|\])')
+
+# Parser states
+_BEFORE_ARRAY = 0
+_IN_ARRAY = 1
+_AFTER_ARRAY = 2
+
+
+class JSONArrayStream:
+    """
+    Incremental parser for a JSON object with one big array member, such as a
+    bitcoind reply `{"result": [...], "error": null, "id": 1}`.
+
+    Bytes are fed as they are received. The elements of the array (objects, arrays or
+    scalars) are returned as soon as they are complete, and only the element being read
+    is kept in memory. The rest of the document is returned by `close`, with the array
+    replaced by `null`.
+    """
+    def __init__(self, key: str = "result"):
+        self._key = orjson.dumps(key)
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._last_key = None
+        self._state = _BEFORE_ARRAY
+        self._item_start = None
+        # The document without the array
+        self._envelope = bytearray()
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        self._buffer += chunk
+        items = []
+        # Bytes of the buffer that aren't needed anymore
+        consumed = 0
+        between_items = self._between_items
+        restart = True
+        while restart:
+            restart = False
+            # Commas only matter between the elements, elsewhere they aren't tokenized
+            for match in (_ITEM_TOKEN if between_items else _TOKEN).finditer(self._buffer, self._pos):
+                token = match.group()
+                if token == b'"':
+                    # Unterminated string, wait for more data
+                    break
+                self._pos = match.end()
+                if token[0] == ord('"'):
+                    if self._depth == 1:
+                        self._last_key = token
+                    continue
+                consumed = self._structural(token, match.start(), items) or consumed
+
+                if self._switch_tokens(between_items):
+                    between_items = not between_items
+                    restart = True
+                    break
+
+        self._discard(consumed)
+        return items
+
+    def _discard(self, consumed: int):
+        """Drop the first `consumed` bytes of the buffer"""
+        if consumed:
+            del self._buffer[:consumed]
+            self._pos -= consumed
+            if self._item_start is not None:
+                self._item_start -= consumed
+
+    @property
+    def _between_items(self) -> bool:
+        return self._state == _IN_ARRAY and self._depth == 2
+
+    def _switch_tokens(self, between_items: bool) -> bool:
+        """Whether what follows is tokenized with the other pattern"""
+        if between_items == self._between_items:
+            return False
+        # Read by `_TOKEN` as well, arrays of objects are tokenized in one go
+        return between_items or not _NEXT_CONTAINER.match(self._buffer, self._pos)
+
+    def _structural(self, token: bytes, start: int, items: List[Any]) -> int:
+        """Handle the token at `start`, return the bytes of the buffer that are no longer needed"""
+        if token in (b"{", b"["):
+            return self._open(token, start)
+        if token == b",":
+            self._scalar(start, items)
+            self._item_start = self._pos
+            return self._pos
+        return self._close(start, items)
+
+    def _open(self, token: bytes, start: int) -> int:
+        self._depth += 1
+        if self._state == _BEFORE_ARRAY and self._depth == 2 and token == b"[" and self._last_key == self._key:
+            self._state = _IN_ARRAY
+            self._envelope += self._buffer[:start] + b"null"
+            self._item_start = self._pos
+            return self._pos
+
+        if self._state == _IN_ARRAY and self._depth == 3:
+            self._item_start = start
+        return 0
+
+    def _scalar(self, end: int, items: List[Any]):
+        """Parse the scalar element, if any, that ends at `end`"""
+        if self._item_start is None:
+            # Follows an object or array element
+            return
+        value = self._buffer[self._item_start:end].strip()
+        if value:
+            items.append(orjson.loads(value))
+
+    def _close(self, start: int, items: List[Any]) -> int:
+        self._depth -= 1
+        if self._state != _IN_ARRAY:
+            return 0
+
+        if self._depth == 2:
+            items.append(orjson.loads(self._buffer[self._item_start:self._pos]))
+            self._item_start = None
+            return self._pos
+        if self._depth == 1:
+            # End of the array, what follows belongs to the envelope
+            self._scalar(start, items)
+            self._item_start = None
+            self._state = _AFTER_ARRAY
+            return self._pos
+        return 0
+
+    def close(self) -> Dict:
+        """Parse what remains of the document once all bytes have been fed."""
+        return orjson.loads(bytes(self._envelope) + bytes(self._buffer))
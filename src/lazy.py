@@ -0,0 +1,29 @@
+import sys
+import importlib
+import importlib.util
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Stands in for a module until one of its attributes is used, then imports it. Unlike
+    `importlib.util.LazyLoader`, safe to use from several threads at once: the import
+    lock of the module makes the first ones to use it wait for its import to finish.
+    """
+    def __getattr__(self, name: str):
+        if "_module" not in self.__dict__:
+            # Waits for the module to be initialized, when another thread is importing it
+            self.__dict__["_module"] = importlib.import_module(self.__name__)
+        return getattr(self.__dict__["_module"], name)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    The module `name`, only executed once one of its attributes is used. For heavy
+    dependencies that only some code paths need.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    return LazyModule(name)
@@ -0,0 +1,122 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import contextlib
+import threading
+from sqlite3 import DatabaseError
+from contextvars import ContextVar
+from typing import Optional
+
+from .db import Session
+from .errors import LeaseLostError
+from .models import Leases
+
+logger = logging.getLogger("resigner")
+
+DEFAULT_LEASE_TTL = 30.0
+DEFAULT_MAX_CLOCK_SKEW = 2.0
+
+# The lease the writes of the running job are fenced with, see `fenced`
+FENCING_LEASE: ContextVar[Optional["Lease"]] = ContextVar("fencing_lease", default=None)
+
+
+class Lease:
+    """
+    A lease stored in the database, held by one instance at a time: the leader.
+
+    The leader renews it every third of `ttl` (`heartbeat`); if it stops doing so, another
+    instance takes the lease over once it expired. The leader considers it lost as soon as
+    `ttl` elapsed since its last renewal, before any other instance can take it.
+
+    The expiry is a wall clock time, written with the leader's clock and compared to the
+    others': another instance only takes the lease over `max_clock_skew` seconds after it
+    expired, which keeps two leaders apart as long as the clocks of the hosts sharing the
+    database differ by less than that.
+    """
+    def __init__(
+        self,
+        name: str,
+        ttl: float = DEFAULT_LEASE_TTL,
+        holder: Optional[str] = None,
+        max_clock_skew: float = DEFAULT_MAX_CLOCK_SKEW
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_clock_skew = max_clock_skew
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # The lease is kept in the database in use when it is made
+        self.database = Session.current
+        self._expires_at = 0.0
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def try_acquire(self) -> bool:
+        """Take the lease, or renew it if held. Returns whether this instance is the leader."""
+        start = time.monotonic()
+        try:
+            claimed = Leases.claim(self.name, self.holder, time.time(), self.ttl, self.max_clock_skew)
+        except DatabaseError as e:
+            logger.warning("Failed to claim the %s lease: %s", self.name, e)
+            return self.held
+        self._expires_at = start + self.ttl if claimed else 0.0
+        return claimed
+
+    @property
+    def held(self) -> bool:
+        return time.monotonic() < self._expires_at
+
+    def check(self):
+        """Raise `LeaseLostError` unless the database still records this instance as the leader"""
+        with Session.use(self.database):
+            held = self.held and Leases.held_by(self.name, self.holder, time.time())
+        if not held:
+            self._expires_at = 0.0
+            raise LeaseLostError(self.name)
+
+    def heartbeat(self):
+        """Renew the lease until it is lost"""
+        while self.held:
+            time.sleep(self.ttl / 3)
+            if self.held and not self.try_acquire():
+                logger.warning("Lost the %s lease", self.name)
+
+    def sleep(self, seconds: float) -> bool:
+        """Sleep `seconds`, or until the lease is lost. Returns whether it is still held."""
+        end = time.monotonic() + seconds
+        while self.held and time.monotonic() < end:
+            time.sleep(min(self.ttl / 3, end - time.monotonic()))
+        return self.held
+
+    def start_heartbeat(self):
+        if self._heartbeat is None or not self._heartbeat.is_alive():
+            self._heartbeat = threading.Thread(target=self.heartbeat, name=f"{self.name}-lease", daemon=True)
+            self._heartbeat.start()
+
+    def release(self):
+        """Let another instance take the lease over right away"""
+        if self.held:
+            self._expires_at = 0.0
+            Leases.update({"expires_at": 0}, {"name": self.name, "holder": self.holder})
+
+    def synced_at(self) -> Optional[float]:
+        """When the leader last synced the database with the chain"""
+        rows = Leases.get(["synced_at"], {"name": self.name})
+        return rows[0]["synced_at"] if rows else None
+
+    def mark_synced(self):
+        Leases.update({"synced_at": time.time()}, {"name": self.name, "holder": self.holder})
+
+
+@contextlib.contextmanager
+def fenced():
+    """
+    A transaction for the writes of a daemon job: it only goes ahead while this instance
+    holds `FENCING_LEASE`, if set. The check is part of the transaction when the lease is in
+    the same database, no other instance can take the lease over before the writes commit.
+    """
+    with Session.transaction():
+        lease = FENCING_LEASE.get()
+        if lease is not None:
+            lease.check()
+        yield
@@ -0,0 +1,66 @@
+import os
+import time
+import fcntl
+import threading
+from typing import Optional
+
+
+class ProcessLock:
+    """
+    A lock held by one thread of one process at a time: a thread lock, and an exclusive
+    `flock` on `path` when set so that it also excludes the other processes using it.
+
+    The operating system releases the file lock when its holder dies, a crashed worker
+    never leaves it held.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd: Optional[int] = None
+
+    def _lock_file(self, blocking: bool) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def try_acquire(self) -> bool:
+        if not self._thread_lock.acquire(blocking=False):
+            return False
+        if self.path is None or self._lock_file(blocking=False):
+            return True
+        self._thread_lock.release()
+        return False
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the lock, at most `timeout` seconds. Returns whether it was acquired."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._thread_lock.acquire(timeout=-1 if timeout is None else max(timeout, 0)):
+            return False
+        if self.path is None or self._lock_file(blocking=deadline is None):
+            return True
+        # flock can't time out, poll it
+        while time.monotonic() < deadline:
+            time.sleep(0.002)
+            if self._lock_file(blocking=False):
+                return True
+        self._thread_lock.release()
+        return False
+
+    def release(self):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
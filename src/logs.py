@@ -0,0 +1,142 @@
+"""
+Logging off the request threads.
+
+Records are filtered and stamped with the request id on the thread that logs them, then
+handed over a bounded queue to a listener thread which formats and writes them. A full
+queue drops the record rather than blocking the request.
+
+Records can be given a category (`logger.info(..., extra={"category": "psbt"})`, the
+logger name otherwise), each category being sampled and rate limited on its own, see
+`[logging]` in docs/config.md. Warnings and errors are never dropped.
+"""
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict, Optional
+
+import orjson
+
+from .metrics import LOG_RECORDS_DROPPED
+from .tracing import RequestIdFilter
+
+PSBT_LOG = {"category": "psbt"}
+PSBT_PREFIX = 12
+
+
+def psbt_summary(psbt: str) -> str:
+    """What is logged of a PSBT: its first characters, length and hash"""
+    digest = hashlib.sha256(psbt.encode()).hexdigest()[:16]
+    return f"{psbt[:PSBT_PREFIX]}... ({len(psbt)} chars, sha256:{digest})"
+
+
+def record_category(record: logging.LogRecord) -> str:
+    return getattr(record, "category", record.name)
+
+
+class CategoryLimiter(logging.Filter):
+    """
+    Keep a `sample` share of the records of a category, then at most `rate` of them per
+    second with bursts of `burst`.
+    """
+    def __init__(self, categories: Dict[str, Dict], rand: Callable[[], float] = random.random):
+        super().__init__()
+        self.categories = categories
+        self.rand = rand
+        # category: (tokens, last refill)
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _take(self, category: str, rate: float, burst: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(category, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = record_category(record)
+        limits = self.categories.get(category)
+        if limits is None or record.levelno >= logging.WARNING:
+            return True
+
+        if self.rand() >= limits.get("sample", 1.0):
+            LOG_RECORDS_DROPPED.inc(category=category, reason="sampled")
+            return False
+        rate = limits.get("rate")
+        if rate is not None and not self._take(category, rate, limits.get("burst", max(rate, 1))):
+            LOG_RECORDS_DROPPED.inc(category=category, reason="rate_limited")
+            return False
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hand records to the listener thread, dropping them when it can't keep up"""
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(category=record_category(record), reason="queue_full")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON document per record"""
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "category": record_category(record),
+            "request_id": getattr(record, "request_id", "-"),
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(document).decode()
+
+
+def start_async_logging(settings: Optional[Dict] = None) -> Optional[QueueListener]:
+    """
+    Move the handlers of the root logger behind a queue, returns the listener writing to
+    them. Does nothing if it's already the case.
+    """
+    settings = settings or {}
+    root = logging.getLogger()
+    if any(isinstance(handler, DroppingQueueHandler) for handler in root.handlers):
+        return None
+
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+        # The request id is only known on the logging thread, the queue handler adds it
+        for log_filter in [f for f in handler.filters if isinstance(f, RequestIdFilter)]:
+            handler.removeFilter(log_filter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(settings.get("queue_size", 10000)))
+    queue_handler.addFilter(CategoryLimiter(settings.get("categories", {})))
+    queue_handler.addFilter(RequestIdFilter())
+    root.addHandler(queue_handler)
+
+    queue_handler.listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
+    return queue_handler.listener
+
+
+def restart_async_logging():
+    """In a forked process: the listener thread of the parent didn't survive the fork, start a new one"""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            handler.queue = queue.Queue(handler.queue.maxsize)
+            handler.listener = QueueListener(handler.queue, *handler.listener.handlers, respect_handler_level=True)
+            handler.listener.start()
+            atexit.register(handler.listener.stop)
@@ -3,17 +3,48 @@ import re
 import time
 import math
 import logging
+import hmac
 import argparse
 import threading
+import functools
+import struct
+import contextlib
 
-from typing import Optional
+from typing import Iterator, List, Optional, Tuple
 from sqlite3 import OperationalError, IntegrityError, DatabaseError
 
-from flask import Flask, jsonify, request, send_from_directory, abort
-
-
-from .errors import ServerError, UtxoError, UnsafePSBTError, DBError
-from .daemon import daemon
+from flask import Flask, jsonify, request, send_from_directory, abort, g
+
+
+from .errors import ServerError, UtxoError, UnsafePSBTError, DBError, DeadlineExceededError, PSBTSerializationError
+from .deadline import Deadline
+from .tracing import TRACER, FileExporter, RequestIdFilter, span, valid_request_id
+from .flight_recorder import FlightRecorder
+from .profiler import SamplingProfiler
+from .logs import PSBT_LOG, DroppingQueueHandler, JsonFormatter, psbt_summary, start_async_logging
+from .metrics import (
+    REGISTRY,
+    CONTENT_TYPE,
+    HTTP_REQUESTS,
+    HTTP_REQUEST_DURATION,
+    RPC_CACHE_LOOKUPS,
+    RPC_CACHE_ENTRIES,
+    SYNC_HEIGHT,
+    SYNC_LAG,
+    SPEND_WINDOW_SPENT,
+    SPEND_WINDOW_LIMIT,
+    SPEND_WINDOW_UTILIZATION
+)
+from .daemon import BLOCK_TIME, elected_daemon, sync_once
+from .db import Session
+from .lease import Lease, DEFAULT_LEASE_TTL, DEFAULT_MAX_CLOCK_SKEW
+from .locks import ProcessLock
+from .replication import SPEND_REPLICA
+from .shared_cache import WALLET_UTXOS
+from .standby import SPEND_JOURNAL, follow_primary, start_primary, start_shipping
+from .tenants import (
+    DEFAULT_SYNC_WORKERS, RESIGNER_FINGERPRINTS, TENANTS, Tenant, psbt_input_fingerprints, wallet_fingerprints
+)
 from .bitcoind_rpc_client import BitcoindRPC, BitcoindRPCError
 from .config import Configuration
 from .policy import (
@@ -27,19 +58,33 @@ from .models import (
     Utxos,
     SpentUtxos,
     SignedSpends,
-    AggregateSpends
+    AggregateSpends,
+    Leases
 )
 
-from .analysis import ResignerPsbt, analyse_psbt_from_base64_str
+from .analysis import ResignerPsbt, psbt_lookups, analyse_psbt_lookups, batch_psbt_lookups
 
 
-def setup_logging(name="resigner"):  
+def setup_logging(name="resigner", settings: Optional[dict] = None):  
+    """Log through a queue unless `[logging] asynchronous = false`, see docs/config.md"""
     #logging.getLogger("werkzeug").disabled = True
     logging.getLogger("httpx").disabled = True
+    settings = settings or {}
     
-    log_format = "%(levelname)s:%(asctime)s.%(msecs)03d:%(name)s: %(message)s"
+    log_format = "%(levelname)s:%(asctime)s.%(msecs)03d:%(name)s:%(request_id)s: %(message)s"
 
     logging.basicConfig(level=logging.INFO, format=log_format, datefmt='%H:%M:%S')
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            # Already logging through the queue
+            continue
+        if settings.get("format") == "json":
+            handler.setFormatter(JsonFormatter())
+        # Log lines carry the id of the request they were written for, "-" outside of one
+        if not any(isinstance(f, RequestIdFilter) for f in handler.filters):
+            handler.addFilter(RequestIdFilter())
+    if settings.get("asynchronous", True):
+        start_async_logging(settings)
     logger = logging.getLogger(name)
 
     return logger
@@ -64,6 +109,10 @@ def setup_error_handlers(app):
         else:
             return jsonify(message="Method Not Allowed"), 405
     
+    @app.errorhandler(PSBTSerializationError)
+    def psbt_serialization_error(e):
+        return jsonify(error_code=400, message=e.message), 400
+
     @app.errorhandler(UnsafePSBTError)
     def psbt_error(e):
         return jsonify(error_code=403, message=e.message), 403
@@ -74,8 +123,15 @@ def setup_error_handlers(app):
 
     @app.errorhandler(PolicyException)
     def policy_error(e):
+        g.rejected_by = e.policy
         return jsonify(error_code=403, message=e.message), 403
 
+    @app.errorhandler(DeadlineExceededError)
+    def deadline_error(e):
+        remote_addr = request.environ.get('REMOTE_ADDR', request.remote_addr)
+        logger.error(f"{e.message}, while handling request from IP: {remote_addr}")
+        return jsonify(error_code=504, message=e.message), 504
+
     @app.errorhandler(DatabaseError)
     @app.errorhandler(DBError)
     def dberror_handler(e):
@@ -98,20 +154,556 @@ def setup_error_handlers(app):
         return jsonify(error_code=500, message=f"Internal Server Error: {e}"), 500
 
 
-def sign_transaction(psbt: str, config: Configuration):
+SPEND_WINDOWS = ("daily", "weekly", "monthly")
+
+
+def config_section(config: Configuration, name: str) -> dict:
+    """An optional section of the configuration, empty when missing"""
+    try:
+        return config.get(name)
+    except TypeError:
+        return {}
+
+
+def spend_limits(config: Configuration) -> dict:
+    limits = config_section(config, "spending_limt")
+    if not limits:
+        return {}
+    return {window: limits.get(f"{window}_limit", 0) for window in SPEND_WINDOWS}
+
+
+def spend_window_spent() -> dict:
+    spends = AggregateSpends.get()[0]
+    return {
+        (window, state): spends[f"{state}_{window}_spends"]
+        for window in SPEND_WINDOWS for state in ("confirmed", "unconfirmed")
+    }
+
+
+def spend_window_utilization(config: Configuration) -> dict:
+    spent = spend_window_spent()
+    return {
+        (window,): (spent[(window, "confirmed")] + spent[(window, "unconfirmed")]) / limit
+        for window, limit in spend_limits(config).items() if limit > 0
+    }
+
+
+# Held while a spend is checked against the limits, signed and recorded. Shared by the
+# workers in the pre-fork mode, see src/prefork.py
+SPEND_LOCK = ProcessLock()
+
+
+@contextlib.contextmanager
+def spend_lock(deadline: Deadline, lock: ProcessLock = SPEND_LOCK):
+    if not lock.acquire(deadline.remaining()):
+        raise DeadlineExceededError("waiting for the spend lock", deadline.budget)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+# Endpoints whose requests are never traced
+UNTRACED_ENDPOINTS = frozenset({"metrics", "swagger_ui", "serve_static", "flight_recorder", "profile"})
+
+
+def tracing_exporters(config: Configuration) -> list:
+    exporters = []
+    tracing = config_section(config, "tracing")
+    if tracing.get("export") in ("json", "otlp"):
+        exporters.append(FileExporter(tracing.get("path", "traces.jsonl"), otlp=tracing["export"] == "otlp"))
+
+    recorder = config_section(config, "flight_recorder")
+    if recorder:
+        exporters.append(FlightRecorder(
+            recorder.get("size", 100),
+            recorder.get("slow_request_threshold"),
+            recorder.get("dump_path", "flight-recorder"),
+            recorder.get("min_dump_interval", 60)
+        ))
+    return exporters
+
+
+def start_request_trace():
+    """Start tracing the current request, under the id the client sent if valid"""
+    request_id = request.headers.get("X-Request-Id", "").lower()
+    return TRACER.start(
+        request.endpoint or "unmatched",
+        request_id if valid_request_id(request_id) else None,
+        **{"http.method": request.method, "http.route": request.url_rule.rule if request.url_rule else ""}
+    )
+
+
+def annotate_request_trace(root, response):
+    root.set_attribute("http.status_code", response.status_code)
+    if response.status_code >= 500:
+        root.error = f"HTTP {response.status_code}"
+    response.headers["X-Request-Id"] = root.trace.trace_id
+
+
+def setup_tracing(app):
+    """Trace every request while an exporter is configured, see docs/config.md"""
+    TRACER.exporters[:] = tracing_exporters(app.config["route_args"]["config"])
+    app.config["route_args"]["flight_recorder"] = next(
+        (exporter for exporter in TRACER.exporters if isinstance(exporter, FlightRecorder)), None
+    )
+
+    @app.before_request
+    def start_trace():
+        if request.endpoint not in UNTRACED_ENDPOINTS:
+            g.trace_root = start_request_trace()
+
+    @app.after_request
+    def add_request_id(response):
+        if g.get("trace_root") is not None:
+            annotate_request_trace(g.trace_root, response)
+        return response
+
+    @app.teardown_request
+    def finish_trace(exception):
+        root = g.pop("trace_root", None)
+        if root is not None:
+            if exception is not None:
+                root.set_error(exception)
+            TRACER.finish(root)
+
+
+def setup_metrics(app):
+    """Record every request, and read the values only known at scrape time"""
+    config = app.config["route_args"]["config"]
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        status = str(response.status_code)
+        HTTP_REQUESTS.inc(endpoint=endpoint, status=status, policy=g.get("rejected_by", ""))
+        duration = time.perf_counter() - g.get("request_start", time.perf_counter())
+        HTTP_REQUEST_DURATION.observe(duration, endpoint=endpoint, status=status)
+        return response
+
+    def client():
+        return config.get("bitcoind")["client"]
+
+    def sync_lag():
+        height = SYNC_HEIGHT.value()
+        return {} if height is None else {(): client().getblockcount() - height}
+
+    def cache_lookups():
+        stats = client().cache_stats()
+        return {("hit",): stats.get("hits", 0), ("miss",): stats.get("misses", 0)}
+
+    RPC_CACHE_LOOKUPS.set_function(cache_lookups)
+    RPC_CACHE_ENTRIES.set_function(lambda: {(): client().cache_stats().get("entries", 0)})
+    SYNC_LAG.set_function(sync_lag)
+    SPEND_WINDOW_SPENT.set_function(spend_window_spent)
+    SPEND_WINDOW_LIMIT.set_function(lambda: {(window,): limit for window, limit in spend_limits(config).items()})
+    SPEND_WINDOW_UTILIZATION.set_function(lambda: spend_window_utilization(config))
+
+    @app.route('/metrics')
+    def metrics():
+        return app.response_class(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+def sign_transaction(psbt: str, config: Configuration, deadline: Optional[Deadline] = None):
     logger = config.get("logger")
     btcd = config.get("bitcoind")["client"]
     signed_psbt = ""
+    if deadline is not None:
+        deadline.check("signing")
     try:
-        logger.info("signing psbt: %s", psbt)
+        logger.info("signing psbt: %s", psbt_summary(psbt), extra=PSBT_LOG)
         signed_psbt = btcd.walletprocesspsbt(psbt)
     except BitcoindRPCError as e:
         raise ServerError(e)
 
-    logger.info("Processed PSBT: %s...%s without errors", psbt[:9], psbt[-10:])
+    logger.info("Processed PSBT: %s without errors", psbt_summary(psbt), extra=PSBT_LOG)
     # Todo: implement a proper error reporting
     return signed_psbt
 
+def record_signed_spend(psbt_obj: ResignerPsbt, signed_psbt: str, request_timestamp: int, logger: logging.Logger):
+    """Record a signed psbt, the utxos it spends and its amount in the unconfirmed spends"""
+    with Session.transaction():
+        SignedSpends.insert(
+                psbt_obj.txid,
+                psbt_obj.psbt_str,
+                signed_psbt,
+                psbt_obj.amount_sats,
+                request_timestamp,
+                False
+        )
+
+        for utxo in psbt_obj.utxos:
+            SpentUtxos.insert(utxo["txid"], utxo["vout"], psbt_obj.txid)
+
+        logger.info("Updating aggregate spends, amount: %d", psbt_obj.amount_sats)
+        AggregateSpends.add(unconfirmed_sats=psbt_obj.amount_sats)
+    # Only what was committed is replicated
+    if SPEND_REPLICA.enabled:
+        SPEND_REPLICA.record(psbt_obj.amount_sats)
+    # The standby knows of the spend before its signed psbt is returned
+    if SPEND_JOURNAL.enabled and Session.is_default:
+        try:
+            SPEND_JOURNAL.append(psbt_obj, signed_psbt, request_timestamp)
+        except OSError as e:
+            raise ServerError(f"Failed to journal the spend {psbt_obj.txid} to the standby: {e}")
+
+
+def routing_enabled() -> bool:
+    """Whether PSBTs are routed by their keys: then only the routed wallet's utxos are signed"""
+    return bool(len(TENANTS) or RESIGNER_FINGERPRINTS)
+
+
+def route_psbt(psbt: str) -> Optional[Tenant]:
+    """
+    The tenant a PSBT is routed to, by the key fingerprints of each of its inputs. None for
+    the default wallet. PSBTs with an input involving none of the known keys, whose inputs
+    span several wallets, or that can't be parsed, are rejected here, before any rpc.
+
+    The fingerprints are the submitter's to set: the inputs are then checked to be utxos of
+    the routed wallet, see `analyse_psbt_lookups`.
+    """
+    if not routing_enabled():
+        return None
+    try:
+        inputs_fingerprints = psbt_input_fingerprints(psbt)
+    except (PSBTSerializationError, ValueError, struct.error, IndexError) as e:
+        # Not routed to the default wallet: it would skip the checks of the keys
+        raise PSBTSerializationError(f"psbt can't be parsed: {getattr(e, 'message', e)}")
+
+    wallets = set()
+    for fingerprints in inputs_fingerprints:
+        tenants = TENANTS.matching(fingerprints)
+        if len(tenants) > 1:
+            raise UnsafePSBTError(psbt, f"PSBT spends from several tenants: {', '.join(t.name for t in tenants)}")
+        if not tenants and RESIGNER_FINGERPRINTS and not fingerprints & RESIGNER_FINGERPRINTS:
+            raise UnsafePSBTError(psbt, "PSBT has an input that doesn't involve the resigner's keys")
+        wallets.add(tenants[0] if tenants else None)
+    if len(wallets) > 1:
+        raise UnsafePSBTError(psbt, "PSBT spends from several wallets")
+    return wallets.pop() if wallets else None
+
+
+@contextlib.contextmanager
+def routed_wallet(
+    tenant: Optional[Tenant], config: Configuration, policy_handler: PolicyHandler
+) -> Iterator[Tuple[Configuration, PolicyHandler, ProcessLock]]:
+    """
+    The configuration, policies and spend lock of the wallet `route_psbt` returned: the
+    default one (`config`, `policy_handler`) for None. Its database is used within.
+    """
+    if tenant is None:
+        yield config, policy_handler, SPEND_LOCK
+        return
+    with Session.use(tenant.database):
+        yield tenant.config, tenant.policy_handler, tenant.spend_lock
+
+
+def process_psbt(
+    args: dict,
+    config: Configuration,
+    policy_handler: PolicyHandler,
+    lock: ProcessLock,
+    request_timestamp: int
+) -> dict:
+    """Analyse, check against the policies, sign and record a PSBT. Returns the signed PSBT."""
+    logger = config.get("logger")
+    deadline = request_deadline(args, config)
+    with deadline:
+        with span("psbt_lookups"):
+            lookups = psbt_lookups(args["psbt"], config.get("bitcoind")["client"], deadline)
+
+    # A spend is analysed and checked against the limits only once the previous one is recorded
+    with spend_lock(deadline, lock):
+        with deadline:
+            with span("analyse_psbt"):
+                psbt_obj = analyse_psbt_lookups(args["psbt"], lookups, owned_only=routing_enabled())
+            try:
+                with span("policies"):
+                    policy_handler.run({"psbt": psbt_obj}, deadline=deadline)
+            except PolicyException as e:
+                raise PolicyException(e.message, e.policy)
+
+            # Todo: check if the psbt was actually signed.
+            logger.info("Signing PSBT: %s", psbt_summary(args["psbt"]), extra=PSBT_LOG)
+            with span("sign_transaction"):
+                result = sign_transaction(args["psbt"], config, deadline)
+
+        # The psbt is signed at this point, the spend has to be recorded whatever the time left.
+        if result["complete"] is not True:
+            logger.info("Signed PSBT: %s not complete", psbt_summary(result["psbt"]), extra=PSBT_LOG)
+            # Todo: should fail here
+            pass
+
+        with span("persist"):
+            record_signed_spend(psbt_obj, result["psbt"], request_timestamp, logger)
+    return result
+
+
+# Most psbts a batch request may hold
+MAX_BATCH_SIZE = 100
+
+# Errors failing a single psbt of a batch
+BATCH_ITEM_ERRORS = (UtxoError, UnsafePSBTError, PolicyException, DeadlineExceededError, BitcoindRPCError, ServerError)
+
+
+def batch_item_error(e: Exception) -> dict:
+    """The result of a psbt of a batch failing with `e`, as the error handlers answer it alone"""
+    if isinstance(e, UtxoError):
+        return {"error_code": 403, "message": e.message, "details": {"txid": e.txid, "vout": e.vout}}
+    if isinstance(e, (UnsafePSBTError, PolicyException)):
+        return {"error_code": 403, "message": e.message}
+    if isinstance(e, PSBTSerializationError):
+        return {"error_code": 400, "message": e.message}
+    if isinstance(e, DeadlineExceededError):
+        return {"error_code": 504, "message": e.message}
+    return {"error_code": 500, "message": f"Internal Server Error: {e}"}
+
+
+def process_psbt_batch(
+    args: dict,
+    config: Configuration,
+    policy_handler: PolicyHandler,
+    request_timestamp: int
+) -> list:
+    """
+    `process_psbt` of each psbt of `args["psbts"]`, with the rpcs of the batch shared and
+    the spends checked against the limits cumulatively, in submission order. Returns the
+    result of each psbt: the signed psbt, or the error it failed with.
+    """
+    psbts = args["psbts"]
+    deadline = request_deadline(args, config)
+    results = [None] * len(psbts)
+
+    # The psbts of each wallet, in submission order
+    wallets = {}
+    for i, psbt in enumerate(psbts):
+        try:
+            wallets.setdefault(route_psbt(psbt), []).append(i)
+        except (UnsafePSBTError, PSBTSerializationError) as e:
+            results[i] = batch_item_error(e)
+
+    for tenant, indexes in wallets.items():
+        with routed_wallet(tenant, config, policy_handler) as (wallet_config, wallet_policies, lock):
+            process_wallet_batch(
+                psbts, indexes, results, wallet_config, wallet_policies, lock, deadline, request_timestamp
+            )
+    return results
+
+
+def process_wallet_batch(
+    psbts: list,
+    indexes: list,
+    results: list,
+    config: Configuration,
+    policy_handler: PolicyHandler,
+    lock: ProcessLock,
+    deadline: Deadline,
+    request_timestamp: int
+):
+    """Process the psbts of a batch at `indexes`, all of the same wallet, writing their `results`"""
+    logger = config.get("logger")
+    btd_client = config.get("bitcoind")["client"]
+    lookups = wallet_batch_lookups(psbts, indexes, results, btd_client, deadline)
+    if lookups is None:
+        return
+
+    # The whole batch is checked and recorded before the next spend is
+    with spend_lock(deadline, lock):
+        accepted = check_batch_policies(psbts, indexes, lookups, results, policy_handler, deadline)
+        if accepted:
+            sign_wallet_batch(accepted, results, btd_client, deadline, request_timestamp, logger)
+
+
+def sign_wallet_batch(
+    accepted: List[Tuple[int, ResignerPsbt]],
+    results: list,
+    btd_client: BitcoindRPC,
+    deadline: Deadline,
+    request_timestamp: int,
+    logger: logging.Logger
+):
+    """Sign and record the `accepted` psbts of a wallet's batch, under its spend lock"""
+    try:
+        with deadline:
+            with span("sign_transaction"):
+                deadline.check("signing")
+                signed = btd_client.batch_call(
+                    "walletprocesspsbt", [[psbt_obj.psbt_str, True, "ALL", True] for _, psbt_obj in accepted]
+                )
+    except DeadlineExceededError as e:
+        for i, _ in accepted:
+            results[i] = batch_item_error(e)
+        return
+
+    # The psbts are signed at this point, the spends have to be recorded whatever the time left.
+    for (i, psbt_obj), result in zip(accepted, signed):
+        if isinstance(result, BitcoindRPCError):
+            results[i] = batch_item_error(result)
+            continue
+        if result["complete"] is not True:
+            logger.info("Signed PSBT: %s not complete", psbt_summary(result["psbt"]), extra=PSBT_LOG)
+        with span("persist"):
+            record_signed_spend(psbt_obj, result["psbt"], request_timestamp, logger)
+        results[i] = {"psbt": result["psbt"], "signed": True}
+
+
+def wallet_batch_lookups(
+    psbts: list,
+    indexes: list,
+    results: list,
+    btd_client: BitcoindRPC,
+    deadline: Deadline
+) -> Optional[list]:
+    """
+    `batch_psbt_lookups` of the psbts of a wallet's batch, within what is left of the budget,
+    which the previous wallets' psbts may have spent. None, with the psbts' `results` set to
+    the error, once it is spent: the psbts of the other wallets keep their results.
+    """
+    try:
+        with deadline:
+            with span("analyse_psbt"):
+                return batch_psbt_lookups([psbts[i] for i in indexes], btd_client, deadline)
+    except DeadlineExceededError as e:
+        for i in indexes:
+            results[i] = batch_item_error(e)
+        return None
+
+
+def check_batch_policies(
+    psbts: list,
+    indexes: list,
+    lookups: list,
+    results: list,
+    policy_handler: PolicyHandler,
+    deadline: Deadline
+) -> List[Tuple[int, ResignerPsbt]]:
+    """
+    Analyse the psbts of a wallet's batch and check them against its policies, in order:
+    each with the spends of the psbts accepted before it. Returns the accepted ones.
+
+    A psbt spending an output an accepted one spends is rejected: both would be signed,
+    but only one of them can be recorded.
+    """
+    accepted = []
+    pending_sats = 0
+    spent_outpoints = set()
+    for i, item_lookups in zip(indexes, lookups):
+        try:
+            with deadline:
+                if isinstance(item_lookups, BitcoindRPCError):
+                    raise item_lookups
+                outpoints = {(vin["txid"], vin["vout"]) for vin in item_lookups[0]["tx"]["vin"]}
+                if outpoints & spent_outpoints:
+                    raise UnsafePSBTError(psbts[i], "PSBT spends an output spent by an earlier PSBT of the batch")
+                psbt_obj = analyse_psbt_lookups(psbts[i], item_lookups, owned_only=routing_enabled())
+                with span("policies"):
+                    policy_handler.run({"psbt": psbt_obj}, deadline=deadline, pending_sats=pending_sats)
+        except BATCH_ITEM_ERRORS as e:
+            results[i] = batch_item_error(e)
+            continue
+        accepted.append((i, psbt_obj))
+        pending_sats += psbt_obj.amount_sats
+        spent_outpoints |= outpoints
+    return accepted
+
+
+INVALID_TIMEOUT = "timeout must be a positive number of seconds"
+
+
+def valid_timeout(timeout) -> bool:
+    """Whether `timeout` is a timeout a client may supply, if any"""
+    return timeout is None or (
+        not isinstance(timeout, bool) and isinstance(timeout, (int, float)) and timeout > 0
+    )
+
+
+def request_deadline(args: dict, config: Configuration) -> Deadline:
+    """
+    Time budget of a signing request: the configured `request_timeout`, or the
+    `timeout` supplied by the client if it is shorter.
+    """
+    budget = config.get("resigner_config")["request_timeout"]
+    timeout = args.get("timeout")
+    if not valid_timeout(timeout):
+        abort(400, {'message': INVALID_TIMEOUT})
+    if timeout is not None:
+        budget = min(budget, timeout)
+
+    return Deadline(budget)
+
+
+def sampling_profiler(config: Configuration) -> Optional[SamplingProfiler]:
+    profiler = config_section(config, "profiler")
+    if not profiler.get("enabled"):
+        return None
+    return SamplingProfiler(profiler.get("interval", 0.01), profiler.get("max_duration", 60))
+
+
+def finite_float(value) -> float:
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{value} isn't finite")
+    return value
+
+
+def admin_only(app, view):
+    """Only serve `view` to requests bearing the `[admin] token` of the configuration"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = config_section(app.config["route_args"]["config"], "admin")["token"]
+        given = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+            return jsonify(error_code=401, message="Unauthorized"), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def setup_admin(app):
+    """Diagnostics endpoints, only served when an admin token is configured"""
+    if not config_section(app.config["route_args"]["config"], "admin").get("token"):
+        return
+    add_flight_recorder_route(app)
+    add_profiler_route(app)
+
+
+def add_flight_recorder_route(app):
+    @app.route('/admin/flight-recorder')
+    @functools.partial(admin_only, app)
+    def flight_recorder():
+        recorder = app.config["route_args"]["flight_recorder"]
+        if recorder is None:
+            return jsonify(error_code=404, message="The flight recorder isn't enabled"), 404
+        response = jsonify(recorder.snapshot())
+        response.headers["Content-Disposition"] = f"attachment; filename=flight-{time.strftime('%Y%m%dT%H%M%S')}.json"
+        return response
+
+
+def add_profiler_route(app):
+    profiler = sampling_profiler(app.config["route_args"]["config"])
+
+    @app.route('/admin/profile')
+    @functools.partial(admin_only, app)
+    def profile():
+        if profiler is None:
+            return jsonify(error_code=404, message="The profiler isn't enabled"), 404
+        try:
+            seconds, interval = (
+                finite_float(request.args.get("seconds", 10)), finite_float(request.args.get("interval", profiler.interval))
+            )
+        except ValueError:
+            return jsonify(error_code=400, message="seconds and interval must be numbers"), 400
+        stacks = profiler.profile(seconds, interval)
+        if stacks is None:
+            return jsonify(error_code=409, message="A profile is already running"), 409
+        response = app.response_class(profiler.collapsed(stacks), content_type="text/plain; charset=utf-8")
+        response.headers["Content-Disposition"] = f"attachment; filename=profile-{time.strftime('%Y%m%dT%H%M%S')}.folded"
+        return response
+
+
 def create_route(app):
     @app.route('/swagger')
     def swagger_ui():
@@ -126,53 +718,36 @@ def create_route(app):
         request_timestamp = math.floor(time.time() * 1000000)
         policy_handler = app.config["route_args"]["policy_handler"]
         config = app.config["route_args"]["config"]
-        logger = config.get("logger")
 
         args = request.get_json()
 
         if not args["psbt"]:
             abort(400, {'message': 'psbt not supplied in request'}) 
-        
-        psbt_obj = analyse_psbt_from_base64_str(args["psbt"], config)
 
-        try:
-            policy_handler.run({"psbt": psbt_obj})
-        except PolicyException as e:
-            raise PolicyException(e.message, e.policy)
-
-        # Todo: check if the psbt was actually signed.
-        signed = False
-        logger.info("Signing PSBT: %s...%s", args["psbt"][0:9], args["psbt"][-10:])
-        result = sign_transaction(args["psbt"], config)
-        if result["complete"] is not True:
-            logger.info("Signed PSBT: %s...%s not complete", result[0:9], result[-10:])
-            # Todo: should fail here
-            pass
+        with routed_wallet(route_psbt(args["psbt"]), config, policy_handler) as (wallet_config, wallet_policies, lock):
+            result = process_psbt(args, wallet_config, wallet_policies, lock, request_timestamp)
 
-        SignedSpends.insert(
-                psbt_obj.txid,
-                args["psbt"],
-                result["psbt"],
-                psbt_obj.amount_sats,
-                request_timestamp,
-                False
-        )
+        # Due to bitcoind policies we don't actually know if the psbt was signed. we only know that it didn't throw an error
+        return jsonify(psbt=result["psbt"], signed=True)
 
-        for utxo in psbt_obj.utxos:
-            SpentUtxos.insert(utxo["txid"], utxo["vout"], psbt_obj.txid)
+    add_batch_route(app)
 
-        logger.info("Updating aggregate spends, amount: %d", psbt_obj.amount_sats)
-        agg_spends = AggregateSpends.get()[0]
-        AggregateSpends.update(
-            {
-                "unconfirmed_daily_spends": agg_spends["unconfirmed_daily_spends"] + psbt_obj.amount_sats,
-                "unconfirmed_weekly_spends": agg_spends["unconfirmed_weekly_spends"] + psbt_obj.amount_sats,
-                "unconfirmed_monthly_spends": agg_spends["unconfirmed_monthly_spends"] + psbt_obj.amount_sats
-            }
-        )
 
-        # Due to bitcoind policies we don't actually know if the psbt was signed. we only know that it didn't throw an error
-        return jsonify(psbt=result["psbt"], signed=True)
+def add_batch_route(app):
+    @app.route('/process-psbt/batch', methods=['POST'])
+    def ProcessPsbtBatch():
+        request_timestamp = math.floor(time.time() * 1000000)
+        policy_handler = app.config["route_args"]["policy_handler"]
+        config = app.config["route_args"]["config"]
+
+        args = request.get_json()
+        psbts = args.get("psbts") if isinstance(args, dict) else None
+        if not isinstance(psbts, list) or not psbts or not all(isinstance(psbt, str) and psbt for psbt in psbts):
+            abort(400, {'message': 'psbts must be a non-empty array of psbts'})
+        if len(psbts) > MAX_BATCH_SIZE:
+            abort(400, {'message': f'A batch holds at most {MAX_BATCH_SIZE} psbts'})
+
+        return jsonify(results=process_psbt_batch(args, config, policy_handler, request_timestamp))
 
 
 def create_app(config: Configuration, policy_handler: PolicyHandler, debug=True)-> Flask:
@@ -185,6 +760,9 @@ def create_app(config: Configuration, policy_handler: PolicyHandler, debug=True)
     app.config["route_args"] = {"config": config, "policy_handler": policy_handler}
 
     setup_error_handlers(app)
+    setup_tracing(app)
+    setup_metrics(app)
+    setup_admin(app)
     create_route(app)
     return app
 
@@ -194,19 +772,47 @@ def init_db():
     SpentUtxos.create()
     SignedSpends.create()
     AggregateSpends.create()
+    Leases.create()
 
     # Insert the only record in AggregateSpends Table
     if not AggregateSpends.get():
         AggregateSpends.insert()
 
 
-def local_main(debug: Optional[bool] = False, port: Optional[int] = 7767):
-    # Setup args
-    parser = argparse.ArgumentParser(description='Signing Service for Miniscript Policies.')
-    parser.add_argument('--config_path', type=str, help='configuration path')
-   
-    config_path =  os.getenv("RESIGNER_CONFIG_PATH") or parser.parse_args().config_path
+def daemon_lease(config: Configuration) -> Lease:
+    """The lease of the instance running the daemon, among those sharing the database"""
+    settings = config_section(config, "daemon")
+    return Lease(
+        "daemon",
+        float(settings.get("lease_ttl", DEFAULT_LEASE_TTL)),
+        max_clock_skew=float(settings.get("max_clock_skew", DEFAULT_MAX_CLOCK_SKEW))
+    )
+
+
+def wait_for_daemon_sync(config: Configuration, logger: logging.Logger):
+    """Start the daemon, and wait for the first sync of the db with the chain, its own or the leader's"""
+    condition = threading.Condition()
+    lease = daemon_lease(config)
+    threading.Thread(target=elected_daemon, args=([config, condition, lease]), daemon=True).start()
+    # The leader ships the database to the standby
+    start_shipping(config_section(config, "standby"), lease)
+
+    start_sync_time = time.time()
+    def db_is_synced() -> bool:
+        logger.info(f"syncing db with onchain data took : {time.time() - start_sync_time} seconds")
+        return config.get("resigner_config")["synced_db_with_onchain_data"]
+
+    #Wait on db to sync with the blockchain
+    with condition:
+        condition.wait_for(db_is_synced)
 
+
+def start_resigner(config_path: Optional[str], start_daemon: bool = True) -> Tuple[Configuration, PolicyHandler]:
+    """
+    Load the configuration, sync the database with the chain and start the daemon:
+    everything but serving requests. Without `start_daemon`, the database is synced once
+    and the daemon left to the caller.
+    """
     if not config_path:
         raise ServerError("Resigner started without configuration path")
 
@@ -218,45 +824,92 @@ def local_main(debug: Optional[bool] = False, port: Optional[int] = 7767):
     btd_client = BitcoindRPC(
         bitcoind['bitcoind_wallet_rpc_url'],
         bitcoind["bitcoind_rpc_user"],
-        bitcoind["bitcoind_rpc_password"]
+        bitcoind["bitcoind_rpc_password"],
+        **bitcoind.get("rpc_options", {})
     )
 
     config.set({"client": btd_client}, "bitcoind")
     
     # Logging
-    logger = setup_logging()
+    logger = setup_logging(settings=config_section(config, "logging"))
     config.set({"logger": logger})
 
     # Init DB
     init_db()
 
+    # A standby promoted to primary catches up before signing anything
+    start_primary(config_section(config, "standby"))
+
+    if config_section(config, "tenants"):
+        TENANTS.load(config, init_db)
+        TENANTS.sync_workers = int(
+            config_section(config, "daemon").get("tenant_sync_workers", DEFAULT_SYNC_WORKERS)
+        )
+    fingerprints = config_section(config, "resigner_config").get("fingerprints")
+    if fingerprints:
+        RESIGNER_FINGERPRINTS.update(wallet_fingerprints(fingerprints, btd_client))
+
+    shared_cache = config_section(config, "shared_cache")
+    if shared_cache:
+        WALLET_UTXOS.path = shared_cache.get("utxos_path", f"{Session.path}.utxos")
+        WALLET_UTXOS.max_age = float(shared_cache.get("max_age", 2 * BLOCK_TIME))
+
     # Set db sync status
     config.set({"synced_db_with_onchain_data": False},"resigner_config")
 
-    
-    # Setup daemon
-    condition = threading.Condition()
-    threading.Thread(target=daemon, args=([config, condition]), daemon=True).start()
-
     logger.info("Syncing db with blockchain. Might take a couple minutes depending on the amount of the utxos")
-    
-    start_sync_time = time.time()
-    def db_is_synced() -> bool:
-        logger.info(f"syncing db with onchain data took : {time.time() - start_sync_time} seconds")
-        return config.get("resigner_config")["synced_db_with_onchain_data"]
-
-    #Wait on db to sync with the blockchain
-    with condition:
-        condition.wait_for(db_is_synced)
+    if start_daemon:
+        wait_for_daemon_sync(config, logger)
+    else:
+        sync_once(config)
 
     # Setup PolicyHandler
+    spend_limit = SpendLimit(config)
     policy_handler = PolicyHandler()
     policy_handler.register_policy(
         [
-            SpendLimit(config),
+            spend_limit,
         ]
     )
 
+    replication = config_section(config, "replication")
+    if replication and len(TENANTS):
+        # The counters only hold the default wallet's spends
+        raise ServerError("Spend counters replication isn't supported with tenants")
+    if replication:
+        SPEND_REPLICA.start(replication, lambda: spend_limit.t_struct)
+        # The spends recorded before replication was enabled still count
+        SPEND_REPLICA.seed(spend_limit.aggregate_totals())
+    return config, policy_handler
+
+
+def follow_standby(config_path: Optional[str]):
+    """Run as the standby of a primary, see src/standby.py"""
+    if not config_path:
+        raise ServerError("Resigner started without configuration path")
+    config = Configuration(config_path)
+    setup_logging(settings=config_section(config, "logging"))
+    settings = config_section(config, "standby")
+    if not settings.get("apply_from"):
+        raise ServerError("A standby needs `apply_from` in the [standby] section")
+
+    init_db()
+    follow_primary(settings)
+
+
+def local_main(debug: Optional[bool] = False, port: Optional[int] = 7767):
+    # Setup args
+    parser = argparse.ArgumentParser(description='Signing Service for Miniscript Policies.')
+    parser.add_argument('--config_path', type=str, help='configuration path')
+    parser.add_argument('--standby', action='store_true', help='apply the snapshots shipped by the primary')
+    args = parser.parse_args()
+
+    config_path =  os.getenv("RESIGNER_CONFIG_PATH") or args.config_path
+    if args.standby:
+        follow_standby(config_path)
+        return
+    config, policy_handler = start_resigner(config_path)
+
     app = create_app(config, policy_handler)
 
     app.run(debug=debug, port=port)    
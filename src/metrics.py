@@ -0,0 +1,215 @@
+"""
+Process metrics, exposed at /metrics in the OpenMetrics text format.
+
+Metrics are module level objects updated where the measured work happens. Values only
+known to other components (cache counters, spend totals) are read when the metrics are
+scraped, from the function given to `Metric.set_function`.
+"""
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Upper bounds of the histogram buckets, in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, object] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]):
+        """
+        Read the values when scraped: `function` returns them by tuple of label values,
+        `()` for a metric without labels. Replaces the previous function.
+        """
+        self._function = function
+
+    def value(self, **labels) -> Optional[float]:
+        return self._values.get(self._key(labels))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            values = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        suffix = "_total" if self.type == "counter" else ""
+        return [
+            f"{self.name}{suffix}{_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = REQUEST_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def set_function(self, function):
+        raise TypeError("histograms can't be read from a function")
+
+    def value(self, **labels) -> Optional[Tuple[int, float]]:
+        """(count, sum) of the observations"""
+        with self._lock:
+            found = self._values.get(self._key(labels))
+        return (sum(found[0]), found[1]) if found is not None else None
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, key + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(total)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def render(self) -> str:
+        """All the metrics in the OpenMetrics text format"""
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A value that can't be read (bitcoind down, ...) must not fail the whole scrape
+                samples = []
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.extend(samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = Counter(
+    "resigner_http_requests", "HTTP requests handled, by route, status code and rejecting policy",
+    ["endpoint", "status", "policy"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "resigner_http_request_duration_seconds", "Time spent handling HTTP requests",
+    ["endpoint", "status"]
+)
+RPC_DURATION = Histogram(
+    "resigner_rpc_duration_seconds", "Latency of the rpcs sent to bitcoind, cache hits excluded",
+    ["method", "outcome"]
+)
+RPC_CACHE_LOOKUPS = Counter(
+    "resigner_rpc_cache_lookups", "Lookups of cacheable rpcs in the rpc cache", ["result"]
+)
+RPC_CACHE_ENTRIES = Gauge("resigner_rpc_cache_entries", "Results held by the rpc cache")
+DB_QUERY_DURATION = Histogram(
+    "resigner_db_query_duration_seconds", "Time spent executing SQLite statements",
+    ["operation", "table"], buckets=DB_BUCKETS
+)
+DB_COMMIT_DURATION = Histogram(
+    "resigner_db_commit_duration_seconds", "Time spent committing SQLite transactions", buckets=DB_BUCKETS
+)
+DAEMON_JOB_DURATION = Histogram(
+    "resigner_daemon_job_duration_seconds", "Duration of the daemon's sync jobs", ["job", "outcome"],
+    buckets=JOB_BUCKETS
+)
+SYNC_HEIGHT = Gauge("resigner_sync_height", "Chain height at the start of the last completed utxo sync")
+SYNC_LAG = Gauge("resigner_sync_lag_blocks", "Blocks mined since the start of the last completed utxo sync")
+SPEND_WINDOW_SPENT = Gauge(
+    "resigner_spend_window_spent_sats", "Amount spent in the current spend limit window",
+    ["window", "state"]
+)
+SPEND_WINDOW_LIMIT = Gauge("resigner_spend_window_limit_sats", "Configured spend limit", ["window"])
+SPEND_WINDOW_UTILIZATION = Gauge(
+    "resigner_spend_window_utilization_ratio", "Share of the spend limit used in the current window",
+    ["window"]
+)
+LOG_RECORDS_DROPPED = Counter(
+    "resigner_log_records_dropped", "Log records dropped by sampling, rate limits or a full logging queue",
+    ["category", "reason"]
+)
@@ -1,7 +1,7 @@
 import re
 import time
 import logging
-from typing import Any, List, Dict, Optional
+from typing import Any, Iterator, List, Dict, Optional, Tuple
 from sqlite3 import OperationalError
 from threading import RLock
 from .db import Session
@@ -70,6 +70,27 @@ class BaseModel:
         self._cursor.close()
         return result
 
+    @classmethod
+    def batches(self, size: int, args: Optional[List] = None) -> Iterator[List[Dict]]:
+        """
+        Yield the rows of the table `size` at a time, in rowid order, so that a large table
+        is never held in memory at once. No cursor is kept open between two batches: the
+        table may be written to meanwhile.
+        """
+        args = args or self._columns
+        last = 0
+        while True:
+            cursor = Session.execute(
+                f"SELECT rowid, {','.join(args)} From {self._table} WHERE rowid > ? ORDER BY rowid LIMIT ?;",
+                (last, size)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [dict(zip(args, row[1:])) for row in rows]
+
 
     @classmethod
     def update(self, values: Dict, condition: Optional[Dict] = {}):
@@ -170,6 +191,18 @@ class Utxos(BaseModel):
             cursor.close()
             Session.commit()
 
+    @classmethod
+    def insert_many(self, rows: List[Tuple[int, str, int, int]]):
+        """Insert (blockheight, txid, vout, amount_sats) rows in one transaction, skipping known utxos"""
+        sql = f"""INSERT OR IGNORE INTO {self._table} VALUES (NULL,?,?,?,?);"""
+
+        rlock = RLock()
+        with rlock:
+            cursor = Session.cursor()
+            cursor.executemany(sql, rows)
+            cursor.close()
+            Session.commit()
+
 
 class SpentUtxos(BaseModel):
     _table: str = "SPENT_UTXOS"
@@ -245,6 +278,22 @@ class AggregateSpends(BaseModel):
             cursor.close()
             Session.commit()
 
+    @classmethod
+    def add(self, unconfirmed_sats: int = 0, confirmed_sats: int = 0):
+        """Add to the unconfirmed and confirmed spends of every period, in a single statement"""
+        sql = f"""UPDATE {self._table} SET
+        unconfirmed_daily_spends = unconfirmed_daily_spends + :unconfirmed,
+        unconfirmed_weekly_spends = unconfirmed_weekly_spends + :unconfirmed,
+        unconfirmed_monthly_spends = unconfirmed_monthly_spends + :unconfirmed,
+        confirmed_daily_spends = confirmed_daily_spends + :confirmed,
+        confirmed_weekly_spends = confirmed_weekly_spends + :confirmed,
+        confirmed_monthly_spends = confirmed_monthly_spends + :confirmed;
+        """
+        cursor = Session.cursor()
+        cursor.execute(sql, {"unconfirmed": unconfirmed_sats, "confirmed": confirmed_sats})
+        cursor.close()
+        Session.commit()
+
 
 class SignedSpends(BaseModel):
     _table: str = "SIGNED_SPENDS"
@@ -298,4 +347,64 @@ class SignedSpends(BaseModel):
             )
             cursor.close()
             Session.commit()
- 
\ No newline at end of file
+
+    @classmethod
+    def confirm(self, txid: str) -> bool:
+        """Mark the spend `txid` confirmed. Returns whether it wasn't already."""
+        cursor = Session.execute(f"UPDATE {self._table} SET confirmed = 1 WHERE id = ? AND NOT confirmed;", [txid])
+        confirmed = cursor.rowcount == 1
+        cursor.close()
+        Session.commit()
+        return confirmed
+ 
+
+class Leases(BaseModel):
+    _table: str = "LEASES"
+    _primary_key = True
+    _schema: str = """CREATE TABLE LEASES
+        (name VARCHAR PRIMARY KEY NOT NULL,
+        holder VARCHAR NOT NULL,
+        expires_at REAL NOT NULL,
+        term INT NOT NULL,
+        synced_at REAL
+        );
+        """
+    _columns: List = [
+        "name",
+        "holder",
+        "expires_at",
+        "term",
+        "synced_at"
+    ]
+
+    @classmethod
+    def claim(self, name: str, holder: str, now: float, ttl: float, grace: float = 0.0) -> bool:
+        """
+        Take or renew the lease `name` for `holder`, unless someone else holds it or it
+        expired less than `grace` seconds ago. Returns whether it did.
+        """
+        sql = f"""INSERT INTO {self._table} VALUES (?,?,?,1,NULL)
+            ON CONFLICT(name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at,
+                term = term + (holder != excluded.holder)
+            WHERE holder = excluded.holder OR expires_at < ?;"""
+
+        rlock = RLock()
+        with rlock:
+            cursor = Session.cursor()
+            cursor.execute(sql, [name, holder, now + ttl, now - grace])
+            claimed = cursor.rowcount == 1
+            cursor.close()
+            Session.commit()
+        return claimed
+
+    @classmethod
+    def held_by(self, name: str, holder: str, now: float) -> bool:
+        """Whether `holder` holds the lease `name` at `now`"""
+        cursor = Session.execute(
+            f"SELECT 1 FROM {self._table} WHERE name = ? AND holder = ? AND expires_at > ?;", [name, holder, now]
+        )
+        held = cursor.fetchone() is not None
+        cursor.close()
+        return held
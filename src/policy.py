@@ -4,7 +4,10 @@ from typing import List, Dict, Optional
 
 from .config import Configuration
 from .models import AggregateSpends
+from .replication import SPEND_REPLICA
 from .analysis import ResignerPsbt
+from .deadline import Deadline
+from .tracing import span
 
 
 class PolicyException(Exception):
@@ -25,18 +28,23 @@ class Policy():
 
 
 class PolicyHandler:
-    __policy_list = []
+    def __init__(self):
+        # Each tenant has its own policies
+        self.__policy_list = []
 
     def register_policy(self, policy: List[Policy]):
         self.__policy_list.append(*policy)
 
-    def run(self, psbt: Optional[ResignerPsbt] = None, **kwargs):
+    def run(self, psbt: Optional[ResignerPsbt] = None, deadline: Optional[Deadline] = None, **kwargs):
         if psbt is None:
             raise TypeError("psbt must not be None")
         for policy in self.__policy_list:
-            if policy.is_defined:
-                if not policy.execute_policy(psbt=psbt, **kwargs):
-                    raise PolicyException(f"PSBT Failed to satisfy configured {policy._name} policy", policy._name)
+            if deadline is not None:
+                deadline.check(f"{policy._name} policy")
+            with span(f"policy {policy._name}"):
+                if policy.is_defined:
+                    if not policy.execute_policy(psbt=psbt, **kwargs):
+                        raise PolicyException(f"PSBT Failed to satisfy configured {policy._name} policy", policy._name)
 
 class SpendLimit(Policy):
     _name: str = "SpendLimit"
@@ -68,12 +76,26 @@ class SpendLimit(Policy):
         psbt=psbt["psbt"]
         condition: List[bool] = []
 
-        if self.is_defined():
-            aggregate_spend = AggregateSpends.get([])[0]
+        if self.is_defined() and SPEND_REPLICA.enabled:
+            # The spends of every instance
+            totals = SPEND_REPLICA.totals(
+                {"daily": self.daily_limit, "weekly": self.weekly_limit, "monthly": self.monthly_limit}
+            )
+            total_daily_spends = totals["daily"]
+            total_weekly_spends = totals["weekly"]
+            total_monthly_spends = totals["monthly"]
+        elif self.is_defined():
+            totals = self.aggregate_totals()
+            total_daily_spends = totals["daily"]
+            total_weekly_spends = totals["weekly"]
+            total_monthly_spends = totals["monthly"]
 
-            total_daily_spends = aggregate_spend["confirmed_daily_spends"] + aggregate_spend["unconfirmed_daily_spends"]
-            total_weekly_spends = aggregate_spend["confirmed_weekly_spends"] + aggregate_spend["unconfirmed_weekly_spends"]
-            total_monthly_spends = aggregate_spend["confirmed_weekly_spends"] + aggregate_spend["unconfirmed_weekly_spends"]
+        if self.is_defined():
+            # Spends accepted earlier in the same batch, not recorded yet
+            pending_sats = kwargs.get("pending_sats", 0)
+            total_daily_spends += pending_sats
+            total_weekly_spends += pending_sats
+            total_monthly_spends += pending_sats
 
             if self.daily_limit > 0:
                 condition.append((total_daily_spends <= self.daily_limit and
@@ -91,6 +113,20 @@ class SpendLimit(Policy):
 
         return all(condition)
 
+    def aggregate_totals(self) -> Dict[str, int]:
+        """The spends of each window recorded in this instance's database"""
+        aggregate_spend = AggregateSpends.get([])[0]
+        return {
+            "daily": aggregate_spend["confirmed_daily_spends"] + aggregate_spend["unconfirmed_daily_spends"],
+            "weekly": aggregate_spend["confirmed_weekly_spends"] + aggregate_spend["unconfirmed_weekly_spends"],
+            "monthly": aggregate_spend["confirmed_monthly_spends"] + aggregate_spend["unconfirmed_monthly_spends"],
+        }
+
+    @property
+    def t_struct(self) -> time.struct_time:
+        """The time the spend windows are measured in"""
+        return self.__t_struct
+
     @property
     def __t_struct(self):
         if "use_servertime" not in self._config.get("resigner_config"):
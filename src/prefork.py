@@ -0,0 +1,56 @@
+"""
+Pre-fork multi-worker mode.
+
+The app is loaded and the database synced once, in the master process, then forked into
+workers (see src/wsgi.py). Every worker then:
+- reopens its database connection, restarts the logging thread and the rpc thread pool,
+  none of which survive a fork;
+- takes part in the election of the daemon (`elected_daemon`): the worker holding the
+  daemon lease in the database runs it, the others take over if it stops renewing it.
+
+The spend limits hold across workers: the policies, the signing and the recording of a
+spend are done under a lock shared by the workers (`SPEND_LOCK`), one spend at a time.
+The rpc cache is each worker's own, it only holds results that don't change until the
+next block.
+"""
+import threading
+
+from .config import Configuration
+from .daemon import elected_daemon
+from .db import Session
+from .errors import ServerError
+from .logs import restart_async_logging
+from .main import SPEND_LOCK, config_section, daemon_lease
+from .replication import SPEND_REPLICA
+from .standby import start_shipping
+from .tenants import TENANTS
+
+
+def lock_path(name: str) -> str:
+    """A lock file next to the database, shared by the workers of a deployment"""
+    return f"{Session.path}.{name}.lock"
+
+
+def prepare_prefork():
+    """In the master, before forking: spends are checked and recorded across workers"""
+    if SPEND_REPLICA.enabled:
+        # The counters live in the memory of one process
+        raise ServerError("Spend counters replication isn't supported with multiple workers")
+    SPEND_LOCK.path = lock_path("spend")
+    for tenant in TENANTS:
+        tenant.spend_lock.path = lock_path(f"spend.{tenant.name}")
+
+
+def after_fork(config: Configuration):
+    """In a worker, right after the fork"""
+    Session.reconnect()
+    restart_async_logging()
+    config.get("bitcoind")["client"].after_fork()
+    TENANTS.reconnect()
+
+    lease = daemon_lease(config)
+    threading.Thread(
+        target=elected_daemon, args=(config, threading.Condition(), lease),
+        name="daemon-election", daemon=True
+    ).start()
+    start_shipping(config_section(config, "standby"), lease)
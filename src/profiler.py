@@ -0,0 +1,84 @@
+"""
+A sampling profiler for the running signer.
+
+Samples the stacks of every thread (Flask's request threads, the daemon and its jobs)
+from `sys._current_frames()` at a fixed interval, and aggregates them as collapsed
+stacks: one `thread;outer frame;...;inner frame count` line per distinct stack, the
+input format of flamegraph.pl, speedscope and most flamegraph viewers.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Optional
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@lru_cache(maxsize=4096)
+def _short_filename(filename: str) -> str:
+    if filename.startswith(PACKAGE_ROOT + os.sep):
+        return filename[len(PACKAGE_ROOT) + 1:]
+    _, found, module = filename.rpartition("site-packages" + os.sep)
+    return module if found else os.path.basename(filename)
+
+
+@lru_cache(maxsize=4096)
+def _frame_label(code) -> str:
+    # Semicolons separate the frames of a collapsed stack
+    return f"{code.co_name} ({_short_filename(code.co_filename)})".replace(";", ":")
+
+
+def collapsed_stack(thread_name: str, frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(thread_name.replace(";", ":").replace(" ", "_"))
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler:
+    """
+    Profiles one duration at a time, from the thread calling `profile` which is left out
+    of the samples. Nothing runs between profiles.
+    """
+    def __init__(self, interval: float = 0.01, max_duration: float = 60.0):
+        self.interval = interval
+        self.max_duration = max_duration
+        self._running = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._running.locked()
+
+    def sample(self, stacks: Counter, ignore: int):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != ignore:
+                stacks[collapsed_stack(names.get(ident, f"thread-{ident}"), frame)] += 1
+
+    def profile(self, duration: float, interval: Optional[float] = None) -> Optional[Dict]:
+        """
+        Sample for `duration` seconds (capped at `max_duration`). Returns None if another
+        profile is running, the stacks and how many times each was seen otherwise.
+        """
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            interval = min(max(interval or self.interval, 0.001), 1.0)
+            deadline = time.monotonic() + min(duration, self.max_duration)
+            stacks = Counter()
+            me = threading.get_ident()
+            while time.monotonic() < deadline:
+                self.sample(stacks, me)
+                time.sleep(interval)
+            return stacks
+        finally:
+            self._running.release()
+
+    @staticmethod
+    def collapsed(stacks: Dict) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
@@ -23,7 +23,7 @@ from typing import (
     Union,
 )
 
-from .key import KeyOriginInfo
+from .crypto.key import KeyOriginInfo
 from .errors import PSBTSerializationError
 from .tx import (
     COutPoint,
@@ -32,7 +32,7 @@ from .tx import (
     CTxInWitness,
     CTxOut,
 )
-from ._serialize import (
+from .crypto._serialize import (
     deser_compact_size,
     deser_string,
     Readable,
@@ -939,13 +939,9 @@ class PSBT(object):
         # separator
         r += b"\x00"
 
-        # inputs
-        for input in self.inputs:
-            r += input.serialize()
-
-        # outputs
-        for output in self.outputs:
-            r += output.serialize()
+        # inputs and outputs, joined at once: appending them one by one is quadratic
+        r += b"".join([input.serialize() for input in self.inputs])
+        r += b"".join([output.serialize() for output in self.outputs])
 
         # return hex string
         return base64.b64encode(r).decode()
@@ -0,0 +1,211 @@
+"""
+Spend-window totals replicated across resigner instances that don't share a database.
+
+Every instance keeps, for each spend window period (the day, week and month in progress),
+a PN-counter: a grow-only counter of the amounts it spent and one of the amounts it took
+back (a replaced PSBT), per instance. Instances send their counters to their peers over
+UDP every `gossip_interval`; merging takes the highest value seen of each instance's
+counters, so the merged view is the same whatever the order, repetition or loss of
+messages. The spend limits are checked against the merged totals.
+
+While a peer hasn't been heard from for `peer_timeout`, it might be spending on its side
+of a partition: `partition_reserve` of each limit is counted as spent for each such peer.
+"""
+import os
+import hmac
+import time
+import socket
+import hashlib
+import datetime
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger("resigner.replication")
+
+MAC_SIZE = 32
+MAX_DATAGRAM = 65507
+
+# window: (period, {node: [spent, taken back]})
+Counters = Dict[str, Tuple[str, Dict[str, List[int]]]]
+
+
+def spend_periods(t: time.struct_time) -> Dict[str, str]:
+    """The period of each spend window in progress at `t`"""
+    # Weeks start on mondays, like the resets of the aggregate spends. The ISO week keeps
+    # a week that spans two years whole.
+    iso_year, iso_week, _ = datetime.date(t.tm_year, t.tm_mon, t.tm_mday).isocalendar()
+    return {
+        "daily": f"{t.tm_year}-{t.tm_yday}",
+        "weekly": f"{iso_year}-W{iso_week}",
+        "monthly": f"{t.tm_year}-{t.tm_mon}",
+    }
+
+
+def merge_counters(ours: Counters, theirs: Counters) -> bool:
+    """Merge `theirs` into `ours`, returns whether `ours` changed"""
+    changed = False
+    for window, (period, nodes) in theirs.items():
+        current = ours.get(window)
+        if current is None or current[0] != period:
+            # A period that ended, or that hasn't started here yet
+            continue
+        for node, (spent, taken_back) in nodes.items():
+            counter = current[1].setdefault(node, [0, 0])
+            if spent > counter[0] or taken_back > counter[1]:
+                counter[0], counter[1] = max(counter[0], spent), max(counter[1], taken_back)
+                changed = True
+    return changed
+
+
+class SpendReplica:
+    """
+    This instance's replica of the spend counters, see the module's documentation.
+    Disabled until `start`ed.
+    """
+    def __init__(self):
+        self.node_id: Optional[str] = None
+        self.peers: List[Tuple[str, int]] = []
+        self.counters: Counters = {}
+        self.last_seen: Dict[str, float] = {}
+        self.gossip_interval = 1.0
+        self.peer_timeout = 10.0
+        self.partition_reserve = 0.0
+        self.state_path: Optional[str] = None
+        self._secret = b""
+        self._clock: Callable[[], time.struct_time] = time.gmtime
+        self._socket: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.node_id is not None
+
+    def configure(self, settings: Dict, clock: Callable[[], time.struct_time] = time.gmtime):
+        self.node_id = settings.get("node_id", socket.gethostname())
+        self.peers = [parse_address(peer) for peer in settings.get("peers", [])]
+        self.gossip_interval = float(settings.get("gossip_interval", 1.0))
+        self.peer_timeout = float(settings.get("peer_timeout", 10.0))
+        self.partition_reserve = float(settings.get("partition_reserve", 0.0))
+        self.state_path = settings.get("state_path")
+        self._secret = settings["secret"].encode()
+        self._clock = clock
+        if self.state_path is not None and os.path.exists(self.state_path):
+            with open(self.state_path, "rb") as f:
+                self.counters = {window: (period, nodes) for window, (period, nodes) in orjson.loads(f.read()).items()}
+        # Peers get a full timeout to show up before their reserve is counted
+        now = time.monotonic()
+        self.last_seen = {f"{host}:{port}": now for host, port in self.peers}
+
+    def start(self, settings: Dict, clock: Callable[[], time.struct_time] = time.gmtime):
+        """Configure the replica and start gossiping with the peers"""
+        self.configure(settings, clock)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(parse_address(settings.get("listen", "0.0.0.0:7768")))
+        threading.Thread(target=self._receive_loop, name="replication-receive", daemon=True).start()
+        threading.Thread(target=self._gossip_loop, name="replication-gossip", daemon=True).start()
+
+    def _roll_over(self):
+        """Drop the counters of the periods that ended"""
+        for window, period in spend_periods(self._clock()).items():
+            if window not in self.counters or self.counters[window][0] != period:
+                self.counters[window] = (period, {})
+
+    def record(self, amount_sats: int):
+        """Count a spend of this instance in every window, a negative amount takes a spend back"""
+        amount_sats = round(amount_sats)
+        with self._lock:
+            self._roll_over()
+            for _, nodes in self.counters.values():
+                counter = nodes.setdefault(self.node_id, [0, 0])
+                counter[0 if amount_sats >= 0 else 1] += abs(amount_sats)
+            self._save()
+
+    def seed(self, totals: Dict[str, int]):
+        """
+        Count this instance's spends of each window recorded before replication was
+        enabled: its counters are raised to `totals` if they are lower.
+        """
+        with self._lock:
+            self._roll_over()
+            for window, total in totals.items():
+                counter = self.counters[window][1].setdefault(self.node_id, [0, 0])
+                counter[0] = max(counter[0], round(total) + counter[1])
+            self._save()
+
+    def silent_peers(self) -> int:
+        deadline = time.monotonic() - self.peer_timeout
+        return sum(1 for seen in self.last_seen.values() if seen < deadline)
+
+    def totals(self, limits: Dict[str, int]) -> Dict[str, int]:
+        """The merged spends of each window, with the reserve of the silent peers"""
+        silent = self.silent_peers()
+        with self._lock:
+            self._roll_over()
+            totals = {
+                window: sum(spent - taken_back for spent, taken_back in nodes.values())
+                for window, (_, nodes) in self.counters.items()
+            }
+        return {
+            window: total + int(silent * self.partition_reserve * limits.get(window, 0))
+            for window, total in totals.items()
+        }
+
+    def message(self) -> bytes:
+        with self._lock:
+            self._roll_over()
+            payload = orjson.dumps({"node": self.node_id, "counters": self.counters})
+        return hmac.new(self._secret, payload, hashlib.sha256).digest() + payload
+
+    def receive(self, datagram: bytes, address: Tuple[str, int]) -> bool:
+        """Merge a peer's message, returns whether it was accepted"""
+        mac, payload = datagram[:MAC_SIZE], datagram[MAC_SIZE:]
+        if not hmac.compare_digest(mac, hmac.new(self._secret, payload, hashlib.sha256).digest()):
+            logger.warning("Dropped a replication message from %s:%d with a wrong signature", *address[:2])
+            return False
+        message = orjson.loads(payload)
+        peer = f"{address[0]}:{address[1]}"
+        if peer in self.last_seen:
+            self.last_seen[peer] = time.monotonic()
+        with self._lock:
+            self._roll_over()
+            if merge_counters(self.counters, message["counters"]):
+                self._save()
+        return True
+
+    def _save(self):
+        if self.state_path is None:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(self.counters))
+        os.replace(tmp_path, self.state_path)
+
+    def _gossip_loop(self):
+        while True:
+            message = self.message()
+            for peer in self.peers:
+                try:
+                    self._socket.sendto(message, peer)
+                except OSError as e:
+                    logger.warning("Failed to send the spend counters to %s:%d: %s", *peer, e)
+            time.sleep(self.gossip_interval)
+
+    def _receive_loop(self):
+        while True:
+            datagram, address = self._socket.recvfrom(MAX_DATAGRAM)
+            try:
+                self.receive(datagram, address)
+            except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                logger.warning("Dropped a malformed replication message from %s:%d: %s", *address[:2], e)
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return socket.gethostbyname(host), int(port)
+
+
+# Disabled until started, see `[replication]` in docs/config.md
+SPEND_REPLICA = SpendReplica()
@@ -0,0 +1,140 @@
+import time
+import threading
+from collections import deque
+from typing import Iterator, Optional
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.2
+# Seconds added to a backend's score for each consecutive failure
+FAILURE_PENALTY = 1.0
+
+
+class RPCBackend:
+    """
+    A single bitcoind RPC endpoint and its health record.
+
+    Every request sent to the endpoint is recorded, successful ones with their latency.
+    After `failure_threshold` consecutive failures the circuit opens and the backend is
+    skipped until `reset_timeout` seconds have passed, at which point a single probe
+    request is let through (half-open). A successful probe closes the circuit again.
+    """
+    def __init__(
+        self,
+        url: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        window: int = 100
+    ):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._latencies = deque(maxlen=window)
+        self._ewma: Optional[float] = None
+        self._failures = 0  # consecutive failures
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"RPCBackend({self.url!r}, state={self.state}, score={self.score:.4f})"
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    @property
+    def score(self) -> float:
+        """Lower is better: the average latency, penalised by consecutive failures."""
+        return (self._ewma or 0.0) + self._failures * FAILURE_PENALTY
+
+    def acquire(self) -> bool:
+        """Return True if a request may be sent to this backend now."""
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        """Seconds left before an open circuit lets a probe through."""
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            if self._ewma is None:
+                self._ewma = latency
+            else:
+                self._ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self._ewma
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                # (Re)open the circuit, a failed probe restarts the cool down.
+                self._opened_at = time.monotonic()
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Latency percentile over the recent successful requests, None without samples."""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class HedgedRequest:
+    """
+    The nodes a hedged request is sent to, shared by the sync and async clients: the
+    healthiest one first, then the next one whenever the requests in flight haven't
+    answered after the first's p95 latency, or all failed.
+    """
+    def __init__(self, candidates: Iterator[RPCBackend], min_delay: float):
+        # The nodes not tried yet
+        self.candidates = candidates
+        self.first = next(candidates)
+        self.delay = max(min_delay, self.first.latency_percentile(95) or 0.0)
+        self.hedged = False
+        # The error of the last request that failed
+        self.error: Optional[BaseException] = None
+
+    @property
+    def timeout(self) -> Optional[float]:
+        """How long to wait for the requests in flight before sending the next one"""
+        return None if self.hedged else self.delay
+
+    def next_backend(self, failed: int, pending: int) -> Optional[RPCBackend]:
+        """
+        The node to send the request to after a wait that ended with `failed` requests
+        failing and `pending` still in flight. None to keep waiting, or if there is no
+        node left.
+        """
+        if failed and pending:
+            return None
+
+        backend = next(self.candidates, None)
+        if backend is not None:
+            self.hedged = self.hedged or not failed
+        elif not failed:
+            self.hedged = True
+        return backend
@@ -0,0 +1,95 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import orjson
+
+
+class RPCCache:
+    """
+    Bounded LRU cache of rpc results that stay valid until the chain tip changes.
+
+    Results are kept serialized, so that callers can't alter a cached value by
+    mutating what they got back.
+    """
+    def __init__(self, max_entries: int = 4096, tip_check_interval: float = 5.0):
+        self.max_entries = max_entries
+        self.tip_check_interval = tip_check_interval
+
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tip: Optional[str] = None
+        self._tip_checked_at: Optional[float] = None
+        # When the tip was checked before the check in progress
+        self._tip_claimed_from: Optional[float] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return True, orjson.loads(value)
+
+    def put(self, key: Hashable, result: Any):
+        value = orjson.dumps(result)
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+
+    def claim_tip_check(self) -> bool:
+        """
+        Whether the chain tip is due for a check, claiming it: the callers waiting on the
+        same check are answered from the cache meanwhile, instead of all checking it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._tip_checked_at is not None and now - self._tip_checked_at < self.tip_check_interval:
+                return False
+            self._tip_claimed_from, self._tip_checked_at = self._tip_checked_at, now
+            return True
+
+    def tip_check_failed(self):
+        """The claimed check couldn't be made, the next caller makes it"""
+        with self._lock:
+            self._tip_checked_at = self._tip_claimed_from
+
+    def set_tip(self, tip: str):
+        """Record the current best block hash, dropping every entry if it changed."""
+        with self._lock:
+            self._tip_checked_at = time.monotonic()
+            if tip != self._tip:
+                self._tip = tip
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
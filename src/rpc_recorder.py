@@ -0,0 +1,110 @@
+import time
+import threading
+from collections import defaultdict, deque
+from typing import Any, Dict, Optional
+
+import httpx
+import orjson
+
+
+def _request_key(path: str, method: str, params: Any) -> bytes:
+    return orjson.dumps([path, method, params])
+
+
+class RPCRecorder:
+    """
+    Append-only log of the rpcs made by a `BitcoindRPC` client.
+
+    One JSON object per line:
+        u: path of the url the rpc was sent to (the wallet)
+        m, p: method and params
+        r, e: result and error returned by bitcoind, or
+        x: name of the httpx exception raised when no answer was received
+        l: latency in seconds
+        t: unix time of the call
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        url: str,
+        method: str,
+        params: Any,
+        latency: float,
+        response: Optional[Dict] = None,
+        exception: Optional[Exception] = None
+    ):
+        entry = {"u": httpx.URL(url).path, "m": method, "p": params}
+        if exception is not None:
+            entry["x"] = type(exception).__name__
+        else:
+            entry["r"] = response["result"]
+            entry["e"] = response["error"]
+        entry["l"] = round(latency, 6)
+        entry["t"] = round(time.time(), 3)
+
+        line = orjson.dumps(entry) + b"\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayTransport(httpx.BaseTransport):
+    """
+    httpx transport answering rpcs from a `RPCRecorder` log instead of a node.
+
+    A request is matched on its url path, method and params. Identical requests get the
+    recorded answers in their original order, the last one being repeated once they are
+    exhausted. Each answer is delayed by its recorded latency times `latency_scale`
+    (0 answers immediately), a batch request by the longest of its answers'.
+    """
+    def __init__(self, path: str, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self._recordings = defaultdict(deque)
+        self._lock = threading.Lock()
+
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = orjson.loads(line)
+                self._recordings[_request_key(entry["u"], entry["m"], entry["p"])].append(entry)
+
+    def _next_recording(self, key: bytes) -> Optional[Dict]:
+        with self._lock:
+            recordings = self._recordings.get(key)
+            if not recordings:
+                return None
+            return recordings.popleft() if len(recordings) > 1 else recordings[0]
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = orjson.loads(request.read())
+        calls = body if isinstance(body, list) else [body]
+        entries = [
+            self._next_recording(_request_key(request.url.path, call["method"], call["params"])) for call in calls
+        ]
+
+        # A batch request is a single round trip
+        latency = max((entry["l"] for entry in entries if entry is not None), default=0)
+        if self.latency_scale:
+            time.sleep(latency * self.latency_scale)
+
+        for entry in entries:
+            if entry is not None and "x" in entry:
+                exception = getattr(httpx, entry["x"], httpx.TransportError)
+                raise exception(f"replayed {entry['x']}", request=request)
+
+        responses = [self._response(call, entry) for call, entry in zip(calls, entries)]
+        return httpx.Response(200, content=orjson.dumps(responses if isinstance(body, list) else responses[0]))
+
+    def _response(self, call: Dict, entry: Optional[Dict]) -> Dict:
+        if entry is None:
+            error = {"code": -32601, "message": f"No recording of {call['method']} with these params"}
+            return {"result": None, "error": error, "id": call["id"]}
+        return {"result": entry["r"], "error": entry["e"], "id": call["id"]}
@@ -214,14 +214,14 @@ def op_nop(stack):
 def op_if(stack, items):
     if len(stack) < 1:
         return False
-    # go through and re-make the items array based on the top stack element
+    # go through and re-make the items deque based on the top stack element
     true_items = []
     false_items = []
     current_array = true_items
     found = False
     num_endifs_needed = 1
     while len(items) > 0:
-        item = items.pop(0)
+        item = items.popleft()
         if item in (99, 100):
             # nested if, we have to go another endif
             num_endifs_needed += 1
@@ -241,23 +241,23 @@ def op_if(stack, items):
         return False
     element = stack.pop()
     if decode_num(element) == 0:
-        items[:0] = false_items
+        items.extendleft(reversed(false_items))
     else:
-        items[:0] = true_items
+        items.extendleft(reversed(true_items))
     return True
 
 
 def op_notif(stack, items):
     if len(stack) < 1:
         return False
-    # go through and re-make the items array based on the top stack element
+    # go through and re-make the items deque based on the top stack element
     true_items = []
     false_items = []
     current_array = true_items
     found = False
     num_endifs_needed = 1
     while len(items) > 0:
-        item = items.pop(0)
+        item = items.popleft()
         if item in (99, 100):
             # nested if, we have to go another endif
             num_endifs_needed += 1
@@ -277,9 +277,9 @@ def op_notif(stack, items):
         return False
     element = stack.pop()
     if decode_num(element) == 0:
-        items[:0] = true_items
+        items.extendleft(reversed(true_items))
     else:
-        items[:0] = false_items
+        items.extendleft(reversed(false_items))
     return True
 
 
@@ -1,9 +1,10 @@
 #This file was modified from the buidl-python project https://github.com/buidl-bitcoin/buidl-python/blob/main/buidl/script.py
+from collections import deque
 from io import BytesIO
 
-from crypto.bech32 import decode_bech32, encode_bech32_checksum
-from crypto.ecc import S256Point
-from helper import (
+from ..crypto.bech32 import decode_bech32, encode_bech32_checksum
+from ..crypto.ecc import S256Point
+from ..helper import (
     decode_base58,
     encode_base58_checksum,
     encode_varstr,
@@ -313,8 +314,8 @@ class Script:
 
     def evaluate(self, tx_obj, input_index):
         # create a copy as we may need to add to this list if we have a
-        # RedeemScript
-        commands = self.commands[:]
+        # RedeemScript. A deque: commands are consumed from the front.
+        commands = deque(self.commands)
         if tx_obj.tx_ins[input_index].witness:
             witness = tx_obj.tx_ins[input_index].witness.clone()
         else:
@@ -323,7 +324,7 @@ class Script:
         altstack = []
         op_lookup = OP_CODE_FUNCTIONS
         while len(commands) > 0:
-            command = commands.pop(0)
+            command = commands.popleft()
             if type(command) == int:
                 # do what the op code says
                 operation = op_lookup[command]
@@ -430,7 +431,7 @@ class Script:
                         # pop off the 1 and start fresh
                         stack.pop()
                         tap_script = witness.tap_script()
-                        commands = witness[:-2] + tap_script.commands[:]
+                        commands = deque(witness[:-2] + tap_script.commands)
                         op_lookup = TAPROOT_OP_CODE_FUNCTIONS
         if len(stack) == 0:
             return False
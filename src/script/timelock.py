@@ -1,5 +1,5 @@
 #This file was modified from the buidl-python project https://github.com/buidl-bitcoin/buidl-python/blob/main/buidl/timelock.py
-from helper import (
+from ..helper import (
     int_to_little_endian,
     little_endian_to_int,
 )
@@ -0,0 +1,182 @@
+"""
+Read-mostly data shared by the processes of a deployment through a memory mapped file.
+
+A `SharedTable` is an open addressing hash table of fixed size keys and values. It is
+written whole by `publish`, to a new file renamed over the previous one, and looked up in
+place by the readers: no copy, no deserialization, and a single copy in memory (the page
+cache) whatever the number of workers. Publishing marks the replaced file as stale, its
+readers map the new one on their next lookup.
+
+The file is only shared by the processes of a host. A table with a `max_age` is ignored by
+its readers once that long has passed since it was published: on a host whose daemon
+stopped publishing, e.g. because the leader runs on another host, it isn't read stale.
+
+The daemon publishes the wallet's utxos after each sync (`WALLET_UTXOS`), the workers check
+the inputs of a PSBT against them without a database query.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
+import threading
+import time
+from typing import Iterable, Optional, Tuple
+
+MAGIC = b"RSGNTAB2"
+# magic, stale, key size, value size, slots, entries, time published
+HEADER = struct.Struct("<8sBxxxIIQQd")
+STALE_OFFSET = 8
+PUBLISHED_AT = struct.Struct("<d")
+PUBLISHED_AT_OFFSET = HEADER.size - PUBLISHED_AT.size
+
+EMPTY = 0
+USED = 1
+
+
+def slot_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SharedTable:
+    """A hash table published by one process and read by the others, see the module's documentation"""
+    def __init__(self, path: Optional[str], key_size: int, value_size: int, max_age: Optional[float] = None):
+        self.path = path
+        # Seconds after which a table that wasn't published again is ignored, None for never
+        self.max_age = max_age
+        self.key_size = key_size
+        self.value_size = value_size
+        self.slot_size = 1 + key_size + value_size
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def publish(self, items: Iterable[Tuple[bytes, bytes]]):
+        """Replace the content of the table with `items`, (key, value) pairs read only once"""
+        slots = 8
+        table = bytearray(HEADER.size + slots * self.slot_size)
+        entries = 0
+        for key, value in items:
+            if 2 * entries >= slots:
+                # Grown as the items come, rather than sized from all of them held in memory
+                slots *= 2
+                table = self._grow(table, slots)
+            offset = self._find(table, slots, key)
+            if table[offset] == EMPTY:
+                entries += 1
+            table[offset] = USED
+            table[offset + 1:offset + self.slot_size] = key + value
+        HEADER.pack_into(table, 0, MAGIC, 0, self.key_size, self.value_size, slots, entries, time.time())
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(table)
+        try:
+            previous = open(self.path, "r+b")
+        except FileNotFoundError:
+            previous = None
+        os.replace(tmp_path, self.path)
+        if previous is not None:
+            with previous:
+                previous.seek(STALE_OFFSET)
+                previous.write(b"\x01")
+
+    def _grow(self, table: bytearray, slots: int) -> bytearray:
+        """`table` rehashed into `slots` slots"""
+        grown = bytearray(HEADER.size + slots * self.slot_size)
+        for offset in range(HEADER.size, len(table), self.slot_size):
+            if table[offset] == USED:
+                slot = table[offset:offset + self.slot_size]
+                new_offset = self._find(grown, slots, bytes(slot[1:1 + self.key_size]))
+                grown[new_offset:new_offset + self.slot_size] = slot
+        return grown
+
+    def _find(self, table, slots: int, key: bytes) -> int:
+        """Offset of the slot of `key`, or of the empty slot it would go in"""
+        if len(key) != self.key_size:
+            raise ValueError(f"keys are {self.key_size} bytes, got {len(key)}")
+        index = slot_hash(key) & (slots - 1)
+        while True:
+            offset = HEADER.size + index * self.slot_size
+            if table[offset] == EMPTY or table[offset + 1:offset + 1 + self.key_size] == key:
+                return offset
+            index = (index + 1) & (slots - 1)
+
+    def _current(self) -> Optional[mmap.mmap]:
+        table = self._map
+        if table is None or table[STALE_OFFSET] != 0:
+            table = self._remap()
+        if table is not None and self.max_age is not None:
+            if time.time() - PUBLISHED_AT.unpack_from(table, PUBLISHED_AT_OFFSET)[0] > self.max_age:
+                # Not published again lately, the readers fall back to the source of the table
+                return None
+        return table
+
+    def _remap(self) -> Optional[mmap.mmap]:
+        with self._lock:
+            if self._map is not None and self._map[STALE_OFFSET] == 0:
+                return self._map
+            # The replaced mapping is closed once the views on it are gone
+            self._map = None
+            try:
+                with open(self.path, "rb") as f:
+                    table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                return None
+            magic, _, key_size, value_size, _, _, _ = HEADER.unpack_from(table)
+            if magic != MAGIC:
+                # Published by an older version, until it is published again
+                return None
+            if (key_size, value_size) != (self.key_size, self.value_size):
+                raise ValueError(
+                    f"{self.path} isn't a table of {self.key_size} bytes keys and {self.value_size} bytes values"
+                )
+            self._map = table
+            return table
+
+    @property
+    def published(self) -> bool:
+        return self.path is not None and self._current() is not None
+
+    def get(self, key: bytes) -> Optional[memoryview]:
+        """The value of `key`, a view on the shared memory. None if absent or nothing was published."""
+        table = self._current() if self.path is not None else None
+        if table is None:
+            return None
+        offset = self._find(table, HEADER.unpack_from(table)[4], key)
+        if table[offset] == EMPTY:
+            return None
+        return memoryview(table)[offset + 1 + self.key_size:offset + self.slot_size]
+
+    def __len__(self) -> int:
+        table = self._current() if self.path is not None else None
+        return HEADER.unpack_from(table)[5] if table is not None else 0
+
+
+# txid, vout
+OUTPOINT = struct.Struct("<32sI")
+# amount in sats, blockheight
+UTXO = struct.Struct("<qi")
+
+
+class WalletUtxos(SharedTable):
+    """The utxos of the wallet, as synced by the daemon in the `Utxos` table"""
+    def __init__(self, path: Optional[str] = None, max_age: Optional[float] = None):
+        super().__init__(path, OUTPOINT.size, UTXO.size, max_age)
+
+    def publish_rows(self, rows: Iterable[dict]):
+        self.publish(
+            (
+                OUTPOINT.pack(bytes.fromhex(row["txid"]), row["vout"]),
+                UTXO.pack(round(row["amount_sats"]), row["blockheight"])
+            )
+            for row in rows
+        )
+
+    def lookup(self, txid: str, vout: int) -> Optional[Tuple[int, int]]:
+        """(amount in sats, blockheight) of the utxo, None if it isn't the wallet's"""
+        value = self.get(OUTPOINT.pack(bytes.fromhex(txid), vout))
+        return UTXO.unpack(value) if value is not None else None
+
+
+# Disabled until given a path, see `[shared_cache]` in docs/config.md
+WALLET_UTXOS = WalletUtxos()
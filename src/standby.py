@@ -0,0 +1,268 @@
+"""
+Warm standby.
+
+The primary ships snapshots of its database to `[standby] ship_to`, a directory the
+standby can read (a network mount, or a directory synced to the standby host). A snapshot
+is a full online backup of the database (SQLite's backup API: consistent, without stopping
+the writers), not the changes since the previous one. It is taken when the database
+changed, at most every `interval` seconds, written next to the previous one then renamed
+over it: the directory always holds a complete one.
+
+Between snapshots, each spend the primary signs is journaled to the same directory, one
+file per spend, before the signed PSBT is returned: a spend whose journal entry can't be
+written is never handed out. The entries a snapshot holds are pruned once it is shipped.
+
+The standby (`resigner.py --standby`) applies every new snapshot to its own database, then
+replays the spends journaled since. On failover it is started as a primary, with the same
+`apply_from`: before serving, it applies the last snapshot and replays every journaled
+spend, and refuses to start if the primary is still shipping meanwhile. It then takes the
+daemon lease over once the primary's expired, and serves right away if the primary synced
+the database with the chain recently.
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import orjson
+
+from .analysis import ResignerPsbt, undo_replaced_spend
+from .db import Session
+from .errors import ServerError
+from .lease import Lease
+from .models import SignedSpends, SpentUtxos, AggregateSpends
+
+logger = logging.getLogger("resigner.standby")
+
+SNAPSHOT = "resigner.db"
+MANIFEST = "manifest.json"
+# Directory of the journaled spends
+JOURNAL = "spends"
+DEFAULT_INTERVAL = 5.0
+# Rounds of catching up a promoted standby tries before giving up
+CATCH_UP_ROUNDS = 3
+
+
+def replace_file(path: str, content: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def ship_snapshot(database_path: str, directory: str, seq: int) -> Dict:
+    """Write a full copy of the database to `directory`, returns its manifest"""
+    tmp_path = os.path.join(directory, f"{SNAPSHOT}.tmp")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    source = sqlite3.connect(database_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(directory, SNAPSHOT))
+
+    manifest = {"seq": seq, "shipped_at": time.time()}
+    replace_file(os.path.join(directory, MANIFEST), orjson.dumps(manifest))
+    return manifest
+
+
+class SpendJournal:
+    """The spends signed with the default wallet, journaled to `[standby] ship_to`"""
+    def __init__(self):
+        self.directory: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def open(self, ship_to: str):
+        self.directory = os.path.join(ship_to, JOURNAL)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def append(self, psbt_obj: ResignerPsbt, signed_psbt: str, request_timestamp: int):
+        """Journal a recorded spend, before its signed psbt is returned. Raises `OSError` on failure."""
+        entry = {
+            "txid": psbt_obj.txid,
+            "psbt": psbt_obj.psbt_str,
+            "signed_psbt": signed_psbt,
+            "amount_sats": psbt_obj.amount_sats,
+            "request_timestamp": request_timestamp,
+            "utxos": [(utxo["txid"], utxo["vout"]) for utxo in psbt_obj.utxos],
+        }
+        # Written under the spend lock: the names sort in the order the spends were signed
+        replace_file(os.path.join(self.directory, f"{time.time_ns():020d}-{psbt_obj.txid}.json"), orjson.dumps(entry))
+
+
+def journal_names(directory: str) -> List[str]:
+    """The entries of the journal in `directory`, in the order they were written"""
+    try:
+        return sorted(name for name in os.listdir(os.path.join(directory, JOURNAL)) if name.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+
+def read_journal(directory: str, names: List[str]) -> Iterator[Tuple[str, Dict]]:
+    """The entries `names` of the journal in `directory`, but those pruned meanwhile"""
+    for name in names:
+        try:
+            with open(os.path.join(directory, JOURNAL, name), "rb") as f:
+                yield name, orjson.loads(f.read())
+        except FileNotFoundError:
+            # In a snapshot shipped since
+            continue
+
+
+def prune_journal(directory: str, names: List[str]):
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, JOURNAL, name))
+        except FileNotFoundError:
+            pass
+
+
+def ship_journaled(database_path: str, directory: str, seq: int) -> Dict:
+    """Ship a snapshot, then prune the journaled spends it holds. Returns its manifest."""
+    # Recorded before they were journaled, so in the snapshot
+    journaled = journal_names(directory)
+    manifest = ship_snapshot(database_path, directory, seq)
+    prune_journal(directory, journaled)
+    return manifest
+
+
+def ship_snapshots(directory: str, interval: float, lease: Optional[Lease] = None):
+    """Ship a full snapshot whenever the database changed, while this instance holds `lease`"""
+    os.makedirs(directory, exist_ok=True)
+    seq = 0
+    shipped_version = None
+    while True:
+        if lease is None or lease.held:
+            # Every commit writes to the database file
+            stat = os.stat(Session.path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            if version != shipped_version:
+                try:
+                    seq += 1
+                    ship_journaled(Session.path, directory, seq)
+                    shipped_version = version
+                except (OSError, sqlite3.Error) as e:
+                    logger.error("Failed to ship a snapshot of the database to %s: %s", directory, e)
+        else:
+            # The next leader ships
+            shipped_version = None
+        time.sleep(interval)
+
+
+def start_primary(settings: Dict):
+    """
+    Before serving: catch up with what the primary shipped when this is a standby promoted to
+    primary, and journal the spends signed when this instance ships snapshots.
+    """
+    if settings.get("apply_from"):
+        catch_up(settings)
+    if settings.get("ship_to"):
+        SPEND_JOURNAL.open(settings["ship_to"])
+
+
+def start_shipping(settings: Dict, lease: Optional[Lease] = None):
+    if settings.get("ship_to"):
+        interval = float(settings.get("interval", DEFAULT_INTERVAL))
+        threading.Thread(
+            target=ship_snapshots, args=(settings["ship_to"], interval, lease), name="standby-shipping", daemon=True
+        ).start()
+
+
+def read_manifest(directory: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(directory, MANIFEST), "rb") as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+
+
+def apply_snapshot(directory: str):
+    """Replace the content of the database with the snapshot in `directory`"""
+    # The snapshot being read stays whole even if a new one is renamed over it
+    source = sqlite3.connect(f"file:{os.path.join(directory, SNAPSHOT)}?mode=ro", uri=True)
+    try:
+        source.backup(Session.connection)
+    finally:
+        source.close()
+
+
+def replay_spend(entry: Dict) -> bool:
+    """Record a journaled spend, unless the database holds it already. Returns whether it was replayed."""
+    with Session.transaction():
+        if SignedSpends.get([], {"id": entry["txid"]}):
+            return False
+        for txid, vout in entry["utxos"]:
+            undo_replaced_spend(entry["psbt"], txid, vout)
+        SignedSpends.insert(
+            entry["txid"], entry["psbt"], entry["signed_psbt"], entry["amount_sats"], entry["request_timestamp"], False
+        )
+        for txid, vout in entry["utxos"]:
+            SpentUtxos.insert(txid, vout, entry["txid"])
+        AggregateSpends.add(unconfirmed_sats=entry["amount_sats"])
+    return True
+
+
+def apply_shipped(directory: str, applied: Optional[Dict], replayed: Set[str]) -> Optional[Dict]:
+    """
+    Apply the snapshot in `directory`, unless `applied` is its manifest, then replay the spends
+    journaled since, but those in `replayed`. Returns the manifest of the snapshot in use.
+    """
+    manifest = read_manifest(directory)
+    if manifest is not None and manifest != applied:
+        apply_snapshot(directory)
+        # The entries replayed on the previous snapshot are replayed on this one
+        replayed.clear()
+        applied = manifest
+        logger.info("Applied snapshot %d, shipped %.1fs ago", manifest["seq"], time.time() - manifest["shipped_at"])
+
+    for name, entry in read_journal(directory, [name for name in journal_names(directory) if name not in replayed]):
+        if replay_spend(entry):
+            logger.info("Replayed the spend %s", entry["txid"])
+        replayed.add(name)
+    return applied
+
+
+def follow_primary(settings: Dict):
+    """The standby: apply the primary's snapshots and spends as they are shipped, forever"""
+    directory = settings["apply_from"]
+    interval = float(settings.get("interval", DEFAULT_INTERVAL))
+    applied, replayed = None, set()
+    logger.info("Standby applying the snapshots shipped to %s", directory)
+    while True:
+        try:
+            applied = apply_shipped(directory, applied, replayed)
+        except (OSError, sqlite3.Error, orjson.JSONDecodeError) as e:
+            logger.error("Failed to apply what was shipped to %s: %s", directory, e)
+        time.sleep(interval)
+
+
+def catch_up(settings: Dict):
+    """
+    Before a standby promoted to primary signs anything: apply the last snapshot and every
+    spend journaled since. Raises `ServerError` if the primary keeps shipping meanwhile.
+    """
+    directory = settings["apply_from"]
+    applied, replayed = None, set()
+    for _ in range(CATCH_UP_ROUNDS):
+        applied = apply_shipped(directory, applied, replayed)
+        if read_manifest(directory) == applied and set(journal_names(directory)) <= replayed:
+            logger.info("Caught up with the snapshots and spends shipped to %s", directory)
+            return
+    raise ServerError(f"The primary is still shipping to {directory}: stop it before promoting the standby")
+
+
+# Disabled unless `[standby] ship_to` is configured
+SPEND_JOURNAL = SpendJournal()
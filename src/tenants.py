@@ -0,0 +1,176 @@
+"""
+Routing of PSBTs by the key fingerprints of their inputs.
+
+Each `[tenants.<name>]` section of the configuration registers a wallet served by the same
+instance, with its own bitcoind wallet, spend limits and database (`<database>.<name>`, or
+`database`). A PSBT is routed to the tenant whose key fingerprints are found in the BIP32
+derivations of every one of its inputs; PSBTs referencing no tenant go to the wallet of the
+`[bitcoind]` section, with the default database. The derivations are set by whoever submits
+the PSBT: the routed wallet only signs PSBTs whose inputs are all its own utxos. The tenants'
+rpc clients share the connections and threads of the `[bitcoind]` client; each database has a
+connection of its own.
+
+When the fingerprints of the `[bitcoind]` wallet are known (`RESIGNER_FINGERPRINTS`), PSBTs with
+an input referencing neither them nor a tenant's are rejected before any rpc or database work.
+"""
+import re
+from typing import Dict, Iterator, List, Set, Union
+
+from .bitcoind_rpc_client import BitcoindRPC, BitcoindRPCError
+from .config import Configuration
+from .db import Database, Session
+from .errors import ServerError
+from .helper import hash160
+from .lazy import lazy_import
+from .locks import ProcessLock
+from .policy import PolicyHandler, SpendLimit
+
+# Only parsed when PSBTs are routed
+psbt_module = lazy_import(f"{__package__}.psbt")
+key_module = lazy_import(f"{__package__}.crypto.key")
+
+# Tenants the daemon syncs at once
+DEFAULT_SYNC_WORKERS = 4
+
+KEY_ORIGIN = re.compile(r"\[([0-9a-fA-F]{8})")
+# An extended key without an origin
+BARE_XPUB = re.compile(r"(?<![\]\w])([xt]pub[1-9A-HJ-NP-Za-km-z]+)")
+# A private extended key, with its origin if any
+PRIVATE_XKEY = re.compile(r"(?:\[([0-9a-fA-F]{8})[^\]]*\])?([xt]prv[1-9A-HJ-NP-Za-km-z]+)")
+
+
+def psbt_input_fingerprints(psbt: str) -> List[Set[bytes]]:
+    """The master key fingerprints of the BIP32 derivations of each input of `psbt`"""
+    parsed = psbt_module.PSBT()
+    parsed.deserialize(psbt)
+    return [
+        {origin.fingerprint for origin in psbt_input.hd_keypaths.values()}
+        | {origin.fingerprint for _, origin in psbt_input.tap_bip32_paths.values()}
+        for psbt_input in parsed.inputs
+    ]
+
+
+def parse_fingerprint(fingerprint: str) -> bytes:
+    value = bytes.fromhex(fingerprint)
+    if len(value) != 4:
+        raise ServerError(f"{fingerprint} isn't a key fingerprint: 4 bytes in hex")
+    return value
+
+
+def descriptor_fingerprints(descriptor: str) -> Set[bytes]:
+    """The fingerprints the keys of `descriptor` are derived from in its wallet's PSBTs"""
+    fingerprints = {bytes.fromhex(origin) for origin in KEY_ORIGIN.findall(descriptor)}
+    # bitcoind takes a key without an origin as its own master key
+    fingerprints.update(
+        hash160(key_module.ExtendedKey.deserialize(xpub).pubkey)[:4] for xpub in BARE_XPUB.findall(descriptor)
+    )
+    return fingerprints
+
+
+def private_fingerprints(descriptor: str) -> Set[bytes]:
+    """The fingerprints of the keys of `descriptor` given as private keys: the wallet's own"""
+    return {
+        bytes.fromhex(origin) if origin else hash160(key_module.ExtendedKey.deserialize(xprv).pubkey)[:4]
+        for origin, xprv in PRIVATE_XKEY.findall(descriptor)
+    }
+
+
+def own_fingerprints(client: BitcoindRPC) -> Set[bytes]:
+    """The fingerprints of the keys the wallet of `client` holds the private keys of"""
+    try:
+        descriptors = client.listdescriptors(True)["descriptors"]
+    except BitcoindRPCError:
+        # A wallet without private keys
+        return set()
+    return {fingerprint for descriptor in descriptors for fingerprint in private_fingerprints(descriptor["desc"])}
+
+
+def wallet_fingerprints(
+    fingerprints: Union[str, List[str]], client: BitcoindRPC, cosigners_only: bool = False
+) -> Set[bytes]:
+    """
+    The `fingerprints` setting of a wallet: a list, or "wallet" for those of its descriptors.
+    With `cosigners_only`, "wallet" leaves out the resigner's own keys, which its wallets share.
+    """
+    if fingerprints != "wallet":
+        return {parse_fingerprint(fingerprint) for fingerprint in fingerprints}
+    descriptor_keys = {
+        fingerprint
+        for descriptor in client.listdescriptors()["descriptors"]
+        for fingerprint in descriptor_fingerprints(descriptor["desc"])
+    }
+    return descriptor_keys - own_fingerprints(client) if cosigners_only else descriptor_keys
+
+
+class Tenant:
+    """A wallet of the instance, with its configuration, policies and database"""
+    def __init__(self, name: str, config: Configuration, database: Database, fingerprints: Set[bytes]):
+        self.name = name
+        self.config = config
+        self.database = database
+        self.fingerprints = fingerprints
+        self.spend_limit = SpendLimit(config)
+        self.policy_handler = PolicyHandler()
+        self.policy_handler.register_policy([self.spend_limit])
+        # Spends of different tenants don't wait for each other
+        self.spend_lock = ProcessLock()
+
+
+class TenantRegistry:
+    def __init__(self):
+        self.tenants: Dict[str, Tenant] = {}
+        self.by_fingerprint: Dict[bytes, Tenant] = {}
+        # See `[daemon] tenant_sync_workers`
+        self.sync_workers = DEFAULT_SYNC_WORKERS
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(list(self.tenants.values()))
+
+    def __len__(self) -> int:
+        return len(self.tenants)
+
+    def register(self, tenant: Tenant):
+        for fingerprint in tenant.fingerprints:
+            other = self.by_fingerprint.get(fingerprint)
+            if other is not None and other is not tenant:
+                raise ServerError(f"Tenants {other.name} and {tenant.name} share the key {fingerprint.hex()}")
+        self.tenants[tenant.name] = tenant
+        self.by_fingerprint.update((fingerprint, tenant) for fingerprint in tenant.fingerprints)
+
+    def matching(self, fingerprints: Set[bytes]) -> List[Tenant]:
+        """The tenants whose keys `fingerprints` are"""
+        tenants = [self.by_fingerprint[f] for f in fingerprints if f in self.by_fingerprint]
+        return list({tenant.name: tenant for tenant in tenants}.values())
+
+    def reconnect(self):
+        """In a forked process, see `Database.reconnect`. The rpc clients share the default one's threads."""
+        for tenant in self:
+            tenant.database.reconnect()
+
+    def load(self, config: Configuration, init_db):
+        """Register the tenants of `[tenants]`, creating the tables of their databases with `init_db`"""
+        for name, settings in config.get("tenants").items():
+            # The connections and threads of the default wallet's client are shared
+            client = config.get("bitcoind")["client"].for_wallet(
+                settings["bitcoind_wallet_rpc_url"],
+                settings.get("bitcoind_rpc_user", config.get("bitcoind")["bitcoind_rpc_user"]),
+                settings.get("bitcoind_rpc_password", config.get("bitcoind")["bitcoind_rpc_password"]),
+            )
+            tenant_config = config.derive({
+                "bitcoind": {**config.get("bitcoind"), "client": client},
+                "spending_limt": settings.get("spending_limt", {}),
+            })
+            database = Database(settings.get("database", f"{Session.default.path}.{name}"))
+            fingerprints = wallet_fingerprints(settings.get("fingerprints", []), client, cosigners_only=True)
+            if not fingerprints:
+                raise ServerError(f"Tenant {name} has no key fingerprints to route its PSBTs by")
+
+            with Session.use(database):
+                init_db()
+            self.register(Tenant(name, tenant_config, database, fingerprints))
+
+
+# Empty unless `[tenants]` is configured
+TENANTS = TenantRegistry()
+# Empty, and PSBTs aren't filtered, unless `[resigner_config] fingerprints` is configured
+RESIGNER_FINGERPRINTS: Set[bytes] = set()
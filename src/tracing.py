@@ -0,0 +1,238 @@
+import os
+import re
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import orjson
+
+_current_span = contextvars.ContextVar("resigner_span", default=None)
+
+REQUEST_ID = re.compile(r"[0-9a-f]{32}")
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def new_request_id() -> str:
+    """A random request id, which is also the trace id of the request (16 bytes, hex)"""
+    return os.urandom(16).hex()
+
+
+def valid_request_id(request_id: Optional[str]) -> bool:
+    return request_id is not None and REQUEST_ID.fullmatch(request_id) is not None and set(request_id) != {"0"}
+
+
+class Span:
+    """A timed stage of a request, child of the stage it ran in"""
+    __slots__ = (
+        "trace", "span_id", "parent_id", "name", "kind", "attributes", "start_ns", "end_ns", "error",
+        "_start_perf", "_token"
+    )
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: int, attributes: Dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+        self._start_perf = time.perf_counter_ns()
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, exception: BaseException):
+        self.error = f"{type(exception).__name__}: {exception}"
+
+    def finish(self):
+        # Wall clock start, monotonic duration
+        self.end_ns = self.start_ns + time.perf_counter_ns() - self._start_perf
+        self.trace.spans.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6 if self.end_ns is not None else None
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Stands in for a span outside of a traced request"""
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """The spans of one request, in the order they finished"""
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+
+    @property
+    def root(self) -> Optional[Span]:
+        return self.spans[-1] if self.spans else None
+
+    def to_dict(self) -> Dict:
+        return {
+            "request_id": self.trace_id,
+            "spans": [span.to_dict() for span in sorted(self.spans, key=lambda span: span.start_ns)],
+        }
+
+    def to_otlp(self) -> Dict:
+        """The trace as an OTLP/JSON `ExportTraceServiceRequest`"""
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "resigner"}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "resigner"},
+                    "spans": [span.to_otlp() for span in self.spans],
+                }],
+            }]
+        }
+
+
+class Tracer:
+    """
+    Starts the trace of a request and hands it to the exporters once finished.
+
+    Requests are only traced while there is at least one exporter, the instrumentation
+    costs next to nothing otherwise.
+    """
+    def __init__(self):
+        self.exporters: List[Callable[[Trace], None]] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def start(self, name: str, request_id: Optional[str] = None, **attributes) -> Optional[Span]:
+        """Start the root span of a request, active in the current context until `finish`"""
+        if not self.enabled:
+            return None
+        root = Span(Trace(request_id or new_request_id()), name, None, KIND_SERVER, attributes)
+        root._token = _current_span.set(root)
+        return root
+
+    def finish(self, root: Span):
+        root.finish()
+        _current_span.reset(root._token)
+        for exporter in self.exporters:
+            try:
+                exporter(root.trace)
+            except Exception as e:
+                logging.getLogger("resigner").error("Failed to export trace %s: %s", root.trace.trace_id, e)
+
+    @contextmanager
+    def trace(self, name: str, request_id: Optional[str] = None, **attributes):
+        root = self.start(name, request_id, **attributes)
+        if root is None:
+            yield NOOP_SPAN
+            return
+        try:
+            yield root
+        except BaseException as e:
+            root.set_error(e)
+            raise
+        finally:
+            self.finish(root)
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Time the block as a stage of the traced request, if there is one"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(parent.trace, name, parent.span_id, kind, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set_error(e)
+        raise
+    finally:
+        child.finish()
+        _current_span.reset(token)
+
+
+def current_request_id() -> Optional[str]:
+    current = _current_span.get()
+    return current.trace.trace_id if current is not None else None
+
+
+class FileExporter:
+    """Append each trace to a file, one JSON document per line"""
+    def __init__(self, path: str, otlp: bool = False):
+        self.path = path
+        self.otlp = otlp
+        self._lock = threading.Lock()
+
+    def __call__(self, trace: Trace):
+        line = orjson.dumps(trace.to_otlp() if self.otlp else trace.to_dict()) + b"\n"
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(line)
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the id of the request being handled, and of its current span, to log records"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        current = _current_span.get()
+        record.request_id = current.trace.trace_id if current is not None else "-"
+        record.span_id = current.span_id if current is not None else "-"
+        return True
@@ -20,7 +20,7 @@ import struct
 from .helper import (
     hash256,
 )
-from .script import (
+from .script.script import (
     is_opreturn,
     is_p2sh,
     is_p2pkh,
@@ -28,7 +28,7 @@ from .script import (
     is_witness,
     is_p2wsh,
 )
-from ._serialize import (
+from .crypto._serialize import (
     deser_uint256,
     deser_string,
     deser_string_vector,
@@ -0,0 +1,30 @@
+"""
+WSGI entry point of the pre-fork multi-worker mode, see src/prefork.py. Started with the
+uwsgi command of pyuwsgi:
+
+    RESIGNER_CONFIG_PATH=config.toml uwsgi --master --processes 4 --enable-threads \\
+        --http :7767 --module src.wsgi:app
+
+Loading this module starts resigner and syncs the database; uwsgi does it once in the
+master, then forks the workers (`--lazy-apps` must not be set).
+"""
+import os
+
+from .main import create_app, start_resigner
+from .prefork import prepare_prefork, after_fork
+
+config, policy_handler = start_resigner(os.getenv("RESIGNER_CONFIG_PATH"), start_daemon=False)
+prepare_prefork()
+app = create_app(config, policy_handler, debug=False)
+
+
+def post_fork():
+    after_fork(config)
+
+
+try:
+    import uwsgi
+    uwsgi.post_fork_hook = post_fork
+except ImportError:
+    # Forked by another pre-fork server
+    os.register_at_fork(after_in_child=post_fork)
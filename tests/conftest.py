@@ -27,13 +27,26 @@ from ..src.models import (
 )
 
 from .test_framework.utils import fund_address, createpsbt, reset_aggregate_spends
+from .test_framework.fake_bitcoind import FakeBitcoind
 
 CONFIG_FILE = "config_test.toml"
 BTC_RPC_PORT = 18443
 BITCOIN_DIRNAME = ".test_bitcoin"
+# "bitcoind" runs the tests against a regtest node, "fake" against an in-process FakeBitcoind
+TEST_BACKEND = os.getenv("RESIGNER_TEST_BACKEND", "bitcoind")
 
 @pytest.fixture(scope="session")
-def run_bitcoind(config):
+def bitcoind_transport():
+    if TEST_BACKEND == "fake":
+        return FakeBitcoind(latency=float(os.getenv("RESIGNER_FAKE_LATENCY", "0")))
+    return None
+
+@pytest.fixture(scope="session")
+def run_bitcoind(config, bitcoind_transport):
+    if bitcoind_transport is not None:
+        yield
+        return
+
     # Run bitcoind in a separate folder
     os.makedirs(BITCOIN_DIRNAME, exist_ok=True)
 
@@ -43,7 +56,12 @@ def run_bitcoind(config):
     subprocess.Popen([bitcoind, f"--datadir={BITCOIN_DIRNAME}"])
 
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
 
     # Check bitcoind is running
     while True:
@@ -110,9 +128,14 @@ def sync_db(resigner_wallet, reset_db):
     sync_utxos(resigner_wallet)
 
 @pytest.fixture(scope="session", autouse=True)
-def funder(config, run_bitcoind):
+def funder(config, run_bitcoind, bitcoind_transport):
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
     wallet_name = "testwallet"
    
     wallets = btd_client.listwalletdir()["wallets"]
@@ -132,9 +155,14 @@ def funder(config, run_bitcoind):
     pass
 
 @pytest.fixture(scope="session", autouse=True)
-def resigner_wallet(config, funder):
+def resigner_wallet(config, funder, bitcoind_transport):
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
     wallet_name = "resigner_wallet"
 
     wallets = (btd_client.listwalletdir())["wallets"]
@@ -186,9 +214,14 @@ def resigner_wallet(config, funder):
     pass
 
 @pytest.fixture(scope="session", autouse=True)
-def resigner_change_wallet(config, funder):
+def resigner_change_wallet(config, funder, bitcoind_transport):
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
     wallet_name = "resigner_change_wallet"
 
     wallets = (btd_client.listwalletdir())["wallets"]
@@ -217,9 +250,14 @@ def resigner_change_wallet(config, funder):
     pass
 
 @pytest.fixture(scope="session")
-def user_wallet_1(config):
+def user_wallet_1(config, bitcoind_transport):
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
     wallet_name = "user_wallet_1"
 
     wallets = (btd_client.listwalletdir())["wallets"]
@@ -242,9 +280,14 @@ def user_wallet_1(config):
     pass
 
 @pytest.fixture(scope="session")
-def user_change_wallet_1(config):
+def user_change_wallet_1(config, bitcoind_transport):
     bitcoind = config.get("bitcoind")
-    btd_client = BitcoindRPC(bitcoind["rpc_url"], bitcoind["bitcoind_rpc_user"], bitcoind["bitcoind_rpc_password"])
+    btd_client = BitcoindRPC(
+        bitcoind["rpc_url"],
+        bitcoind["bitcoind_rpc_user"],
+        bitcoind["bitcoind_rpc_password"],
+        transport=bitcoind_transport
+    )
     wallet_name = "user_change_wallet_1"
 
     wallets = (btd_client.listwalletdir())["wallets"]
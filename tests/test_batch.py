@@ -0,0 +1,24 @@
+from .test_framework.utils import createpsbt
+from ..src.models import SignedSpends, SpentUtxos
+
+def test_batch_duplicate_outpoint(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """Of the PSBTs of a batch spending the same utxo, only the first is signed"""
+    receive_addr = funder.getnewaddress()
+    change_addr = user_change_wallet_1.getnewaddress()
+    unspent = resigner_wallet.listunspent(7)
+
+    psbts = [
+        user_wallet_1.walletprocesspsbt(createpsbt(resigner_wallet, [utxo], receive_addr, amount, change_addr))["psbt"]
+        for utxo, amount in [(unspent[0], 0.01), (unspent[0], 0.02), (unspent[1], 0.01)]
+    ]
+
+    response = client.post("/process-psbt/batch", json={"psbts": psbts})
+
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert results[0]["signed"] == True and results[2]["signed"] == True
+    assert results[1]["error_code"] == 403
+
+    assert len(SignedSpends.get()) == 2
+    spent = SpentUtxos.get([], {"txid": unspent[0]["txid"], "vout": unspent[0]["vout"]})
+    assert len(spent) == 1
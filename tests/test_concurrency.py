@@ -0,0 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .test_framework.utils import createpsbt
+from ..src.models import AggregateSpends, SignedSpends, SpentUtxos
+
+def test_concurrent_spends_of_a_utxo(app, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """PSBTs spending the same utxo at once each replace the previous one, none fails"""
+    receive_addr = funder.getnewaddress()
+    change_addr = user_change_wallet_1.getnewaddress()
+    unspent = resigner_wallet.listunspent(7)[0]
+
+    psbts = [
+        user_wallet_1.walletprocesspsbt(
+            createpsbt(resigner_wallet, [unspent], receive_addr, round(0.01 + i * 0.001, 8), change_addr)
+        )["psbt"]
+        for i in range(8)
+    ]
+
+    def post(psbt):
+        return app.test_client().post("/process-psbt", json={"psbt": psbt})
+
+    with ThreadPoolExecutor(len(psbts)) as pool:
+        responses = list(pool.map(post, psbts))
+
+    assert all(response.status_code == 200 and response.json["signed"] for response in responses)
+
+    # Only the last signed spend of the utxo is left, and counted once
+    spent = SpentUtxos.get([], {"txid": unspent["txid"], "vout": unspent["vout"]})
+    assert len(spent) == 1
+    signed_spends = SignedSpends.get()
+    assert [spend["id"] for spend in signed_spends] == [spent[0]["psbt_id"]]
+    assert AggregateSpends.get()[0]["unconfirmed_daily_spends"] == signed_spends[0]["amount_sats"]
@@ -0,0 +1,76 @@
+import time
+
+import httpx
+import pytest
+
+from .test_framework.fake_bitcoind import FakeBitcoind
+from .test_framework.utils import createpsbt
+from ..src import BitcoindRPC
+from ..src.deadline import Deadline
+from ..src.errors import DeadlineExceededError
+from ..src.main import INVALID_TIMEOUT
+from ..src.models import SignedSpends
+
+class TimeoutRecorder(httpx.BaseTransport):
+    """A FakeBitcoind recording the read timeout of every request"""
+    def __init__(self):
+        self.node = FakeBitcoind()
+        self.read_timeouts = []
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.read_timeouts.append(request.extensions["timeout"]["read"])
+        return self.node.handle_request(request)
+
+def signing_request(funder, resigner_wallet, user_wallet_1, user_change_wallet_1) -> str:
+    unspent = resigner_wallet.listunspent(7)
+    unsigned_psbt = createpsbt(
+        resigner_wallet, [unspent[0]], funder.getnewaddress(), 0.01, user_change_wallet_1.getnewaddress()
+    )
+    return user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]
+
+def test_expired_deadline(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """A request whose time budget runs out is answered 504, and nothing is signed"""
+    psbt = signing_request(funder, resigner_wallet, user_wallet_1, user_change_wallet_1)
+
+    response = client.post("/process-psbt", json={"psbt": psbt, "timeout": 1e-9})
+    assert response.status_code == 504
+    assert response.json["error_code"] == 504
+
+    response = client.post("/process-psbt/batch", json={"psbts": [psbt], "timeout": 1e-9})
+    assert response.status_code == 200
+    assert response.json["results"][0]["error_code"] == 504
+    assert SignedSpends.get() == []
+
+@pytest.mark.parametrize("timeout", [-1, 0, "10", True])
+def test_invalid_timeout(client, timeout, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    psbt = signing_request(funder, resigner_wallet, user_wallet_1, user_change_wallet_1)
+
+    response = client.post("/process-psbt", json={"psbt": psbt, "timeout": timeout})
+    assert response.status_code == 400
+    assert INVALID_TIMEOUT in response.get_data(as_text=True)
+
+    response = client.post("/process-psbt/batch", json={"psbts": [psbt], "timeout": timeout})
+    assert response.status_code == 400
+    assert INVALID_TIMEOUT in response.get_data(as_text=True)
+    assert SignedSpends.get() == []
+
+def test_rpc_timeout_shrinks_to_the_budget():
+    transport = TimeoutRecorder()
+    btd_client = BitcoindRPC("http://fake", "user", "passwd", transport=transport, timeout=100, cache_size=0)
+
+    btd_client.getblockcount()
+    assert transport.read_timeouts[-1] == 100
+
+    with Deadline(0.5) as deadline:
+        btd_client.getblockcount()
+        assert transport.read_timeouts[-1] <= 0.5
+        time.sleep(0.2)
+        btd_client.getblockcount()
+        assert transport.read_timeouts[-1] <= deadline.remaining() + 0.01 < 0.31
+
+    # Once the budget is spent, rpcs fail without being sent
+    with Deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceededError):
+            btd_client.getblockcount()
+    assert len(transport.read_timeouts) == 3
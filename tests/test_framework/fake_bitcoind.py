@@ -0,0 +1,1439 @@
+"""
+In-process fake bitcoind.
+
+`FakeBitcoind` is an httpx transport answering the JSON-RPC subset resigner uses from an
+in-memory regtest chain, so that tests, benchmarks and load tests run without a node:
+
+    node = FakeBitcoind(latency=0.002)
+    btd_client = BitcoindRPC("http://fake/wallet/resigner_wallet", "user", "passwd", transport=node)
+
+It is a simulator, not a reimplementation of Bitcoin Core:
+- keys are real BIP32 keys, so PSBTs carry real public keys, fingerprints and paths, but
+  scripts aren't compiled: the witness script of a descriptor is its public text, and
+  signatures are placeholders.
+- miniscript isn't evaluated: an input is complete once every key of its descriptor has
+  signed, except in multi(k, ...) where k signatures are enough.
+- there is no fee estimation, a flat fee is used when the wallet builds a transaction.
+
+The module only depends on httpx, orjson and bip32 so it can be imported on its own.
+"""
+import base64
+import hashlib
+import inspect
+import re
+import struct
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import orjson
+from bip32 import BIP32, PrivateDerivationError
+
+COIN = 100000000
+COINBASE_MATURITY = 100
+HALVING_INTERVAL = 150  # regtest
+DUST = 546
+WALLET_FEE = 1410  # sats, fee of the transactions built by the wallets
+GENESIS_TIME = 1296688602
+BLOCK_INTERVAL = 600
+HARDENED = 0x80000000
+
+# PSBT key types
+PSBT_GLOBAL_UNSIGNED_TX = 0x00
+PSBT_IN_WITNESS_UTXO = 0x01
+PSBT_IN_PARTIAL_SIG = 0x02
+PSBT_IN_WITNESS_SCRIPT = 0x05
+PSBT_IN_BIP32_DERIVATION = 0x06
+PSBT_IN_FINAL_SCRIPTWITNESS = 0x08
+PSBT_OUT_WITNESS_SCRIPT = 0x01
+PSBT_OUT_BIP32_DERIVATION = 0x02
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str):
+        self.code = code
+        self.message = message
+
+
+def sha256(b: bytes) -> bytes:
+    return hashlib.sha256(b).digest()
+
+
+def hash256(b: bytes) -> bytes:
+    return sha256(sha256(b))
+
+
+def btc(amount_sats: int) -> float:
+    return round(amount_sats / COIN, 8)
+
+
+def to_sats(amount: float) -> int:
+    return int(round(amount * COIN))
+
+
+def ser_compact_size(n: int) -> bytes:
+    if n < 253:
+        return struct.pack("B", n)
+    if n <= 0xffff:
+        return b"\xfd" + struct.pack("<H", n)
+    if n <= 0xffffffff:
+        return b"\xfe" + struct.pack("<I", n)
+    return b"\xff" + struct.pack("<Q", n)
+
+
+def deser_compact_size(f: BytesIO) -> int:
+    n = f.read(1)[0]
+    if n == 253:
+        return struct.unpack("<H", f.read(2))[0]
+    if n == 254:
+        return struct.unpack("<I", f.read(4))[0]
+    if n == 255:
+        return struct.unpack("<Q", f.read(8))[0]
+    return n
+
+
+def ser_string(b: bytes) -> bytes:
+    return ser_compact_size(len(b)) + b
+
+
+def deser_string(f: BytesIO) -> bytes:
+    return f.read(deser_compact_size(f))
+
+
+# BIP173 addresses
+
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+
+def _bech32_polymod(values: List[int]) -> int:
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _bech32_hrp_expand(hrp: str) -> List[int]:
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+
+def _convertbits(data: bytes, frombits: int, tobits: int, pad: bool = True) -> Optional[List[int]]:
+    acc = bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad and bits:
+        ret.append((acc << (tobits - bits)) & maxv)
+    elif not pad and (bits >= frombits or ((acc << (tobits - bits)) & maxv)):
+        return None
+    return ret
+
+
+def encode_segwit_address(hrp: str, program: bytes) -> str:
+    data = [0] + _convertbits(program, 8, 5)
+    polymod = _bech32_polymod(_bech32_hrp_expand(hrp) + data + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def decode_segwit_address(hrp: str, address: str) -> bytes:
+    """Return the scriptPubKey of a segwit v0 address"""
+    address = address.lower()
+    pos = address.rfind("1")
+    if address[:pos] != hrp or any(c not in BECH32_CHARSET for c in address[pos + 1:]):
+        raise RPCError(-5, f"Invalid address: {address}")
+    data = [BECH32_CHARSET.find(c) for c in address[pos + 1:]]
+    if _bech32_polymod(_bech32_hrp_expand(hrp) + data) != 1 or not data or data[0] != 0:
+        raise RPCError(-5, f"Invalid address: {address}")
+    program = _convertbits(data[1:-6], 5, 8, False)
+    if program is None or len(program) not in (20, 32):
+        raise RPCError(-5, f"Invalid address: {address}")
+    return bytes([0, len(program)]) + bytes(program)
+
+
+# BIP380 descriptor checksums
+
+_INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
+_CHECKSUM_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+
+def _descsum_polymod(symbols: List[int]) -> int:
+    generator = [0xf5dee51989, 0xa9fdca3312, 0x1bab10e32d, 0x3706b1677a, 0x644d626ffd]
+    chk = 1
+    for value in symbols:
+        top = chk >> 35
+        chk = (chk & 0x7ffffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _descsum_expand(s: str) -> List[int]:
+    groups = []
+    symbols = []
+    for c in s:
+        v = _INPUT_CHARSET.find(c)
+        if v < 0:
+            raise RPCError(-5, f"Invalid character in descriptor: {c!r}")
+        symbols.append(v & 31)
+        groups.append(v >> 5)
+        if len(groups) == 3:
+            symbols.append(groups[0] * 9 + groups[1] * 3 + groups[2])
+            groups = []
+    if len(groups) == 1:
+        symbols.append(groups[0])
+    elif len(groups) == 2:
+        symbols.append(groups[0] * 3 + groups[1])
+    return symbols
+
+
+def descsum_create(s: str) -> str:
+    symbols = _descsum_expand(s) + [0] * 8
+    checksum = _descsum_polymod(symbols) ^ 1
+    return s + "#" + "".join(_CHECKSUM_CHARSET[(checksum >> (5 * (7 - i))) & 31] for i in range(8))
+
+
+# Transactions
+
+class TxIn:
+    def __init__(self, txid: str, vout: int, sequence: int = 0xffffffff, script_sig: bytes = b"", witness=None):
+        self.txid = txid
+        self.vout = vout
+        self.sequence = sequence
+        self.script_sig = script_sig
+        self.witness: List[bytes] = witness or []
+
+    @property
+    def outpoint(self) -> Tuple[str, int]:
+        return (self.txid, self.vout)
+
+    @property
+    def is_coinbase(self) -> bool:
+        return self.txid == "00" * 32 and self.vout == 0xffffffff
+
+
+class TxOut:
+    def __init__(self, value: int, script_pubkey: bytes):
+        self.value = value
+        self.script_pubkey = script_pubkey
+
+    def serialize(self) -> bytes:
+        return struct.pack("<q", self.value) + ser_string(self.script_pubkey)
+
+    @classmethod
+    def deserialize(cls, f: BytesIO) -> "TxOut":
+        value = struct.unpack("<q", f.read(8))[0]
+        return cls(value, deser_string(f))
+
+
+class Tx:
+    def __init__(self, vin: List[TxIn], vout: List[TxOut], locktime: int = 0, version: int = 2):
+        self.version = version
+        self.vin = vin
+        self.vout = vout
+        self.locktime = locktime
+
+    def serialize(self, with_witness: bool = True) -> bytes:
+        with_witness = with_witness and any(txin.witness for txin in self.vin)
+        r = struct.pack("<i", self.version)
+        if with_witness:
+            r += b"\x00\x01"
+        r += ser_compact_size(len(self.vin))
+        for txin in self.vin:
+            r += bytes.fromhex(txin.txid)[::-1] + struct.pack("<I", txin.vout)
+            r += ser_string(txin.script_sig) + struct.pack("<I", txin.sequence)
+        r += ser_compact_size(len(self.vout))
+        for txout in self.vout:
+            r += txout.serialize()
+        if with_witness:
+            for txin in self.vin:
+                r += ser_compact_size(len(txin.witness)) + b"".join(ser_string(item) for item in txin.witness)
+        return r + struct.pack("<I", self.locktime)
+
+    @classmethod
+    def deserialize(cls, raw: bytes) -> "Tx":
+        f = BytesIO(raw)
+        version = struct.unpack("<i", f.read(4))[0]
+        count = deser_compact_size(f)
+        with_witness = count == 0
+        if with_witness:
+            f.read(1)  # flag
+            count = deser_compact_size(f)
+        vin = []
+        for _ in range(count):
+            txid = f.read(32)[::-1].hex()
+            n = struct.unpack("<I", f.read(4))[0]
+            script_sig = deser_string(f)
+            vin.append(TxIn(txid, n, struct.unpack("<I", f.read(4))[0], script_sig))
+        vout = [TxOut.deserialize(f) for _ in range(deser_compact_size(f))]
+        if with_witness:
+            for txin in vin:
+                txin.witness = [deser_string(f) for _ in range(deser_compact_size(f))]
+        locktime = struct.unpack("<I", f.read(4))[0]
+        if f.read(1):
+            raise ValueError("trailing bytes")
+        return cls(vin, vout, locktime, version)
+
+    @property
+    def txid(self) -> str:
+        return hash256(self.serialize(with_witness=False))[::-1].hex()
+
+    @property
+    def wtxid(self) -> str:
+        return hash256(self.serialize())[::-1].hex()
+
+
+# PSBTs: the maps are kept as raw key/value pairs, which round-trips any field.
+
+def _deser_map(f: BytesIO) -> Dict[bytes, bytes]:
+    entries = {}
+    while True:
+        key = deser_string(f)
+        if not key:
+            return entries
+        entries[key] = deser_string(f)
+
+
+def _ser_map(entries: Dict[bytes, bytes]) -> bytes:
+    return b"".join(ser_string(k) + ser_string(v) for k, v in entries.items()) + b"\x00"
+
+
+class PSBT:
+    def __init__(self, tx: Tx, global_map=None, inputs=None, outputs=None):
+        self.tx = tx
+        self.global_map: Dict[bytes, bytes] = global_map or {}
+        self.inputs: List[Dict[bytes, bytes]] = inputs or [{} for _ in tx.vin]
+        self.outputs: List[Dict[bytes, bytes]] = outputs or [{} for _ in tx.vout]
+
+    @classmethod
+    def parse(cls, psbt: str) -> "PSBT":
+        try:
+            f = BytesIO(base64.b64decode(psbt, validate=True))
+            if f.read(5) != b"psbt\xff":
+                raise ValueError("invalid magic bytes")
+            global_map = _deser_map(f)
+            tx = Tx.deserialize(global_map.pop(bytes([PSBT_GLOBAL_UNSIGNED_TX])))
+            inputs = [_deser_map(f) for _ in tx.vin]
+            outputs = [_deser_map(f) for _ in tx.vout]
+        except (ValueError, KeyError, IndexError, struct.error) as e:
+            raise RPCError(-22, f"TX decode failed {e}")
+        return cls(tx, global_map, inputs, outputs)
+
+    def serialize(self) -> str:
+        global_map = {bytes([PSBT_GLOBAL_UNSIGNED_TX]): self.tx.serialize(with_witness=False), **self.global_map}
+        raw = b"psbt\xff" + _ser_map(global_map)
+        raw += b"".join(_ser_map(m) for m in self.inputs) + b"".join(_ser_map(m) for m in self.outputs)
+        return base64.b64encode(raw).decode()
+
+    @staticmethod
+    def keyed(entries: Dict[bytes, bytes], key_type: int) -> Dict[bytes, bytes]:
+        """Entries of a type, by key data"""
+        return {k[1:]: v for k, v in entries.items() if k[0] == key_type}
+
+
+def _ser_keypath(fingerprint: bytes, path: List[int]) -> bytes:
+    return fingerprint + b"".join(struct.pack("<I", i) for i in path)
+
+
+def _path_str(path: List[int]) -> str:
+    return "m" + "".join(f"/{i & ~HARDENED}'" if i & HARDENED else f"/{i}" for i in path)
+
+
+# Descriptors
+
+_KEY_EXPRESSION = re.compile(
+    r"(?:\[(?P<fingerprint>[0-9a-fA-F]{8})(?P<origin>(?:/\d+['h]?)*)\])?"
+    r"(?P<xkey>[xt]p(?:ub|rv)[1-9A-HJ-NP-Za-km-z]+)"
+    r"(?P<path>(?:/\d+['h]?)*)(?P<wildcard>/\*)?"
+)
+_MULTI = re.compile(r"(?:sorted)?multi(?:_a)?\((\d+),([^()]*)\)")
+
+
+def _parse_path(path: str) -> List[int]:
+    return [int(i.rstrip("'h")) + HARDENED if i[-1] in "'h" else int(i) for i in path.split("/") if i]
+
+
+class DescriptorKey:
+    def __init__(self, match: re.Match):
+        self.xkey = match["xkey"]
+        self.bip32 = BIP32.from_xpriv(self.xkey) if self.xkey[1:4] == "prv" else BIP32.from_xpub(self.xkey)
+        self.has_private = self.xkey[1:4] == "prv"
+        self.fingerprint = self.bip32.get_fingerprint()
+        if match["fingerprint"]:
+            self.fingerprint = bytes.fromhex(match["fingerprint"])
+        self.origin = _parse_path(match["origin"] or "")
+        self.path = _parse_path(match["path"] or "")
+        self.ranged = bool(match["wildcard"])
+        self.public = match.group().replace(self.xkey, self.bip32.get_xpub() if self.has_private else self.xkey)
+        self._derived: Dict[int, bytes] = {}
+
+    def derive(self, index: int) -> Tuple[bytes, bytes, List[int]]:
+        """Public key at `index`, with its master fingerprint and full derivation path"""
+        path = self.path + ([index] if self.ranged else [])
+        if index not in self._derived:
+            self._derived[index] = self.bip32.get_pubkey_from_path(path)
+        return self._derived[index], self.fingerprint, self.origin + path
+
+
+class Descriptor:
+    """A descriptor imported in a wallet, possibly holding private keys"""
+    def __init__(self, desc: str):
+        desc, _, checksum = desc.strip().partition("#")
+        if checksum and descsum_create(desc) != f"{desc}#{checksum}":
+            raise RPCError(-5, f"Provided checksum '{checksum}' does not match computed checksum")
+        try:
+            self.keys = [DescriptorKey(match) for match in _KEY_EXPRESSION.finditer(desc)]
+        except (ValueError, PrivateDerivationError) as e:
+            raise RPCError(-5, f"key error: {e}")
+        if not self.keys:
+            raise RPCError(-5, f"'{desc}' is not a valid descriptor function")
+
+        self.private = desc
+        self.public = _KEY_EXPRESSION.sub(lambda m: DescriptorKey(m).public, desc)
+        self.ranged = any(key.ranged for key in self.keys)
+        self.is_script = not desc.startswith(("wpkh(", "pkh(", "sh(wpkh("))
+        self.required_signatures = self._required_signatures()
+
+    def _required_signatures(self) -> int:
+        required = len(self.keys)
+        for match in _MULTI.finditer(self.public):
+            required -= len(_KEY_EXPRESSION.findall(match[2])) - int(match[1])
+        return required
+
+    def witness_script(self, index: int) -> bytes:
+        return self.public.replace("*", str(index)).encode()
+
+    def script_pubkey(self, index: int) -> bytes:
+        if self.is_script:
+            return b"\x00\x20" + sha256(self.witness_script(index))
+        return b"\x00\x14" + sha256(self.witness_script(index))[:20]
+
+    def signature(self, key: DescriptorKey, index: int, txid: str) -> bytes:
+        pubkey = key.derive(index)[0]
+        return b"\x30\x44" + sha256(pubkey + bytes.fromhex(txid)) * 2 + b"\x02\x20" + b"\x01"
+
+
+class Wallet:
+    def __init__(self, name: str, disable_private_keys: bool, passphrase: str):
+        self.name = name
+        self.private_keys_enabled = not disable_private_keys
+        self.encrypted = bool(passphrase)
+        # public descriptor -> {"desc", "active", "internal", "range", "next_index", "timestamp"}
+        self.descriptors: Dict[str, Dict] = {}
+        self.watch_only: Dict[str, str] = {}  # address -> label
+        self.labels: Dict[str, str] = {}
+
+    def active_descriptor(self, internal: bool) -> Optional[Dict]:
+        for entry in self.descriptors.values():
+            if entry["active"] and entry["internal"] == internal:
+                return entry
+        return None
+
+
+class FakeBitcoind(httpx.BaseTransport):
+    """
+    httpx transport simulating a regtest bitcoind node and its wallets.
+
+    :param latency: seconds added to every rpc
+    :param method_latency: seconds added to the given rpcs, instead of `latency`
+    """
+    def __init__(self, latency: float = 0.0, method_latency: Optional[Dict[str, float]] = None):
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.hrp = "bcrt"
+        # Rpcs served, by method
+        self.calls = Counter()
+
+        self._lock = threading.RLock()
+        self.blocks: List[Dict] = []
+        self.txs: Dict[str, Dict] = {}
+        self.utxos: Dict[Tuple[str, int], Dict] = {}
+        self.mempool: List[str] = []
+        self.mempool_spends: Dict[Tuple[str, int], str] = {}
+        # address -> (public descriptor, index) of every address handed out by a wallet
+        self.addresses: Dict[str, Tuple[str, int]] = {}
+        self.descriptors: Dict[str, Descriptor] = {}
+        self.wallets: Dict[str, Wallet] = {}
+        self._coinbase_count = 0
+
+        self._mine_block([])
+
+    # Transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = orjson.loads(request.read())
+        calls = body if isinstance(body, list) else [body]
+        for call in calls:
+            self.calls[call["method"]] += 1
+
+        # A batch request is a single round trip
+        delay = max(self.method_latency.get(call["method"], self.latency) for call in calls)
+        if delay:
+            time.sleep(delay)
+
+        wallet_name = None
+        if request.url.path.startswith("/wallet/"):
+            wallet_name = httpx.URL(request.url).path[len("/wallet/"):]
+
+        responses = [self.answer(call, wallet_name) for call in calls]
+        if isinstance(body, list):
+            return httpx.Response(200, content=orjson.dumps([content for _, content in responses]))
+        status, content = responses[0]
+        return httpx.Response(status, content=orjson.dumps(content))
+
+    def answer(self, call: Dict, wallet_name: Optional[str]) -> Tuple[int, Dict]:
+        """HTTP status and JSONRPC response of a call"""
+        try:
+            with self._lock:
+                result = self.dispatch(call["method"], call.get("params") or [], wallet_name)
+        except RPCError as e:
+            status = 404 if e.code == -32601 else 500
+            return status, {"result": None, "error": {"code": e.code, "message": e.message}, "id": call.get("id")}
+        return 200, {"result": result, "error": None, "id": call.get("id")}
+
+    def dispatch(self, method: str, params: List, wallet_name: Optional[str] = None):
+        handler = getattr(self, f"rpc_{method}", None)
+        if handler is None:
+            raise RPCError(-32601, "Method not found")
+
+        signature = list(inspect.signature(handler).parameters.values())
+        args = []
+        if signature and signature[0].name == "wallet":
+            args.append(self._wallet(wallet_name))
+            signature = signature[1:]
+        if signature and signature[-1].kind == inspect.Parameter.VAR_POSITIONAL:
+            return handler(*args, *params)
+        if len(params) > len(signature):
+            raise RPCError(-1, f"{method} takes at most {len(signature)} arguments")
+        # null parameters take their default value, as with bitcoind
+        for param, value in zip(signature, params):
+            args.append(param.default if value is None and param.default is not inspect.Parameter.empty else value)
+        return handler(*args)
+
+    def _wallet(self, name: Optional[str]) -> Wallet:
+        if name is None:
+            if len(self.wallets) != 1:
+                raise RPCError(
+                    -19, "Wallet file not specified (must request wallet RPC through /wallet/<filename> uri-path)."
+                )
+            return next(iter(self.wallets.values()))
+        if name not in self.wallets:
+            raise RPCError(-18, "Requested wallet does not exist or is not loaded")
+        return self.wallets[name]
+
+    # Chain state
+
+    @property
+    def height(self) -> int:
+        return len(self.blocks) - 1
+
+    def _confirmations(self, height: Optional[int]) -> int:
+        return 0 if height is None else self.height - height + 1
+
+    def _block(self, block_hash: str) -> Dict:
+        for block in self.blocks:
+            if block["hash"] == block_hash:
+                return block
+        raise RPCError(-5, "Block not found")
+
+    def _mine_block(self, txids: List[str], script_pubkey: bytes = b"\x51") -> Dict:
+        height = len(self.blocks)
+        fees = sum(self.txs[txid]["fee"] for txid in txids)
+        self._coinbase_count += 1
+        coinbase = Tx(
+            [TxIn("00" * 32, 0xffffffff, script_sig=struct.pack("<II", height, self._coinbase_count))],
+            [TxOut((50 * COIN >> (height // HALVING_INTERVAL)) + fees, script_pubkey)]
+        )
+        self._add_tx(coinbase, [], coinbase=True)
+
+        previous = self.blocks[-1]["hash"] if self.blocks else "00" * 32
+        block_time = GENESIS_TIME + height * BLOCK_INTERVAL
+        tx_ids = [coinbase.txid] + txids
+        block_hash = hash256(
+            bytes.fromhex(previous) + struct.pack("<II", height, block_time) +
+            b"".join(bytes.fromhex(t) for t in tx_ids)
+        )[::-1].hex()
+        block = {"hash": block_hash, "height": height, "time": block_time, "previousblockhash": previous, "tx": tx_ids}
+        self.blocks.append(block)
+
+        for txid in tx_ids:
+            record = self.txs[txid]
+            record["height"] = height
+            for n in range(len(record["tx"].vout)):
+                if (txid, n) in self.utxos:
+                    self.utxos[(txid, n)]["height"] = height
+            for txin in record["tx"].vin:
+                self.utxos.pop(txin.outpoint, None)
+                self.mempool_spends.pop(txin.outpoint, None)
+        return block
+
+    def _add_tx(self, tx: Tx, prevouts: List[Dict], coinbase: bool = False) -> str:
+        txid = tx.txid
+        self.txs[txid] = {
+            "tx": tx,
+            "prevouts": prevouts,
+            "height": None,
+            "time": GENESIS_TIME + len(self.blocks) * BLOCK_INTERVAL,
+            "fee": sum(p["value"] for p in prevouts) - sum(o.value for o in tx.vout) if not coinbase else 0,
+            "coinbase": coinbase,
+        }
+        for n, txout in enumerate(tx.vout):
+            self.utxos[(txid, n)] = {
+                "value": txout.value,
+                "script_pubkey": txout.script_pubkey,
+                "height": None,
+                "coinbase": coinbase,
+            }
+        if not coinbase:
+            for txin in tx.vin:
+                self.mempool_spends[txin.outpoint] = txid
+            self.mempool.append(txid)
+        return txid
+
+    def _accept(self, tx: Tx) -> str:
+        prevouts = []
+        for txin in tx.vin:
+            if txin.outpoint in self.mempool_spends:
+                raise RPCError(-26, "txn-mempool-conflict")
+            utxo = self.utxos.get(txin.outpoint)
+            if utxo is None:
+                raise RPCError(-25, "bad-txns-inputs-missingorspent")
+            if utxo["coinbase"] and self._confirmations(utxo["height"]) < COINBASE_MATURITY:
+                raise RPCError(-26, "bad-txns-premature-spend-of-coinbase")
+            if not txin.witness:
+                raise RPCError(
+                    -26, "mandatory-script-verify-flag-failed (Witness program was passed an empty witness)"
+                )
+            prevouts.append(utxo)
+
+        if sum(o.value for o in tx.vout) > sum(p["value"] for p in prevouts):
+            raise RPCError(-26, "bad-txns-in-belowout")
+        if tx.txid in self.txs:
+            raise RPCError(-27, "Transaction already in block chain")
+        return self._add_tx(tx, prevouts)
+
+    # Addresses and wallets
+
+    def _address(self, script_pubkey: bytes) -> Optional[str]:
+        if len(script_pubkey) in (22, 34) and script_pubkey[0] == 0 and script_pubkey[1] == len(script_pubkey) - 2:
+            return encode_segwit_address(self.hrp, script_pubkey[2:])
+        return None
+
+    def _script_pubkey(self, address: str) -> bytes:
+        return decode_segwit_address(self.hrp, address)
+
+    def _spk_json(self, script_pubkey: bytes) -> Dict:
+        address = self._address(script_pubkey)
+        spk = {"asm": "", "hex": script_pubkey.hex()}
+        if address is None:
+            spk["type"] = "nonstandard"
+        else:
+            spk["address"] = address
+            spk["type"] = "witness_v0_scripthash" if len(script_pubkey) == 34 else "witness_v0_keyhash"
+        return spk
+
+    def _derive_address(self, wallet: Wallet, internal: bool) -> str:
+        entry = wallet.active_descriptor(internal) or wallet.active_descriptor(not internal)
+        if entry is None:
+            raise RPCError(-12, "Error: This wallet has no available keys")
+        descriptor = entry["desc"]
+        index = entry["next_index"]
+        entry["next_index"] += 1 if descriptor.ranged else 0
+        address = self._address(descriptor.script_pubkey(index))
+        self.addresses[address] = (descriptor.public, index)
+        return address
+
+    def _owner_descriptor(self, wallet: Wallet, address: Optional[str]) -> Optional[Tuple[Dict, int]]:
+        """The wallet's descriptor entry for `address` and the address' index, if it is one of the wallet's."""
+        if address not in self.addresses:
+            return None
+        public, index = self.addresses[address]
+        entry = wallet.descriptors.get(public)
+        return (entry, index) if entry is not None else None
+
+    def _is_mine(self, wallet: Wallet, address: Optional[str]) -> bool:
+        return address in wallet.watch_only or self._owner_descriptor(wallet, address) is not None
+
+    def _wallet_utxos(self, wallet: Wallet, min_conf: int = 0, spendable_only: bool = True):
+        for (txid, n), utxo in self.utxos.items():
+            address = self._address(utxo["script_pubkey"])
+            confirmations = self._confirmations(utxo["height"])
+            if confirmations < min_conf or not self._is_mine(wallet, address):
+                continue
+            if spendable_only and ((txid, n) in self.mempool_spends or
+                                   (utxo["coinbase"] and confirmations < COINBASE_MATURITY)):
+                continue
+            yield txid, n, utxo, address, confirmations
+
+    def _wallet_txids(self, wallet: Wallet) -> List[str]:
+        txids = []
+        for txid, record in self.txs.items():
+            outputs = [self._address(o.script_pubkey) for o in record["tx"].vout]
+            inputs = [self._address(p["script_pubkey"]) for p in record["prevouts"]]
+            if any(self._is_mine(wallet, address) for address in outputs + inputs):
+                txids.append(txid)
+        return txids
+
+    def _fund(self, wallet: Wallet, outputs: List[TxOut], inputs: List[TxIn]) -> Tuple[Tx, int]:
+        """Add wallet coins and a change output until `outputs` are paid. Returns the tx and change position."""
+        target = sum(o.value for o in outputs) + WALLET_FEE
+        selected = sum(self.utxos[txin.outpoint]["value"] for txin in inputs if txin.outpoint in self.utxos)
+        coins = sorted(self._wallet_utxos(wallet, min_conf=1), key=lambda coin: -coin[2]["value"])
+        used = {txin.outpoint for txin in inputs}
+        for txid, n, utxo, _, _ in coins:
+            if selected >= target:
+                break
+            if (txid, n) not in used:
+                inputs.append(TxIn(txid, n, 0xfffffffd))
+                selected += utxo["value"]
+        if selected < target:
+            raise RPCError(-6, "Insufficient funds")
+
+        change_pos = -1
+        if selected - target > DUST:
+            change_pos = len(outputs)
+            change = self._script_pubkey(self._derive_address(wallet, internal=True))
+            outputs = outputs + [TxOut(selected - target, change)]
+        return Tx(inputs, outputs), change_pos
+
+    def _parse_outputs(self, outputs) -> List[TxOut]:
+        if isinstance(outputs, dict):
+            outputs = [{k: v} for k, v in outputs.items()]
+        txouts = []
+        for output in outputs:
+            for address, amount in output.items():
+                if address == "data":
+                    txouts.append(TxOut(0, b"\x6a" + ser_string(bytes.fromhex(amount))))
+                else:
+                    txouts.append(TxOut(to_sats(amount), self._script_pubkey(address)))
+        return txouts
+
+    # PSBT processing
+
+    def _update_input(self, wallet: Optional[Wallet], psbt: PSBT, i: int, sign: bool) -> None:
+        txin = psbt.tx.vin[i]
+        entries = psbt.inputs[i]
+        utxo = self.utxos.get(txin.outpoint) or self._spent_output(txin.outpoint)
+        if utxo is None:
+            return
+        entries[bytes([PSBT_IN_WITNESS_UTXO])] = TxOut(utxo["value"], utxo["script_pubkey"]).serialize()
+        if wallet is None:
+            return
+        owner = self._owner_descriptor(wallet, self._address(utxo["script_pubkey"]))
+        if owner is None or bytes([PSBT_IN_FINAL_SCRIPTWITNESS]) in entries:
+            return
+
+        entry, index = owner
+        descriptor = entry["desc"]
+        if descriptor.is_script:
+            entries[bytes([PSBT_IN_WITNESS_SCRIPT])] = descriptor.witness_script(index)
+        for key in descriptor.keys:
+            pubkey, fingerprint, path = key.derive(index)
+            entries[bytes([PSBT_IN_BIP32_DERIVATION]) + pubkey] = _ser_keypath(fingerprint, path)
+            if sign and key.has_private and wallet.private_keys_enabled:
+                entries[bytes([PSBT_IN_PARTIAL_SIG]) + pubkey] = descriptor.signature(key, index, psbt.tx.txid)
+
+    def _update_output(self, wallet: Wallet, psbt: PSBT, i: int) -> None:
+        owner = self._owner_descriptor(wallet, self._address(psbt.tx.vout[i].script_pubkey))
+        if owner is None:
+            return
+        entry, index = owner
+        if entry["desc"].is_script:
+            psbt.outputs[i][bytes([PSBT_OUT_WITNESS_SCRIPT])] = entry["desc"].witness_script(index)
+        for key in entry["desc"].keys:
+            pubkey, fingerprint, path = key.derive(index)
+            psbt.outputs[i][bytes([PSBT_OUT_BIP32_DERIVATION]) + pubkey] = _ser_keypath(fingerprint, path)
+
+    def _spent_output(self, outpoint: Tuple[str, int]) -> Optional[Dict]:
+        record = self.txs.get(outpoint[0])
+        if record is None or outpoint[1] >= len(record["tx"].vout):
+            return None
+        txout = record["tx"].vout[outpoint[1]]
+        return {"value": txout.value, "script_pubkey": txout.script_pubkey}
+
+    def _input_descriptor(self, psbt: PSBT, i: int) -> Optional[Descriptor]:
+        witness_utxo = psbt.inputs[i].get(bytes([PSBT_IN_WITNESS_UTXO]))
+        if witness_utxo is None:
+            return None
+        address = self._address(TxOut.deserialize(BytesIO(witness_utxo)).script_pubkey)
+        if address not in self.addresses:
+            return None
+        return self.descriptors.get(self.addresses[address][0])
+
+    def _finalize_input(self, psbt: PSBT, i: int) -> bool:
+        entries = psbt.inputs[i]
+        if bytes([PSBT_IN_FINAL_SCRIPTWITNESS]) in entries:
+            return True
+        descriptor = self._input_descriptor(psbt, i)
+        signatures = PSBT.keyed(entries, PSBT_IN_PARTIAL_SIG)
+        if descriptor is None or len(signatures) < descriptor.required_signatures:
+            return False
+
+        witness = list(signatures.values())
+        script = entries.get(bytes([PSBT_IN_WITNESS_SCRIPT]))
+        if script is not None:
+            witness.append(script)
+        witness_utxo = entries[bytes([PSBT_IN_WITNESS_UTXO])]
+        entries.clear()
+        entries[bytes([PSBT_IN_WITNESS_UTXO])] = witness_utxo
+        entries[bytes([PSBT_IN_FINAL_SCRIPTWITNESS])] = ser_compact_size(len(witness)) + \
+            b"".join(ser_string(item) for item in witness)
+        return True
+
+    def _witness_utxo(self, psbt: PSBT, i: int) -> Optional[TxOut]:
+        witness_utxo = psbt.inputs[i].get(bytes([PSBT_IN_WITNESS_UTXO]))
+        return TxOut.deserialize(BytesIO(witness_utxo)) if witness_utxo is not None else None
+
+    def _decode_tx(self, tx: Tx) -> Dict:
+        size = len(tx.serialize())
+        weight = len(tx.serialize(with_witness=False)) * 3 + size
+        vin = []
+        for txin in tx.vin:
+            if txin.is_coinbase:
+                vin.append({"coinbase": txin.script_sig.hex(), "sequence": txin.sequence})
+                continue
+            entry = {"txid": txin.txid, "vout": txin.vout, "scriptSig": {"asm": "", "hex": txin.script_sig.hex()}}
+            if txin.witness:
+                entry["txinwitness"] = [item.hex() for item in txin.witness]
+            entry["sequence"] = txin.sequence
+            vin.append(entry)
+        return {
+            "txid": tx.txid,
+            "hash": tx.wtxid,
+            "version": tx.version,
+            "size": size,
+            "vsize": (weight + 3) // 4,
+            "weight": weight,
+            "locktime": tx.locktime,
+            "vin": vin,
+            "vout": [
+                {"value": btc(o.value), "n": n, "scriptPubKey": self._spk_json(o.script_pubkey)}
+                for n, o in enumerate(tx.vout)
+            ],
+        }
+
+    @staticmethod
+    def _decode_keypaths(entries: Dict[bytes, bytes], key_type: int) -> List[Dict]:
+        derivations = []
+        for pubkey, value in PSBT.keyed(entries, key_type).items():
+            path = [struct.unpack("<I", value[i:i + 4])[0] for i in range(4, len(value), 4)]
+            derivations.append(
+                {"pubkey": pubkey.hex(), "master_fingerprint": value[:4].hex(), "path": _path_str(path)}
+            )
+        return derivations
+
+    def _decode_input(self, psbt: PSBT, i: int) -> Dict:
+        entries = psbt.inputs[i]
+        decoded = {}
+        witness_utxo = self._witness_utxo(psbt, i)
+        if witness_utxo is not None:
+            decoded["witness_utxo"] = {
+                "amount": btc(witness_utxo.value), "scriptPubKey": self._spk_json(witness_utxo.script_pubkey)
+            }
+        signatures = PSBT.keyed(entries, PSBT_IN_PARTIAL_SIG)
+        if signatures:
+            decoded["partial_signatures"] = {k.hex(): v.hex() for k, v in signatures.items()}
+        if bytes([PSBT_IN_WITNESS_SCRIPT]) in entries:
+            decoded["witness_script"] = {"asm": "", "hex": entries[bytes([PSBT_IN_WITNESS_SCRIPT])].hex()}
+        derivations = self._decode_keypaths(entries, PSBT_IN_BIP32_DERIVATION)
+        if derivations:
+            decoded["bip32_derivs"] = derivations
+        if bytes([PSBT_IN_FINAL_SCRIPTWITNESS]) in entries:
+            f = BytesIO(entries[bytes([PSBT_IN_FINAL_SCRIPTWITNESS])])
+            decoded["final_scriptwitness"] = [deser_string(f).hex() for _ in range(deser_compact_size(f))]
+        return decoded
+
+    def _psbt_fee(self, psbt: PSBT) -> Optional[int]:
+        values = [self._witness_utxo(psbt, i) for i in range(len(psbt.tx.vin))]
+        if any(value is None for value in values):
+            return None
+        return sum(v.value for v in values) - sum(o.value for o in psbt.tx.vout)
+
+    # Blockchain rpcs
+
+    def rpc_stop(self):
+        return "Bitcoin Core stopping"
+
+    def rpc_getblockchaininfo(self):
+        tip = self.blocks[-1]
+        return {
+            "chain": "regtest",
+            "blocks": self.height,
+            "headers": self.height,
+            "bestblockhash": tip["hash"],
+            "difficulty": 4.656542373906925e-10,
+            "time": tip["time"],
+            "mediantime": tip["time"],
+            "verificationprogress": 1,
+            "initialblockdownload": False,
+            "chainwork": f"{2 * (self.height + 1):064x}",
+            "size_on_disk": 0,
+            "pruned": False,
+            "warnings": "",
+        }
+
+    def rpc_getbestblockhash(self):
+        return self.blocks[-1]["hash"]
+
+    def rpc_getblockhash(self, height: int):
+        if not 0 <= height <= self.height:
+            raise RPCError(-8, "Block height out of range")
+        return self.blocks[height]["hash"]
+
+    def rpc_getblockcount(self):
+        return self.height
+
+    def _header(self, block: Dict) -> Dict:
+        header = {
+            "hash": block["hash"],
+            "confirmations": self._confirmations(block["height"]),
+            "height": block["height"],
+            "version": 0x20000000,
+            "merkleroot": hash256(b"".join(bytes.fromhex(t) for t in block["tx"]))[::-1].hex(),
+            "time": block["time"],
+            "mediantime": block["time"],
+            "nonce": 0,
+            "bits": "207fffff",
+            "difficulty": 4.656542373906925e-10,
+            "chainwork": f"{2 * (block['height'] + 1):064x}",
+            "nTx": len(block["tx"]),
+        }
+        if block["height"] > 0:
+            header["previousblockhash"] = block["previousblockhash"]
+        if block["height"] < self.height:
+            header["nextblockhash"] = self.blocks[block["height"] + 1]["hash"]
+        return header
+
+    def _header_hex(self, block: Dict) -> str:
+        return (struct.pack("<i", 0x20000000) + bytes.fromhex(block["previousblockhash"])[::-1] +
+                bytes.fromhex(self._header(block)["merkleroot"])[::-1] +
+                struct.pack("<III", block["time"], 0x207fffff, 0)).hex()
+
+    def rpc_getblockheader(self, block_hash: str, verbose: bool = True):
+        block = self._block(block_hash)
+        return self._header(block) if verbose else self._header_hex(block)
+
+    def rpc_getblockstats(self, hash_or_height, stats: Optional[List] = None):
+        block = self.blocks[hash_or_height] if isinstance(hash_or_height, int) else self._block(hash_or_height)
+        txs = [self.txs[txid] for txid in block["tx"]]
+        result = {
+            "blockhash": block["hash"],
+            "height": block["height"],
+            "time": block["time"],
+            "txs": len(txs),
+            "ins": sum(len(r["tx"].vin) for r in txs[1:]),
+            "outs": sum(len(r["tx"].vout) for r in txs),
+            "total_out": sum(o.value for r in txs[1:] for o in r["tx"].vout),
+            "totalfee": sum(r["fee"] for r in txs),
+            "subsidy": 50 * COIN >> (block["height"] // HALVING_INTERVAL),
+        }
+        return {k: v for k, v in result.items() if not stats or k in stats}
+
+    def rpc_getblock(self, block_hash: str, verbosity: int = 1):
+        block = self._block(block_hash)
+        if verbosity == 0:
+            return self._header_hex(block)
+        result = self._header(block)
+        if verbosity == 1:
+            result["tx"] = list(block["tx"])
+        else:
+            result["tx"] = [self._decode_tx(self.txs[txid]["tx"]) for txid in block["tx"]]
+        return result
+
+    def rpc_gettxout(self, txid: str, n: int, include_mempool: bool = True):
+        utxo = self.utxos.get((txid, n))
+        if utxo is None or (utxo["height"] is None and not include_mempool):
+            return None
+        if include_mempool and (txid, n) in self.mempool_spends:
+            return None
+        return {
+            "bestblock": self.blocks[-1]["hash"],
+            "confirmations": self._confirmations(utxo["height"]),
+            "value": btc(utxo["value"]),
+            "scriptPubKey": self._spk_json(utxo["script_pubkey"]),
+            "coinbase": utxo["coinbase"],
+        }
+
+    def rpc_getrawtransaction(self, txid: str, verbose: bool = False, block_hash: Optional[str] = None):
+        record = self.txs.get(txid)
+        if record is None or (block_hash is not None and (
+                record["height"] is None or self.blocks[record["height"]]["hash"] != block_hash)):
+            raise RPCError(
+                -5, "No such mempool or blockchain transaction. Use gettransaction for wallet transactions."
+            )
+        raw = record["tx"].serialize().hex()
+        if not verbose:
+            return raw
+        result = self._decode_tx(record["tx"])
+        result["hex"] = raw
+        if record["height"] is not None:
+            block = self.blocks[record["height"]]
+            result.update(blockhash=block["hash"], confirmations=self._confirmations(block["height"]),
+                          time=block["time"], blocktime=block["time"])
+        return result
+
+    def rpc_generatetoaddress(self, nblocks: int, address: str, maxtries: int = 1000000):
+        script_pubkey = self._script_pubkey(address)
+        hashes = []
+        for _ in range(nblocks):
+            txids, self.mempool = self.mempool, []
+            hashes.append(self._mine_block(txids, script_pubkey)["hash"])
+        return hashes
+
+    def rpc_sendrawtransaction(self, hexstring: str, maxfeerate=0.10):
+        try:
+            tx = Tx.deserialize(bytes.fromhex(hexstring))
+        except (ValueError, IndexError, struct.error):
+            raise RPCError(-22, "TX decode failed. Make sure the tx has at least one input.")
+        return self._accept(tx)
+
+    def rpc_scanblocks(self, action: str, scanobjects: Optional[List] = None, start_height: int = 0,
+                       stop_height: Optional[int] = None, filtertype: str = "basic", options: Optional[Dict] = None):
+        if action == "status":
+            return None
+        if action == "abort":
+            return False
+        if action != "start":
+            raise RPCError(-8, f"Invalid action '{action}'")
+
+        script_pubkeys = set()
+        for scanobject in scanobjects or []:
+            desc = scanobject if isinstance(scanobject, str) else scanobject["desc"]
+            if desc.startswith("addr("):
+                script_pubkeys.add(self._script_pubkey(desc[5:desc.index(")")]))
+        stop_height = self.height if stop_height is None else stop_height
+        relevant = [
+            block["hash"] for block in self.blocks[start_height:stop_height + 1]
+            if any(o.script_pubkey in script_pubkeys for txid in block["tx"] for o in self.txs[txid]["tx"].vout)
+        ]
+        return {"from_height": start_height, "to_height": stop_height, "relevant_blocks": relevant, "completed": True}
+
+    # PSBT rpcs
+
+    def rpc_createpsbt(self, inputs: List, outputs, locktime: int = 0, replaceable: bool = False):
+        default_sequence = 0xfffffffd if replaceable else (0xfffffffe if locktime else 0xffffffff)
+        vin = [TxIn(i["txid"], i["vout"], i.get("sequence", default_sequence)) for i in inputs]
+        return PSBT(Tx(vin, self._parse_outputs(outputs), locktime)).serialize()
+
+    def rpc_decodepsbt(self, psbt: str):
+        parsed = PSBT.parse(psbt)
+        decoded = {
+            "tx": self._decode_tx(parsed.tx),
+            "global_xpubs": [],
+            "psbt_version": 0,
+            "proprietary": [],
+            "unknown": {},
+            "inputs": [self._decode_input(parsed, i) for i in range(len(parsed.tx.vin))],
+            "outputs": [],
+        }
+        for entries in parsed.outputs:
+            output = {}
+            derivations = self._decode_keypaths(entries, PSBT_OUT_BIP32_DERIVATION)
+            if derivations:
+                output["bip32_derivs"] = derivations
+            decoded["outputs"].append(output)
+        fee = self._psbt_fee(parsed)
+        if fee is not None:
+            decoded["fee"] = btc(fee)
+        return decoded
+
+    def rpc_analyzepsbt(self, psbt: str):
+        parsed = PSBT.parse(psbt)
+        inputs = []
+        for i in range(len(parsed.tx.vin)):
+            entries = parsed.inputs[i]
+            is_final = bytes([PSBT_IN_FINAL_SCRIPTWITNESS]) in entries
+            descriptor = self._input_descriptor(parsed, i)
+            signed = len(PSBT.keyed(entries, PSBT_IN_PARTIAL_SIG))
+            if is_final:
+                step = "extractor"
+            elif descriptor is not None and signed >= descriptor.required_signatures:
+                step = "finalizer"
+            else:
+                step = "updater" if bytes([PSBT_IN_WITNESS_UTXO]) not in entries else "signer"
+            inputs.append({"has_utxo": bytes([PSBT_IN_WITNESS_UTXO]) in entries, "is_final": is_final, "next": step})
+
+        steps = ["updater", "signer", "finalizer", "extractor"]
+        result = {"inputs": inputs, "next": min((i["next"] for i in inputs), key=steps.index, default="extractor")}
+        fee = self._psbt_fee(parsed)
+        if fee is not None:
+            result["fee"] = btc(fee)
+        return result
+
+    def _psbt_list(self, psbts) -> List[PSBT]:
+        # Accept both the list as single parameter, and the psbts as parameters
+        if len(psbts) == 1 and isinstance(psbts[0], list):
+            psbts = psbts[0]
+        return [PSBT.parse(psbt) for psbt in psbts]
+
+    def rpc_combinepsbt(self, *psbts):
+        parsed = self._psbt_list(psbts)
+        combined = parsed[0]
+        for other in parsed[1:]:
+            if other.tx.txid != combined.tx.txid:
+                raise RPCError(-8, "PSBTs not compatible (different transactions)")
+            combined.global_map.update(other.global_map)
+            for mine, theirs in zip(combined.inputs + combined.outputs, other.inputs + other.outputs):
+                mine.update(theirs)
+        return combined.serialize()
+
+    def rpc_joinpsbts(self, *psbts):
+        parsed = self._psbt_list(psbts)
+        tx = Tx([txin for p in parsed for txin in p.tx.vin], [txout for p in parsed for txout in p.tx.vout])
+        return PSBT(tx, {}, [m for p in parsed for m in p.inputs], [m for p in parsed for m in p.outputs]).serialize()
+
+    def rpc_finalizepsbt(self, psbt: str, extract: bool = True):
+        parsed = PSBT.parse(psbt)
+        complete = all([self._finalize_input(parsed, i) for i in range(len(parsed.tx.vin))])
+        if not complete or not extract:
+            return {"psbt": parsed.serialize(), "complete": complete}
+
+        for txin, entries in zip(parsed.tx.vin, parsed.inputs):
+            f = BytesIO(entries[bytes([PSBT_IN_FINAL_SCRIPTWITNESS])])
+            txin.witness = [deser_string(f) for _ in range(deser_compact_size(f))]
+        return {"hex": parsed.tx.serialize().hex(), "complete": True}
+
+    def rpc_utxoupdatepsbt(self, psbt: str, descriptors: Optional[List] = None):
+        parsed = PSBT.parse(psbt)
+        for i in range(len(parsed.tx.vin)):
+            self._update_input(None, parsed, i, sign=False)
+        return parsed.serialize()
+
+    # Wallet rpcs
+
+    def rpc_createwallet(self, wallet_name: str, disable_private_keys: bool = False, blank: bool = False,
+                         passphrase: str = "", avoid_reuse: bool = False, descriptors: bool = True,
+                         load_on_startup: Optional[bool] = None):
+        if wallet_name in self.wallets:
+            raise RPCError(-4, f"Wallet file verification failed. Failed to create database path "
+                               f"'{wallet_name}'. Database already exists.")
+        wallet = Wallet(wallet_name, disable_private_keys, passphrase)
+        self.wallets[wallet_name] = wallet
+        if not blank and not disable_private_keys:
+            # Like bitcoind, a wallet gets its own keys unless created blank
+            xprv = BIP32.from_seed(sha256(wallet_name.encode()), network="test").get_xpriv()
+            self._import_descriptor(wallet, {"desc": f"wpkh({xprv}/84'/1'/0'/0/*)", "active": True})
+            self._import_descriptor(wallet, {"desc": f"wpkh({xprv}/84'/1'/0'/1/*)", "active": True, "internal": True})
+        return {"name": wallet_name, "warning": ""}
+
+    def rpc_listwallets(self):
+        return list(self.wallets)
+
+    def rpc_listwalletdir(self):
+        return {"wallets": [{"name": name} for name in self.wallets]}
+
+    def _import_descriptor(self, wallet: Wallet, request: Dict):
+        descriptor = Descriptor(request["desc"])
+        if any(key.has_private for key in descriptor.keys) and not wallet.private_keys_enabled:
+            raise RPCError(-4, "Cannot import private keys to a wallet with private keys disabled")
+        if descriptor.public in wallet.descriptors:
+            # Reimporting with private keys upgrades the descriptor
+            previous = wallet.descriptors[descriptor.public]["desc"]
+            if sum(k.has_private for k in previous.keys) > sum(k.has_private for k in descriptor.keys):
+                descriptor = previous
+
+        descriptor_range = request.get("range", [0, 999])
+        descriptor_range = [0, descriptor_range] if isinstance(descriptor_range, int) else descriptor_range
+        internal = request.get("internal", False)
+        active = request.get("active", False)
+        if active:
+            for entry in wallet.descriptors.values():
+                if entry["internal"] == internal:
+                    entry["active"] = False
+
+        wallet.descriptors[descriptor.public] = {
+            "desc": descriptor,
+            "active": active,
+            "internal": internal,
+            "range": descriptor_range,
+            "next_index": request.get("next_index", 0),
+            "timestamp": int(time.time()) if request.get("timestamp", "now") == "now" else request["timestamp"],
+        }
+        self.descriptors.setdefault(descriptor.public, descriptor)
+        indexes = range(descriptor_range[0], descriptor_range[1] + 1) if descriptor.ranged else [0]
+        for index in indexes:
+            self.addresses.setdefault(self._address(descriptor.script_pubkey(index)), (descriptor.public, index))
+
+    def rpc_importdescriptors(self, wallet: Wallet, requests: List):
+        results = []
+        for request in requests:
+            try:
+                self._import_descriptor(wallet, request)
+                results.append({"success": True})
+            except RPCError as e:
+                results.append({"success": False, "error": {"code": e.code, "message": e.message}})
+        return results
+
+    def rpc_importaddress(self, wallet: Wallet, address: str, label: str = "", rescan: bool = True,
+                          p2sh: bool = False):
+        self._script_pubkey(address)
+        wallet.watch_only[address] = label
+        return None
+
+    def rpc_importmulti(self, wallet: Wallet, requests: List, options: Optional[Dict] = None):
+        results = []
+        for request in requests:
+            try:
+                if "desc" in request:
+                    self._import_descriptor(wallet, request)
+                else:
+                    self.rpc_importaddress(wallet, request["scriptPubKey"]["address"], request.get("label", ""))
+                results.append({"success": True})
+            except RPCError as e:
+                results.append({"success": False, "error": {"code": e.code, "message": e.message}})
+        return results
+
+    def rpc_listdescriptors(self, wallet: Wallet, private: bool = False):
+        if private and not wallet.private_keys_enabled:
+            raise RPCError(-4, "Can't get descriptor string.")
+        descriptors = []
+        for entry in wallet.descriptors.values():
+            descriptor = entry["desc"]
+            descriptors.append({
+                "desc": descsum_create(descriptor.private if private else descriptor.public),
+                "timestamp": entry["timestamp"],
+                "active": entry["active"],
+                "internal": entry["internal"],
+                "range": entry["range"],
+                "next": entry["next_index"],
+            })
+        return {"wallet_name": wallet.name, "descriptors": descriptors}
+
+    def rpc_getnewaddress(self, wallet: Wallet, label: str = "", address_type: Optional[str] = None):
+        address = self._derive_address(wallet, internal=False)
+        wallet.labels[address] = label
+        return address
+
+    def rpc_getrawchangeaddress(self, wallet: Wallet, address_type: Optional[str] = None):
+        return self._derive_address(wallet, internal=True)
+
+    def rpc_getaddressinfo(self, wallet: Wallet, address: str):
+        script_pubkey = self._script_pubkey(address)
+        owner = self._owner_descriptor(wallet, address)
+        info = {
+            "address": address,
+            "scriptPubKey": script_pubkey.hex(),
+            "ismine": owner is not None,
+            "solvable": owner is not None,
+            "iswatchonly": address in wallet.watch_only,
+            "isscript": len(script_pubkey) == 34,
+            "iswitness": True,
+            "witness_version": 0,
+            "witness_program": script_pubkey[2:].hex(),
+            "ischange": owner is not None and owner[0]["internal"],
+            "labels": [wallet.labels[address]] if address in wallet.labels else [],
+        }
+        if owner is not None:
+            entry, index = owner
+            info["desc"] = descsum_create(entry["desc"].public.replace("*", str(index)))
+            info["timestamp"] = entry["timestamp"]
+        return info
+
+    def rpc_getbalance(self, wallet: Wallet, dummy: str = "*", minconf: int = 0, include_watchonly: bool = True,
+                       avoid_reuse: bool = True):
+        return btc(sum(utxo["value"] for _, _, utxo, _, _ in self._wallet_utxos(wallet, minconf)))
+
+    def rpc_getwalletinfo(self, wallet: Wallet):
+        balance = self.rpc_getbalance(wallet, minconf=1)
+        return {
+            "walletname": wallet.name,
+            "walletversion": 169900,
+            "format": "sqlite",
+            "balance": balance,
+            "unconfirmed_balance": round(self.rpc_getbalance(wallet, minconf=0) - balance, 8),
+            "immature_balance": btc(sum(
+                utxo["value"] for _, _, utxo, _, _ in self._wallet_utxos(wallet, spendable_only=False)
+                if utxo["coinbase"] and self._confirmations(utxo["height"]) < COINBASE_MATURITY
+            )),
+            "txcount": len(self._wallet_txids(wallet)),
+            "keypoolsize": 1000,
+            "private_keys_enabled": wallet.private_keys_enabled,
+            "avoid_reuse": False,
+            "scanning": False,
+            "descriptors": True,
+            "external_signer": False,
+        }
+
+    def rpc_listunspent(self, wallet: Wallet, minconf: int = 1, maxconf: int = 9999999,
+                        addresses: Optional[List] = None, query_options: Optional[Dict] = None):
+        query_options = query_options or {}
+        minimum_amount = to_sats(query_options.get("minimumAmount", 0))
+        maximum_amount = to_sats(query_options.get("maximumAmount", 21000000))
+        maximum_count = query_options.get("maximumCount", 0)
+        minimum_sum = to_sats(query_options.get("minimumSumAmount", 21000000))
+
+        unspent = []
+        total = 0
+        for txid, n, utxo, address, confirmations in self._wallet_utxos(wallet, minconf):
+            if confirmations > maxconf or (addresses and address not in addresses):
+                continue
+            if not minimum_amount <= utxo["value"] <= maximum_amount:
+                continue
+            owner = self._owner_descriptor(wallet, address)
+            entry = {
+                "txid": txid,
+                "vout": n,
+                "address": address,
+                "label": wallet.labels.get(address, ""),
+                "scriptPubKey": utxo["script_pubkey"].hex(),
+                "amount": btc(utxo["value"]),
+                "confirmations": confirmations,
+                "spendable": owner is not None and any(k.has_private for k in owner[0]["desc"].keys),
+                "solvable": owner is not None,
+                "safe": confirmations > 0,
+            }
+            if owner is not None:
+                entry["desc"] = descsum_create(owner[0]["desc"].public.replace("*", str(owner[1])))
+                if owner[0]["desc"].is_script:
+                    entry["witnessScript"] = owner[0]["desc"].witness_script(owner[1]).hex()
+            unspent.append(entry)
+            total += utxo["value"]
+            if (maximum_count and len(unspent) >= maximum_count) or total >= minimum_sum:
+                break
+        return unspent
+
+    def _wallet_tx_entries(self, wallet: Wallet, txid: str) -> List[Dict]:
+        record = self.txs[txid]
+        entries = []
+        for prevout in record["prevouts"]:
+            address = self._address(prevout["script_pubkey"])
+            if self._is_mine(wallet, address):
+                for n, txout in enumerate(record["tx"].vout):
+                    if not self._is_mine(wallet, self._address(txout.script_pubkey)):
+                        entries.append({"address": self._address(txout.script_pubkey), "category": "send",
+                                        "amount": -btc(txout.value), "vout": n, "fee": -btc(record["fee"])})
+                break
+        for n, txout in enumerate(record["tx"].vout):
+            address = self._address(txout.script_pubkey)
+            if self._is_mine(wallet, address):
+                category = "receive"
+                if record["coinbase"]:
+                    category = "generate" if self._confirmations(record["height"]) >= COINBASE_MATURITY else "immature"
+                entries.append({"address": address, "category": category, "amount": btc(txout.value), "vout": n})
+        return entries
+
+    def _wallet_tx(self, wallet: Wallet, txid: str) -> Dict:
+        record = self.txs[txid]
+        result = {"confirmations": self._confirmations(record["height"])}
+        if record["height"] is not None:
+            block = self.blocks[record["height"]]
+            result.update(blockhash=block["hash"], blockheight=block["height"], blocktime=block["time"])
+        result.update(txid=txid, time=record["time"], timereceived=record["time"])
+        return result
+
+    def rpc_gettransaction(self, wallet: Wallet, txid: str, include_watchonly: bool = True, verbose: bool = False):
+        if txid not in self.txs or txid not in self._wallet_txids(wallet):
+            raise RPCError(-5, "Invalid or non-wallet transaction id")
+        details = self._wallet_tx_entries(wallet, txid)
+        result = {"amount": round(sum(d["amount"] for d in details), 8)}
+        result.update(self._wallet_tx(wallet, txid))
+        result["bip125-replaceable"] = "no" if self.txs[txid]["height"] is not None else "unknown"
+        result["details"] = details
+        result["hex"] = self.txs[txid]["tx"].serialize().hex()
+        if verbose:
+            result["decoded"] = self._decode_tx(self.txs[txid]["tx"])
+        return result
+
+    def rpc_listsinceblock(self, wallet: Wallet, block_hash: str = "", target_confirmations: int = 1,
+                           include_watchonly: bool = True, include_removed: bool = True):
+        since = self._block(block_hash)["height"] if block_hash else -1
+        transactions = []
+        for txid in self._wallet_txids(wallet):
+            height = self.txs[txid]["height"]
+            if height is not None and height <= since:
+                continue
+            for entry in self._wallet_tx_entries(wallet, txid):
+                transactions.append({**entry, **self._wallet_tx(wallet, txid)})
+        last_block = self.blocks[max(0, self.height - target_confirmations + 1)]["hash"]
+        return {"transactions": transactions, "removed": [], "lastblock": last_block}
+
+    def rpc_listreceivedbyaddress(self, wallet: Wallet, minconf: int = 1, include_empty: bool = False,
+                                  include_watchonly: bool = True, address_filter: Optional[str] = None):
+        received: Dict[str, Dict] = {}
+        for txid, record in self.txs.items():
+            confirmations = self._confirmations(record["height"])
+            if confirmations < minconf:
+                continue
+            for txout in record["tx"].vout:
+                address = self._address(txout.script_pubkey)
+                if not self._is_mine(wallet, address) or (address_filter and address != address_filter):
+                    continue
+                entry = received.setdefault(address, {
+                    "address": address, "amount": 0, "confirmations": confirmations,
+                    "label": wallet.labels.get(address, ""), "txids": []
+                })
+                entry["amount"] = round(entry["amount"] + btc(txout.value), 8)
+                entry["confirmations"] = min(entry["confirmations"], confirmations)
+                entry["txids"].append(txid)
+        return list(received.values())
+
+    def rpc_walletlock(self, wallet: Wallet):
+        if not wallet.encrypted:
+            raise RPCError(-15, "Error: running with an unencrypted wallet, but walletlock was called.")
+        return None
+
+    def rpc_walletprocesspsbt(self, wallet: Wallet, psbt: str, sign: bool = True, sighashtype: str = "ALL",
+                              bip32derivs: bool = True, finalize: bool = True):
+        parsed = PSBT.parse(psbt)
+        for i in range(len(parsed.tx.vin)):
+            self._update_input(wallet, parsed, i, sign)
+        for i in range(len(parsed.tx.vout)):
+            self._update_output(wallet, parsed, i)
+
+        complete = True
+        for i in range(len(parsed.tx.vin)):
+            if finalize and sign:
+                complete = self._finalize_input(parsed, i) and complete
+            else:
+                complete = bytes([PSBT_IN_FINAL_SCRIPTWITNESS]) in parsed.inputs[i] and complete
+        return {"psbt": parsed.serialize(), "complete": complete}
+
+    def rpc_walletcreatefundedpsbt(self, wallet: Wallet, inputs: List, outputs, locktime: int = 0,
+                                   options: Optional[Dict] = None, bip32derivs: bool = True):
+        vin = [TxIn(i["txid"], i["vout"], i.get("sequence", 0xfffffffd)) for i in inputs or []]
+        tx, change_pos = self._fund(wallet, self._parse_outputs(outputs), vin)
+        tx.locktime = locktime
+        parsed = PSBT(tx)
+        for i in range(len(tx.vin)):
+            self._update_input(wallet, parsed, i, sign=False)
+        for i in range(len(tx.vout)):
+            self._update_output(wallet, parsed, i)
+        return {"psbt": parsed.serialize(), "fee": btc(self._psbt_fee(parsed)), "changepos": change_pos}
+
+    def _send(self, wallet: Wallet, outputs: List[TxOut]) -> str:
+        if not wallet.private_keys_enabled:
+            raise RPCError(-4, "Error: Private keys are disabled for this wallet")
+        tx, _ = self._fund(wallet, outputs, [])
+        parsed = PSBT(tx)
+        for i in range(len(tx.vin)):
+            self._update_input(wallet, parsed, i, sign=True)
+        result = self.rpc_finalizepsbt(parsed.serialize())
+        if not result["complete"]:
+            raise RPCError(-4, "Signing transaction failed")
+        return self._accept(Tx.deserialize(bytes.fromhex(result["hex"])))
+
+    def rpc_sendtoaddress(self, wallet: Wallet, address: str, amount: float, comment: str = "",
+                          comment_to: str = "", subtractfeefromamount: bool = False, replaceable: bool = True,
+                          conf_target: Optional[int] = None, estimate_mode: str = "unset",
+                          avoid_reuse: bool = True, fee_rate: Optional[float] = None):
+        value = to_sats(amount) - (WALLET_FEE if subtractfeefromamount else 0)
+        return self._send(wallet, [TxOut(value, self._script_pubkey(address))])
+
+    def rpc_sendmany(self, wallet: Wallet, dummy: str = "", amounts: Optional[Dict] = None, minconf: int = 1,
+                     comment: str = "", subtractfeefrom: Optional[List] = None, replaceable: bool = True,
+                     conf_target: Optional[int] = None, estimate_mode: str = "unset",
+                     fee_rate: Optional[float] = None, verbose: bool = False):
+        if not amounts:
+            raise RPCError(-8, "Invalid parameter, amounts must be a non-empty object")
+        return self._send(wallet, self._parse_outputs(amounts))
@@ -0,0 +1,30 @@
+import orjson
+import pytest
+
+from ..src.json_stream import JSONArrayStream
+
+def stream(document: bytes, chunk_size: int):
+    parser = JSONArrayStream()
+    items = []
+    for i in range(0, len(document), chunk_size):
+        items.extend(parser.feed(document[i:i + chunk_size]))
+    return items, parser.close()
+
+@pytest.mark.parametrize("result", [
+    [{"txid": "a,]", "vout": 0}, {"txid": "b", "vout": 1, "path": [1, [2]]}],
+    ["0f,", "[\"x\"]", "", "e\\u00e9"],
+    [1, -2.5e3, True, False, None, 123456789012],
+    [1, "two", {"three": [3]}, [4, {}], None],
+    [[], {}, []],
+    [],
+])
+@pytest.mark.parametrize("chunk_size", [1, 3, 4096])
+@pytest.mark.parametrize("option", [None, orjson.OPT_INDENT_2])
+def test_stream_array_elements(result, chunk_size, option):
+    """Every element of the array is returned, whatever its type, in whatever chunks it arrives"""
+    document = orjson.dumps({"result": result, "error": None, "id": 1}, option=option)
+
+    items, envelope = stream(document, chunk_size)
+
+    assert items == result
+    assert envelope == {"result": None, "error": None, "id": 1}
@@ -0,0 +1,62 @@
+import contextvars
+
+import pytest
+
+from .test_framework.utils import createpsbt
+from ..src.daemon import run_job, sync_aggregate_spends
+from ..src.errors import LeaseLostError
+from ..src.lease import Lease, FENCING_LEASE, fenced
+from ..src.models import AggregateSpends, Leases
+
+def take_over(lease: Lease, name: str) -> Lease:
+    """Expire `lease` in the database, as a leader that stopped renewing it, and take it over"""
+    Leases.update({"expires_at": 0}, {"name": name, "holder": lease.holder})
+    new_leader = Lease(name, holder="new-leader", max_clock_skew=0)
+    assert new_leader.try_acquire()
+    return new_leader
+
+def signed_and_confirmed_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1) -> int:
+    unspent = resigner_wallet.listunspent(7)
+    unsigned_psbt = createpsbt(
+        resigner_wallet, [unspent[0]], funder.getnewaddress(), 0.01, user_change_wallet_1.getnewaddress()
+    )
+    response = client.post("/process-psbt", json={"psbt": user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]})
+    resigner_wallet.sendrawtransaction(resigner_wallet.finalisepsbt(response.json["psbt"])["hex"])
+    funder.generatetoaddress(7, funder.getnewaddress())
+    return AggregateSpends.get()[0]["unconfirmed_daily_spends"]
+
+def test_lease_lost_mid_job(config, client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """A leader whose lease was taken over mid-job makes none of the job's writes"""
+    amount = signed_and_confirmed_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1)
+    # Left by an earlier run against the same database
+    Leases.delete({"name": "test-daemon"})
+    leader = Lease("test-daemon", ttl=60, holder="leader", max_clock_skew=0)
+    assert leader.try_acquire()
+
+    def job():
+        with fenced():
+            AggregateSpends.add(unconfirmed_sats=1)
+        # The leader stalled past its lease, still believing it holds it
+        take_over(leader, "test-daemon")
+        assert leader.held
+        with pytest.raises(LeaseLostError):
+            sync_aggregate_spends(config)
+        run_job("sync_aggregate_spends", sync_aggregate_spends, config)
+
+    context = contextvars.copy_context()
+    context.run(FENCING_LEASE.set, leader)
+    context.run(job)
+
+    spends = AggregateSpends.get()[0]
+    assert spends["unconfirmed_daily_spends"] == amount + 1 and spends["confirmed_daily_spends"] == 0
+    assert not leader.held
+
+def test_spend_confirmed_once(config, client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """A spend confirmed by two overlapping syncs is only counted once"""
+    amount = signed_and_confirmed_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1)
+
+    sync_aggregate_spends(config)
+    sync_aggregate_spends(config)
+
+    spends = AggregateSpends.get()[0]
+    assert spends["unconfirmed_daily_spends"] == 0 and spends["confirmed_daily_spends"] == amount
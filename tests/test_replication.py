@@ -0,0 +1,39 @@
+import time
+import calendar
+
+from ..src.replication import SpendReplica, spend_periods
+
+def gmtime(date: str) -> time.struct_time:
+    return time.gmtime(calendar.timegm(time.strptime(date, "%Y-%m-%d")))
+
+def test_week_across_year_boundary():
+    """The days of a week spanning two years are in the same weekly period"""
+    monday, sunday, next_monday = gmtime("2024-12-30"), gmtime("2025-01-05"), gmtime("2025-01-06")
+
+    assert spend_periods(monday)["weekly"] == spend_periods(sunday)["weekly"]
+    assert spend_periods(sunday)["weekly"] != spend_periods(next_monday)["weekly"]
+    assert spend_periods(monday)["monthly"] != spend_periods(sunday)["monthly"]
+
+def test_spends_of_a_week_across_year_boundary():
+    now = [gmtime("2024-12-31")]
+    replica = SpendReplica()
+    replica.configure({"node_id": "a", "secret": "s"}, lambda: now[0])
+
+    replica.record(1000)
+    now[0] = gmtime("2025-01-02")
+    replica.record(500)
+
+    totals = replica.totals({})
+    assert totals["weekly"] == 1500
+    assert totals["daily"] == 500 and totals["monthly"] == 500
+
+def test_seed_from_aggregate_spends():
+    """The spends recorded before replication was enabled are counted once"""
+    replica = SpendReplica()
+    replica.configure({"node_id": "a", "secret": "s"}, lambda: gmtime("2025-01-02"))
+    replica.record(-200)
+
+    replica.seed({"daily": 1000, "weekly": 3000, "monthly": 5000})
+    replica.seed({"daily": 1000, "weekly": 3000, "monthly": 5000})
+
+    assert replica.totals({}) == {"daily": 1000, "weekly": 3000, "monthly": 5000}
@@ -0,0 +1,96 @@
+import pytest
+
+from .test_framework.utils import createpsbt
+from ..src.crypto.key import ExtendedKey, KeyOriginInfo
+from ..src.db import Database, Session
+from ..src.helper import hash160
+from ..src.main import init_db
+from ..src.models import SignedSpends, SpentUtxos
+from ..src.psbt import PSBT
+from ..src.tenants import RESIGNER_FINGERPRINTS, TENANTS, Tenant, wallet_fingerprints
+
+RESIGNER_XPRV = (
+    "tprv8ZgxMBicQKsPcu7atsTZmCB59KA6mhFr4TyKBghM7Tqu3cNHxVD2S2KFoth2b7c9tZsD3PetrANdQ8oc5KUw3KcZr273Vgxrd1dTzyGepSG"
+)
+
+# The cosigner key of the test tenant
+TENANT_FINGERPRINT = bytes.fromhex("0badc0de")
+
+@pytest.fixture
+def tenant(config, tmp_path):
+    database = Database(str(tmp_path / "tenant.db"))
+    with Session.use(database):
+        init_db()
+    tenant = Tenant("acme", config.derive({}), database, {TENANT_FINGERPRINT})
+    TENANTS.register(tenant)
+    yield tenant
+    TENANTS.tenants.clear()
+    TENANTS.by_fingerprint.clear()
+
+def with_tenant_key(psbt: str, inputs: list) -> str:
+    """`psbt` with a derivation from the tenant's key added to its `inputs`"""
+    parsed = PSBT()
+    parsed.deserialize(psbt)
+    for i in inputs:
+        parsed.inputs[i].hd_keypaths[b"\x02" + bytes(range(32))] = KeyOriginInfo(TENANT_FINGERPRINT, [0, 1])
+    return parsed.serialize()
+
+@pytest.fixture
+def resigner_fingerprints(resigner_wallet):
+    RESIGNER_FINGERPRINTS.update(wallet_fingerprints("wallet", resigner_wallet))
+    yield RESIGNER_FINGERPRINTS
+    RESIGNER_FINGERPRINTS.clear()
+
+def test_unparseable_psbt(client, resigner_fingerprints):
+    """A PSBT that can't be parsed is rejected, not routed to the default wallet"""
+    response = client.post("/process-psbt", json={"psbt": "cHNidP8BAH0CAAAAAZ"})
+    assert response.status_code == 400
+
+    response = client.post("/process-psbt/batch", json={"psbts": ["not a psbt"]})
+    assert response.status_code == 200
+    assert response.json["results"][0]["error_code"] == 400
+
+def test_psbt_with_foreign_keys(client, resigner_fingerprints, funder, resigner_wallet, user_wallet_1,
+                                user_change_wallet_1):
+    """Only PSBTs deriving from the resigner's keys are signed"""
+    foreign_psbt = funder.walletcreatefundedpsbt([{funder.getnewaddress(): 0.01}])["psbt"]
+    response = client.post("/process-psbt", json={"psbt": foreign_psbt})
+    assert response.status_code == 403
+    assert SignedSpends.get() == []
+
+    unspent = resigner_wallet.listunspent(7)
+    unsigned_psbt = createpsbt(
+        resigner_wallet, [unspent[0]], funder.getnewaddress(), 0.01, user_change_wallet_1.getnewaddress()
+    )
+    response = client.post("/process-psbt", json={"psbt": user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]})
+    assert response.status_code == 200
+
+def test_tenant_fingerprints_leave_out_the_resigner_key(resigner_wallet):
+    """The resigner's own key, shared by its wallets, doesn't route PSBTs to a tenant"""
+    resigner_key = hash160(ExtendedKey.deserialize(RESIGNER_XPRV).pubkey)[:4]
+    assert resigner_key in wallet_fingerprints("wallet", resigner_wallet)
+
+    cosigners = wallet_fingerprints("wallet", resigner_wallet, cosigners_only=True)
+    assert cosigners and resigner_key not in cosigners
+
+def test_psbt_routed_by_forged_keys(client, tenant, resigner_fingerprints, funder, resigner_wallet, user_wallet_1,
+                                    user_change_wallet_1):
+    """A PSBT of the default wallet's utxos isn't signed by a tenant whose key it was given"""
+    unspent = resigner_wallet.listunspent(7)
+    unsigned_psbt = createpsbt(
+        resigner_wallet, unspent[:2], funder.getnewaddress(), 0.01, user_change_wallet_1.getnewaddress()
+    )
+    psbt = user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]
+
+    # Inputs of two wallets
+    response = client.post("/process-psbt", json={"psbt": with_tenant_key(psbt, [0])})
+    assert response.status_code == 403 and "several wallets" in response.json["message"]
+    # Every input routed to the tenant, none of them its utxos
+    response = client.post("/process-psbt", json={"psbt": with_tenant_key(psbt, [0, 1])})
+    assert response.status_code == 403 and "aren't the wallet's" in response.json["message"]
+    response = client.post("/process-psbt/batch", json={"psbts": [with_tenant_key(psbt, [0, 1])]})
+    assert response.json["results"][0]["error_code"] == 403
+
+    assert SignedSpends.get() == [] and SpentUtxos.get() == []
+    with Session.use(tenant.database):
+        assert SignedSpends.get() == [] and SpentUtxos.get() == []
@@ -0,0 +1,115 @@
+import time
+from collections import Counter
+
+import httpx
+import pytest
+
+from .test_framework.fake_bitcoind import FakeBitcoind
+from ..src import BitcoindRPC
+from ..src.rpc_backend import CLOSED, HALF_OPEN, OPEN
+
+class Nodes(httpx.BaseTransport):
+    """Several bitcoind nodes, by host, serving the same chain: some can be down or slow"""
+    def __init__(self, node: FakeBitcoind, down=(), delays=None):
+        self.node = node
+        self.down = set(down)
+        self.delays = delays or {}
+        self.requests = Counter()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        self.requests[host] += 1
+        if host in self.down:
+            raise httpx.ConnectError("node down", request=request)
+        time.sleep(self.delays.get(host, 0))
+        return self.node.handle_request(request)
+
+@pytest.fixture
+def node():
+    return FakeBitcoind()
+
+def rpc_client(nodes: Nodes, **options) -> BitcoindRPC:
+    return BitcoindRPC(["http://a", "http://b"], "user", "passwd", transport=nodes, cache_size=0, **options)
+
+def test_failover_to_the_next_node(node):
+    nodes = Nodes(node, down={"a"})
+    btd_client = rpc_client(nodes)
+
+    assert btd_client.getblockcount() == 0
+    assert nodes.requests == {"a": 1, "b": 1}
+    a, b = btd_client.backends
+    assert a.score > b.score
+
+def test_circuit_breaker(node):
+    nodes = Nodes(node, down={"a"})
+    btd_client = rpc_client(nodes, circuit_failure_threshold=1, circuit_reset_timeout=0.2)
+    a, b = btd_client.backends
+
+    btd_client.getblockcount()
+    assert a.state == OPEN
+
+    # While its circuit is open, the node isn't sent requests
+    btd_client.getblockcount()
+    assert nodes.requests["a"] == 1
+
+    time.sleep(0.2)
+    assert a.state == HALF_OPEN
+    nodes.down = {"b"}
+    # The half-open node is probed, and its circuit closes when it answers
+    assert btd_client.getblockcount() == 0
+    assert nodes.requests["a"] == 2
+    assert a.state == CLOSED
+    assert b.state == OPEN
+
+def test_hedged_request_first_answer_wins(node):
+    nodes = Nodes(node, delays={"a": 0.5})
+    btd_client = rpc_client(nodes, hedge_min_delay=0.01)
+
+    start = time.monotonic()
+    assert btd_client.getblockcount() == 0
+    assert time.monotonic() - start < 0.4
+    # The slow node was sent the request first, the hedge answered
+    assert nodes.requests == {"a": 1, "b": 1}
+
+def test_hedged_request_failure_doesnt_win(node):
+    nodes = Nodes(node, down={"b"}, delays={"a": 0.1})
+    btd_client = rpc_client(nodes, hedge_min_delay=0.01)
+
+    # The hedge fails first, the slow node's answer is returned
+    assert btd_client.getblockcount() == 0
+    assert nodes.requests == {"a": 1, "b": 1}
+
+def mined_output(node: FakeBitcoind, btd_client: BitcoindRPC):
+    """The coinbase output of a new block"""
+    btd_client.createwallet("miner", False, False, "", False, True)
+    miner = btd_client.for_wallet("http://fake/wallet/miner", "user", "passwd")
+    block_hash = miner.generatetoaddress(1, miner.getnewaddress())[0]
+    return btd_client.getblock(block_hash)["tx"][0], 0
+
+def test_gettxout_with_mempool_isnt_cached(node):
+    btd_client = BitcoindRPC("http://fake", "user", "passwd", transport=node)
+    txid, vout = mined_output(node, btd_client)
+
+    calls = node.calls["gettxout"]
+    assert btd_client.gettxout(txid, vout, False) == btd_client.gettxout(txid, vout, False)
+    assert node.calls["gettxout"] == calls + 1
+
+    # The mempool can spend the output without the tip changing
+    btd_client.gettxout(txid, vout, True)
+    btd_client.gettxout(txid, vout, True)
+    assert node.calls["gettxout"] == calls + 3
+
+def test_cache_invalidated_on_tip_change(node):
+    btd_client = BitcoindRPC("http://fake", "user", "passwd", transport=node, cache_tip_check_interval=0)
+    txid, vout = mined_output(node, btd_client)
+
+    calls = node.calls["gettxout"]
+    confirmations = btd_client.gettxout(txid, vout, False)["confirmations"]
+    assert btd_client.gettxout(txid, vout, False)["confirmations"] == confirmations
+    assert node.calls["gettxout"] == calls + 1
+
+    miner = btd_client.for_wallet("http://fake/wallet/miner", "user", "passwd")
+    miner.generatetoaddress(1, miner.getnewaddress())
+    assert btd_client.gettxout(txid, vout, False)["confirmations"] == confirmations + 1
+    assert node.calls["gettxout"] == calls + 2
+    assert btd_client.cache_stats()["invalidations"] == 1
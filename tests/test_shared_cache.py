@@ -0,0 +1,66 @@
+import time
+import multiprocessing
+
+import pytest
+
+from ..src.shared_cache import WalletUtxos
+
+TXID = "11" * 32
+
+def utxo_rows(count: int, amount_sats: int = 1000) -> list:
+    return [{"txid": TXID, "vout": vout, "amount_sats": amount_sats, "blockheight": 100} for vout in range(count)]
+
+def lookup_in_child(path: str, vouts: list, results):
+    table = WalletUtxos(path)
+    results.put([table.lookup(TXID, vout) for vout in vouts])
+
+def publish_in_child(path: str, rows: list):
+    WalletUtxos(path).publish_rows(rows)
+
+@pytest.fixture
+def table_path(tmp_path):
+    return str(tmp_path / "utxos")
+
+def run(target, *args):
+    process = multiprocessing.get_context("fork").Process(target=target, args=args)
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+
+def test_published_to_other_processes(table_path):
+    WalletUtxos(table_path).publish_rows(utxo_rows(20))
+
+    results = multiprocessing.get_context("fork").Queue()
+    run(lookup_in_child, table_path, [0, 19, 20], results)
+    assert results.get(timeout=10) == [(1000, 100), (1000, 100), None]
+
+    # Published by another process, read by this one
+    reader = WalletUtxos(table_path)
+    run(publish_in_child, table_path, utxo_rows(30, amount_sats=2000))
+    assert reader.lookup(TXID, 29) == (2000, 100)
+    assert len(reader) == 30
+
+def test_stale_table_remapped(table_path):
+    publisher = WalletUtxos(table_path)
+    reader = WalletUtxos(table_path)
+    publisher.publish_rows(utxo_rows(10))
+    assert reader.lookup(TXID, 5) == (1000, 100)
+
+    # The mapping the reader holds is marked stale: it maps the new table, not the spent utxos
+    run(publish_in_child, table_path, utxo_rows(3))
+    assert reader.lookup(TXID, 5) is None
+    assert reader.lookup(TXID, 2) == (1000, 100)
+    assert len(reader) == 3
+
+def test_table_ignored_after_max_age(table_path):
+    WalletUtxos(table_path).publish_rows(utxo_rows(3))
+    reader = WalletUtxos(table_path, max_age=0.1)
+    assert reader.published
+    assert reader.lookup(TXID, 0) == (1000, 100)
+
+    time.sleep(0.15)
+    assert not reader.published
+    assert reader.lookup(TXID, 0) is None
+
+    WalletUtxos(table_path).publish_rows(utxo_rows(3))
+    assert reader.lookup(TXID, 0) == (1000, 100)
@@ -4,6 +4,7 @@ import pytest
 
 from .test_framework.utils import fund_address, createpsbt, reset_aggregate_spends
 from ..src import AggregateSpends
+from ..src.policy import SpendLimit
 
 SATS = 100000000
 
@@ -29,3 +30,17 @@ def test_spendlimit_policy(config, client, funder, resigner_wallet, user_wallet_
     response = client.post("/process-psbt", json={"psbt": incomplete_psbt})
 
     assert response.json["error_code"] == 403 and response.json["message"] ==  "PSBT Failed to satisfy configured SpendLimit policy"
+
+def test_monthly_spendlimit(config, client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1):
+    """Attempt to spend above monthly limit, within the weekly one"""
+    monthly_limit = config.get("spending_limt")["monthly_limit"]
+    AggregateSpends.delete()
+    AggregateSpends.insert(confirmed_weekly_spends=1000, confirmed_monthly_spends=monthly_limit - 1000)
+    assert SpendLimit(config).aggregate_totals() == {"daily": 0, "weekly": 1000, "monthly": monthly_limit - 1000}
+
+    unsigned_psbt = create_funded_psbt(funder, resigner_wallet, user_change_wallet_1, 0.01)
+    incomplete_psbt = user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]
+
+    response = client.post("/process-psbt", json={"psbt": incomplete_psbt})
+
+    assert response.json["error_code"] == 403 and response.json["message"] ==  "PSBT Failed to satisfy configured SpendLimit policy"
@@ -0,0 +1,90 @@
+import pytest
+
+from .test_framework.utils import createpsbt
+from ..src import standby
+from ..src.db import Database, Session
+from ..src.errors import ServerError
+from ..src.main import init_db
+from ..src.models import AggregateSpends, SignedSpends, SpentUtxos
+from ..src.standby import SPEND_JOURNAL, apply_shipped, catch_up, journal_names, read_manifest, ship_journaled
+
+@pytest.fixture
+def ship_to(tmp_path):
+    directory = str(tmp_path / "ship")
+    SPEND_JOURNAL.open(directory)
+    yield directory
+    SPEND_JOURNAL.directory = None
+
+@pytest.fixture
+def standby_db(tmp_path):
+    database = Database(str(tmp_path / "standby.db"))
+    with Session.use(database):
+        init_db()
+    return database
+
+def sign_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1, utxo):
+    unsigned_psbt = createpsbt(
+        resigner_wallet, [utxo], funder.getnewaddress(), 0.01, user_change_wallet_1.getnewaddress()
+    )
+    return client.post("/process-psbt", json={"psbt": user_wallet_1.walletprocesspsbt(unsigned_psbt)["psbt"]})
+
+def test_standby_replays_journaled_spends(client, ship_to, standby_db, funder, resigner_wallet, user_wallet_1,
+                                          user_change_wallet_1):
+    """The spends signed after the last snapshot are on the standby, counted once"""
+    ship_journaled(Session.path, ship_to, 1)
+    unspent = resigner_wallet.listunspent(7)
+    for utxo in unspent[:2]:
+        response = sign_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1, utxo)
+        assert response.status_code == 200
+    assert len(journal_names(ship_to)) == 2
+
+    signed = sorted(row["id"] for row in SignedSpends.get())
+    spent = sorted((row["txid"], row["vout"]) for row in SpentUtxos.get())
+    totals = AggregateSpends.get()
+    with Session.use(standby_db):
+        catch_up({"apply_from": ship_to})
+        assert sorted(row["id"] for row in SignedSpends.get()) == signed
+        assert sorted((row["txid"], row["vout"]) for row in SpentUtxos.get()) == spent
+        assert AggregateSpends.get() == totals
+
+        # Replayed again on the same snapshot, the spends aren't counted twice
+        apply_shipped(ship_to, read_manifest(ship_to), set())
+        assert AggregateSpends.get() == totals
+
+    # The next snapshot holds them: their entries are pruned
+    ship_journaled(Session.path, ship_to, 2)
+    assert journal_names(ship_to) == []
+    with Session.use(standby_db):
+        catch_up({"apply_from": ship_to})
+        assert sorted(row["id"] for row in SignedSpends.get()) == signed
+        assert AggregateSpends.get() == totals
+
+def test_spend_not_journaled_isnt_returned(client, tmp_path, funder, resigner_wallet, user_wallet_1,
+                                           user_change_wallet_1):
+    """A spend the standby can't be told about fails closed"""
+    SPEND_JOURNAL.directory = str(tmp_path / "missing")
+    try:
+        unspent = resigner_wallet.listunspent(7)
+        response = sign_spend(client, funder, resigner_wallet, user_wallet_1, user_change_wallet_1, unspent[0])
+    finally:
+        SPEND_JOURNAL.directory = None
+    assert response.status_code == 500
+    assert "psbt" not in (response.json or {})
+
+def test_promotion_waits_for_the_primary_to_stop(ship_to, standby_db, monkeypatch):
+    """A standby isn't promoted while the primary still ships snapshots"""
+    ship_journaled(Session.path, ship_to, 1)
+    apply_snapshot = standby.apply_snapshot
+    shipped = []
+
+    def apply_then_ship(directory):
+        apply_snapshot(directory)
+        # The primary ships a new snapshot meanwhile
+        shipped.append(len(shipped) + 2)
+        ship_journaled(Session.default.path, directory, shipped[-1])
+
+    monkeypatch.setattr(standby, "apply_snapshot", apply_then_ship)
+    with Session.use(standby_db):
+        with pytest.raises(ServerError):
+            catch_up({"apply_from": ship_to})
+    assert len(shipped) == standby.CATCH_UP_ROUNDS